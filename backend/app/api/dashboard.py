@@ -1,77 +1,260 @@
-from fastapi import APIRouter
+import asyncio
+import base64
+import itertools
+import json
+from datetime import date, datetime, timedelta
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 from app import firestore_client
-from datetime import datetime, timedelta
+from app.api.events import hub
+from app.processing import trifecta
+from app.api.response_cache import ResponseCache
+from app.lazy import LazyModule
+
+google_exceptions = LazyModule('google.api_core.exceptions')
 
 router = APIRouter()
 
+# ベットの保存・判定があった時だけレスポンスを作り直す
+response_cache = ResponseCache()
+
+def _invalidate_on_write(kind: str, event: dict):
+    if kind in ('bets', 'result'):
+        response_cache.invalidate()
+
+def _publish_on_write(kind: str, event: dict):
+    if kind in ('bets', 'prediction', 'result'):
+        # /betsと同じ日付形式にそろえる
+        event = {**event, 'date': event['date'].strftime('%Y-%m-%d')}
+        if kind == 'prediction':
+            # 保存用のコンパクトな形式 (trifecta120) を組み合わせごとの辞書のリストに展開して配信する
+            event['prediction'] = trifecta.from_record(event['prediction'])
+        hub.publish(kind, event)
+
+firestore_client.add_change_listener(_invalidate_on_write)
+firestore_client.add_change_listener(_publish_on_write)
+
 @router.get("/balance")
-async def get_balance_history():
+async def get_balance_history(request: Request):
     """
     収支推移を取得する
     """
-    if not firestore_client.db:
+    return await response_cache.respond(request, load_balance_history)
+
+DEFAULT_BETS_LIMIT = 50
+MAX_BETS_LIMIT = 500
+
+@router.get("/bets")
+async def get_recent_bets(
+    request: Request,
+    limit: int = Query(DEFAULT_BETS_LIMIT, ge=1, le=MAX_BETS_LIMIT),
+    cursor: Optional[str] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    place_id: Optional[int] = None,
+    status: Optional[str] = None,
+    fields: Optional[str] = None,
+):
+    """
+    投票履歴を新しい順に取得する
+    - cursor: 前のページのnext_cursorを渡すと続きを返す
+    - date_from / date_to: レース日 (YYYY-MM-DD、両端を含む)
+    - place_id / status: 場・判定結果 (pending / won / lost) で絞り込む
+    - fields: 返すフィールドをカンマ区切りで指定する
+    """
+    params = BetsQuery(limit, cursor, date_from, date_to, place_id, status, fields)
+    if params.is_default():
+        # ダッシュボードの定期取得はキャッシュから返す
+        return await response_cache.respond(request, load_recent_bets)
+    if not firestore_client.get_db():
+        return {"bets": [], "next_cursor": None}
+
+    # クエリの組み立て・最初の1件の取得までを先に済ませ、エラーは200を返す前にステータスで返す
+    query = params.build()
+    documents = query.stream()
+    try:
+        first = await asyncio.to_thread(next, documents, None)
+    except google_exceptions.GoogleAPICallError as e:
+        raise firestore_error(e)
+
+    # ページを丸ごとメモリに溜めずに1件ずつ送る
+    return StreamingResponse(stream_bets(params, first, documents), media_type="application/json")
+
+@router.get("/events")
+async def stream_events():
+    """
+    ベット・予測・結果の保存をServer-Sent Eventsで配信する
+    (event: bets / prediction / result、data: 保存された差分)
+    """
+    subscriber = hub.subscribe()
+    return StreamingResponse(
+        hub.stream(subscriber),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+async def load_balance_history():
+    """
+    ベットの保存・判定時に更新される日別収支ドキュメント (最大30件) から収支推移を計算する
+    """
+    if not firestore_client.get_db():
         return {"history": []}
     
-    # 過去30日分のベットを取得
+    # 過去30日分の日別収支を取得
     start_date = datetime.now() - timedelta(days=30)
-    bets = firestore_client.db.collection('bets')\
-        .where('created_at', '>=', start_date)\
-        .order_by('created_at')\
+    days = firestore_client.get_db().collection(firestore_client.BALANCE_COLLECTION)\
+        .where('date', '>=', firestore_client.get_balance_date(start_date))\
+        .order_by('date')\
         .stream()
         
     history = []
-    current_balance = 0
-    
-    # 日付ごとに集計
-    daily_balance = {}
     
-    for bet in bets:
-        data = bet.to_dict()
-        date_str = data['date'].strftime('%Y-%m-%d')
-        
-        amount = data.get('amount', 0)
-        return_amount = data.get('return_amount', 0)
-        
-        if date_str not in daily_balance:
-            daily_balance[date_str] = 0
-            
-        daily_balance[date_str] += (return_amount - amount)
-        
     # 累積和を計算
-    sorted_dates = sorted(daily_balance.keys())
     cumulative = 0
-    for date in sorted_dates:
-        cumulative += daily_balance[date]
+    for day in days:
+        data = day.to_dict()
+        cumulative += (data.get('return_amount', 0) - data.get('amount', 0))
         history.append({
-            "date": date,
+            "date": data['date'],
             "balance": cumulative
         })
         
     return {"history": history}
 
-@router.get("/bets")
-async def get_recent_bets():
+def serialize_bet(data: dict) -> dict:
+    # datetimeを文字列に変換
+    if data.get('date'):
+        data['date'] = data['date'].strftime('%Y-%m-%d')
+    if data.get('created_at'):
+        data['created_at'] = data['created_at'].isoformat()
+    if data.get('result_checked_at'):
+        data['result_checked_at'] = data['result_checked_at'].isoformat()
+    return data
+
+def encode_cursor(data: dict, doc_id: str) -> str:
+    values = {'id': doc_id}
+    for key in ('date', 'created_at'):
+        if isinstance(data.get(key), datetime):
+            values[key] = data[key].isoformat()
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor: str) -> dict:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        decoded = {'__name__': values['id']}
+        for key in ('date', 'created_at'):
+            if key in values:
+                decoded[key] = datetime.fromisoformat(values[key])
+        return decoded
+    except Exception:
+        raise HTTPException(status_code=400, detail="invalid cursor")
+
+class BetsQuery:
+    """/bets のクエリパラメータからFirestoreのクエリを組み立てる"""
+    def __init__(self, limit=DEFAULT_BETS_LIMIT, cursor=None, date_from=None, date_to=None,
+                 place_id=None, status=None, fields=None):
+        self.limit = limit
+        self.cursor = decode_cursor(cursor) if cursor else None
+        self.date_from = date_from
+        self.date_to = date_to
+        self.place_id = place_id
+        self.status = status
+        self.fields = [f.strip() for f in fields.split(',') if f.strip()] if fields else None
+
+    def is_default(self) -> bool:
+        return (self.limit == DEFAULT_BETS_LIMIT and not self.cursor and not self.date_from
+                and not self.date_to and self.place_id is None and not self.status and not self.fields)
+
+    def build(self):
+        """
+        新しい順 (created_at降順、同時刻はドキュメントID順) のクエリを作る
+        日付で絞り込む場合はFirestoreの制約上 date を先頭の並び順にする
+        必要な複合インデックスは terraform/main.tf を参照
+        """
+        desc = firestore_client.firestore.Query.DESCENDING
+        query = firestore_client.get_db().collection('bets')
+        if self.place_id is not None:
+            query = query.where('place_id', '==', self.place_id)
+        if self.status:
+            query = query.where('status', '==', self.status)
+
+        order_fields = ['created_at', '__name__']
+        if self.date_from or self.date_to:
+            order_fields = ['date'] + order_fields
+            if self.date_from:
+                query = query.where('date', '>=', datetime.combine(self.date_from, datetime.min.time()))
+            if self.date_to:
+                query = query.where('date', '<', datetime.combine(self.date_to + timedelta(days=1), datetime.min.time()))
+        for field in order_fields:
+            query = query.order_by(field, direction=desc)
+
+        if self.fields:
+            # カーソルを作るために並び順のフィールドは常に取得する
+            query = query.select(sorted(set(self.fields) | {'date', 'created_at'}))
+        if self.cursor:
+            missing = [f for f in order_fields if f not in self.cursor]
+            if missing:
+                raise HTTPException(status_code=400, detail="cursor does not match filters")
+            query = query.start_after({f: self.cursor[f] for f in order_fields})
+        return query.limit(self.limit)
+
+    def project(self, data: dict) -> dict:
+        if not self.fields:
+            return data
+        return {k: v for k, v in data.items() if k in self.fields}
+
+def firestore_error(e) -> HTTPException:
+    """Firestoreのエラーをレスポンスのステータスにする"""
+    if isinstance(e, (google_exceptions.InvalidArgument, google_exceptions.FailedPrecondition,
+                      google_exceptions.OutOfRange)):
+        # 絞り込みの組み合わせにクエリ (複合インデックス) が対応していない等
+        return HTTPException(status_code=400, detail=f"unsupported query: {e.message}")
+    if isinstance(e, google_exceptions.ResourceExhausted):
+        return HTTPException(status_code=429, detail="too many requests")
+    if isinstance(e, (google_exceptions.DeadlineExceeded, google_exceptions.ServiceUnavailable)):
+        return HTTPException(status_code=503, detail="firestore unavailable")
+    print(f"Firestore query failed: {e}")
+    return HTTPException(status_code=502, detail="firestore query failed")
+
+def stream_bets(params: BetsQuery, first, documents):
     """
-    最近の投票履歴を取得する
+    {"bets": [...], "next_cursor": ...} を1件ずつ書き出す
+    first: 送信前に取得済みの最初のドキュメント (無ければNone)、documents: 残りのドキュメント
+    (同期ジェネレータなのでStreamingResponseがスレッドプールで回す)
     """
-    if not firestore_client.db:
-        return {"bets": []}
-        
-    bets = firestore_client.db.collection('bets')\
-        .order_by('created_at', direction=firestore_client.firestore.Query.DESCENDING)\
-        .limit(50)\
-        .stream()
-        
+    yield '{"bets": ['
+    count = 0
+    last = None
+    error = None
+    try:
+        for bet in itertools.chain([first] if first is not None else [], documents):
+            data = bet.to_dict()
+            last = (dict(data), bet.id)
+            item = params.project(serialize_bet(data))
+            yield ("," if count else "") + json.dumps(item, ensure_ascii=False, default=str)
+            count += 1
+    except google_exceptions.GoogleAPICallError as e:
+        # ステータスは送信済みなので、JSONを閉じて途中から取り直せるカーソルを返す
+        print(f"Firestore query failed while streaming bets: {e}")
+        error = "firestore query failed"
+    next_cursor = encode_cursor(*last) if last and (error or count == params.limit) else None
+    tail = '], "next_cursor": ' + json.dumps(next_cursor)
+    if error:
+        tail += ', "error": ' + json.dumps(error)
+    yield tail + '}'
+
+async def load_recent_bets():
+    if not firestore_client.get_db():
+        return {"bets": [], "next_cursor": None}
+
+    params = BetsQuery()
     result = []
-    for bet in bets:
+    last = None
+    for bet in params.build().stream():
         data = bet.to_dict()
-        # datetimeを文字列に変換
-        data['date'] = data['date'].strftime('%Y-%m-%d')
-        if 'created_at' in data:
-            data['created_at'] = data['created_at'].isoformat()
-        if 'result_checked_at' in data and data['result_checked_at']:
-            data['result_checked_at'] = data['result_checked_at'].isoformat()
-            
-        result.append(data)
-        
-    return {"bets": result}
+        last = (dict(data), bet.id)
+        result.append(serialize_bet(data))
+
+    next_cursor = encode_cursor(*last) if last and len(result) == params.limit else None
+    return {"bets": result, "next_cursor": next_cursor}
@@ -0,0 +1,78 @@
+import asyncio
+import itertools
+import json
+import os
+
+# クライアントごとのバッファ上限。溢れた場合は古いイベントから捨てる
+EVENT_BUFFER_SIZE = int(os.getenv("EVENT_BUFFER_SIZE", "100"))
+# 接続維持のためのコメント送信間隔 (秒)
+EVENT_HEARTBEAT_INTERVAL = float(os.getenv("EVENT_HEARTBEAT_INTERVAL", "15"))
+
+class Subscriber:
+    def __init__(self, loop, buffer_size: int):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=buffer_size)
+        self.dropped = 0
+
+    def put(self, event):
+        # 遅いクライアントのためにサーバー側でイベントを溜め続けない
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+class EventHub:
+    """
+    プロセス内のイベント配信 (1つの書き込みを接続中の全クライアントに配る)
+    """
+    def __init__(self, buffer_size: int = EVENT_BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self.subscribers = set()
+        self._ids = itertools.count(1)
+        self.published = 0
+
+    def subscribe(self) -> Subscriber:
+        subscriber = Subscriber(asyncio.get_running_loop(), self.buffer_size)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+
+    def publish(self, kind: str, data: dict):
+        """イベントを全クライアントに配る (どのスレッドから呼んでもよい)"""
+        event = (next(self._ids), kind, data)
+        self.published += 1
+        for subscriber in list(self.subscribers):
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                running = None
+            if running is subscriber.loop:
+                subscriber.put(event)
+            else:
+                subscriber.loop.call_soon_threadsafe(subscriber.put, event)
+
+    async def stream(self, subscriber: Subscriber):
+        """Server-Sent Eventsの形式でイベントを送り続ける"""
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    event_id, kind, data = await asyncio.wait_for(subscriber.queue.get(), EVENT_HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                body = json.dumps(data, ensure_ascii=False, default=str)
+                yield f"id: {event_id}\nevent: {kind}\ndata: {body}\n\n"
+        finally:
+            self.unsubscribe(subscriber)
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": len(self.subscribers),
+            "published": self.published,
+            "dropped": sum(s.dropped for s in self.subscribers),
+        }
+
+hub = EventHub()
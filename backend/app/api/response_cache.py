@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from fastapi import Request, Response
+
+# 他インスタンスでの書き込みは通知されないので、念のためTTLでも期限切れにする
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "60"))
+
+class ResponseCache:
+    """
+    ダッシュボードのレスポンスをバージョン付きでキャッシュする
+    書き込みがあるとinvalidate()でバージョンが上がり、以降のリクエストで作り直す。
+    ETagはレスポンス本文のハッシュなので、作り直しても内容が同じなら304を返せる
+    """
+    def __init__(self, ttl: float = RESPONSE_CACHE_TTL):
+        self.ttl = ttl
+        self.version = 0
+        self._entries = {}  # key -> (version, created_at, etag, body)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.invalidations = 0
+
+    def invalidate(self, *args):
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+            self.invalidations += 1
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == self.version and time.monotonic() - entry[1] < self.ttl:
+                return entry
+        return None
+
+    async def respond(self, request: Request, compute) -> Response:
+        """
+        キャッシュから (無ければcompute()で作って) レスポンスを返す
+        If-None-MatchがETagと一致すれば304 Not Modifiedを返す
+        """
+        key = (request.url.path, str(request.url.query))
+        entry = self._lookup(key)
+        if entry:
+            self.hits += 1
+        else:
+            self.misses += 1
+            version = self.version
+            payload = await compute()
+            body = json.dumps(payload, ensure_ascii=False, default=str).encode('utf-8')
+            etag = f'"{hashlib.sha1(body).hexdigest()}"'
+            entry = (version, time.monotonic(), etag, body)
+            with self._lock:
+                # 計算中に無効化された場合は保存しない
+                if version == self.version:
+                    self._entries[key] = entry
+
+        etag, body = entry[2], entry[3]
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if etag in request.headers.get('if-none-match', ''):
+            self.not_modified += 1
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type='application/json', headers=headers)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "version": self.version,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / total if total else None,
+        }
@@ -0,0 +1,154 @@
+"""
+オフラインのバックテストエンジン
+
+保存済みのレース情報・オッズ・結果を、本番 (worker.handle_predict) と同じ
+特徴量エンジニアリング -> 予測 -> 買い方の処理に通して収支を計算する。GCPは不要。
+
+入力はJSON Lines (1行1レース):
+    {"race_id": "...", "date": "YYYYMMDD", "place_id": 1, "race_number": 1, "deadline": "ISO8601",
+     "info": {...}, "odds": [120要素] | {"format": "trifecta120", ...} | [{"combination", "odds"}, ...],
+     "result": {"combination": "1-2-3", "payout": 1230, "is_returned": false}}
+Firestoreのracesドキュメントをそのまま書き出した形 (predict_1minにオッズを持つ) も読める。
+"""
+import itertools
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from app.processing import feature_engineering, trifecta, betting
+from app.ml.predictor import get_predictor
+
+def parse_odds_field(odds) -> np.ndarray:
+    if odds is None:
+        return None
+    if isinstance(odds, dict):
+        if odds.get('format') != trifecta.RECORD_FORMAT:
+            return None
+        odds = odds['odds']
+    if len(odds) == trifecta.N_COMBINATIONS and not isinstance(odds[0], dict):
+        return np.array([np.nan if v is None else v for v in odds], dtype=np.float64)
+    return trifecta.odds_from_list(odds)
+
+def normalize_race(raw: dict):
+    """1レース分のデータをバックテスト用の形にそろえる (必要なデータが無ければNone)"""
+    metadata = raw.get('metadata', {})
+    info = raw.get('info')
+    odds = parse_odds_field(raw.get('odds', raw.get('predict_1min')))
+    result = raw.get('result')
+    if not info or odds is None or not result or not result.get('combination'):
+        return None
+    place_id = raw.get('place_id', metadata.get('place_id', info.get('place_id')))
+    return {
+        'race_id': raw.get('race_id'),
+        'place_id': int(place_id) if place_id is not None else 0,
+        'order_key': str(raw.get('deadline') or metadata.get('date') or raw.get('date') or info.get('date') or ''),
+        'info': info,
+        'odds': odds,
+        'result': result,
+    }
+
+def load_races(path: str) -> list:
+    races = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            race = normalize_race(json.loads(line))
+            if race:
+                races.append(race)
+    # ドローダウン計算のために時系列順にする
+    races.sort(key=lambda r: (r['order_key'], r['place_id']))
+    return races
+
+def prepare_chunk(races: list) -> dict:
+    """
+    レースの塊を特徴量 -> 予測まで進め、買い方の評価に必要な配列にする
+    (ワーカープロセスで実行される。モデルはプロセスごとに1回ロード)
+    """
+    features = feature_engineering.engineer_boat_features_batch([r['info'] for r in races])
+    probabilities = get_predictor().predict_proba_batch(features)
+    win_idx = np.array([trifecta.COMBINATION_INDEX.get(r['result']['combination'], -1) for r in races], dtype=np.int32)
+    payout = np.array([float(r['result'].get('payout') or 0) for r in races])
+    return {
+        'odds': np.vstack([r['odds'] for r in races]),
+        'probabilities': np.asarray(probabilities, dtype=np.float64),
+        'win_idx': win_idx,
+        'payout': payout,
+        'place_id': np.array([r['place_id'] for r in races], dtype=np.int32),
+    }
+
+def prepare(races: list, workers: int = 1, chunk_size: int = 2000) -> dict:
+    """全レースの予測をプロセスプールで並列に行い、配列を連結して返す"""
+    if not races:
+        raise ValueError("no races to backtest")
+    chunks = [races[i:i + chunk_size] for i in range(0, len(races), chunk_size)]
+    if workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            parts = list(pool.map(prepare_chunk, chunks))
+    else:
+        parts = [prepare_chunk(chunk) for chunk in chunks]
+    return {key: np.concatenate([p[key] for p in parts]) for key in parts[0]}
+
+def max_drawdown(profits: np.ndarray) -> float:
+    cumulative = np.cumsum(profits)
+    peak = np.maximum.accumulate(np.concatenate([[0.0], cumulative]))[1:]
+    return float((peak - cumulative).max()) if len(cumulative) else 0.0
+
+def evaluate(prepared: dict, strategy) -> dict:
+    """1つの買い方について全レースの収支をまとめて計算する"""
+    stakes = betting.select_bets(prepared['odds'], prepared['probabilities'], strategy)
+    win_idx = prepared['win_idx']
+    rows = np.arange(len(win_idx))
+
+    stake_per_race = stakes.sum(axis=1)
+    winning_stake = np.where(win_idx >= 0, stakes[rows, np.clip(win_idx, 0, None)], 0.0)
+    return_per_race = winning_stake * prepared['payout'] / 100.0 # 100円あたりの払戻金なので
+    profit = return_per_race - stake_per_race
+
+    races_bet = int((stake_per_race > 0).sum())
+    hits = int((winning_stake > 0).sum())
+    total_stake = float(stake_per_race.sum())
+    total_return = float(return_per_race.sum())
+
+    venues = {}
+    place_ids = prepared['place_id']
+    for place_id in np.unique(place_ids):
+        mask = place_ids == place_id
+        v_stake = float(stake_per_race[mask].sum())
+        v_return = float(return_per_race[mask].sum())
+        venues[int(place_id)] = {
+            'races_bet': int((stake_per_race[mask] > 0).sum()),
+            'stake': v_stake,
+            'return': v_return,
+            'roi': v_return / v_stake if v_stake else None,
+        }
+
+    return {
+        'races': len(win_idx),
+        'races_bet': races_bet,
+        'bets': int((stakes > 0).sum()),
+        'hits': hits,
+        'hit_rate': hits / races_bet if races_bet else None,
+        'stake': total_stake,
+        'return': total_return,
+        'profit': total_return - total_stake,
+        'roi': total_return / total_stake if total_stake else None,
+        'max_drawdown': max_drawdown(profit),
+        'venues': venues,
+    }
+
+def expand_grid(grid: dict) -> list:
+    """{'threshold': [100, 110], 'amount': [100]} -> パラメータの全組み合わせ"""
+    if not grid:
+        return [{}]
+    keys = list(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+
+def run_grid(prepared: dict, strategy_name: str, grid: dict) -> list:
+    """パラメータの全組み合わせを評価する (予測は1回だけ)"""
+    results = []
+    for params in expand_grid(grid):
+        strategy = betting.get_strategy(strategy_name, **params)
+        results.append({'strategy': strategy_name, 'params': params, **evaluate(prepared, strategy)})
+    return results
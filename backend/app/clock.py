@@ -0,0 +1,44 @@
+"""
+スケジューラ・結果キャッシュが使う時計
+
+通常は datetime.now() / time.monotonic() / asyncio.sleep と同じ。
+負荷試験 (scripts/load_test.py) ではaccelerate()で仮想時刻を早回しし、
+1日分のレースを数分で流す
+"""
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+_speed = 1.0
+_origin = None  # (基準の実時間 monotonic秒, 基準の仮想時刻)
+
+def accelerate(start: datetime, speed: float):
+    """仮想時刻をstartから始め、実時間のspeed倍で進める"""
+    global _speed, _origin
+    _speed = speed
+    _origin = (time.monotonic(), start)
+
+def reset():
+    global _speed, _origin
+    _speed = 1.0
+    _origin = None
+
+def speed() -> float:
+    return _speed
+
+def now() -> datetime:
+    if _origin is None:
+        return datetime.now()
+    real_start, virtual_start = _origin
+    return virtual_start + timedelta(seconds=(time.monotonic() - real_start) * _speed)
+
+def monotonic() -> float:
+    """仮想時間の経過秒 (間隔の計測用)"""
+    return time.monotonic() * _speed
+
+def to_real(seconds: float) -> float:
+    """仮想時間の秒数を実時間の秒数に直す"""
+    return seconds / _speed
+
+async def sleep(seconds: float):
+    await asyncio.sleep(to_real(seconds))
@@ -0,0 +1,249 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from app import clock, metrics
+from app.stats import latency_summary
+
+# 同時に処理するイベント数
+EVENT_WORKERS = int(os.getenv("EVENT_WORKERS", "8"))
+# 処理時間の見積もりの初期値 (秒)。実行するたびに実績で更新する
+EVENT_DEFAULT_DURATION = float(os.getenv("EVENT_DEFAULT_DURATION", "2"))
+# イベント種別ごとの同時実行数の上限 (例: "scrape_info=4,check_result=2")。指定の無い種別はEVENT_WORKERSまで
+EVENT_TYPE_CONCURRENCY = os.getenv("EVENT_TYPE_CONCURRENCY", "scrape_info=4,predict_5min=4,check_result=2")
+# キューに溜めておけるイベント数 (これを超えたら受け付けず、Pub/Subに再送させる)
+EVENT_QUEUE_LIMIT = int(os.getenv("EVENT_QUEUE_LIMIT", "100"))
+# プロセスのメモリ使用量 (RSS) の上限 (MB)。超えている間は新しいイベントを受け付けない。0なら無効
+EVENT_MEMORY_LIMIT_MB = float(os.getenv("EVENT_MEMORY_LIMIT_MB", "0"))
+
+# 優先度 (小さいほど先)。同じ優先度の中では期限が近い順
+EVENT_PRIORITY = {
+    'predict_1min': 0,
+    'scrape_info': 1,
+    'predict_5min': 1,
+    'check_result': 2,
+}
+# 処理を終えている必要がある時刻 (締切からの秒数)。Noneは期限なし
+# scrape_info / predict_5min は predict_1min (締切60秒前) に間に合わなければ意味がない
+EVENT_DUE_OFFSET = {
+    'predict_1min': 0,
+    'scrape_info': -60,
+    'predict_5min': -60,
+    'check_result': None,
+}
+
+# 優先度ごとに使ってよいキューの割合 (混雑時は締切の遠いイベントから断る)
+QUEUE_SHARE = {0: 1.0, 1: 0.8, 2: 0.5}
+
+# 処理時間の見積もり (指数移動平均) の重み
+_ESTIMATE_ALPHA = 0.2
+
+def parse_limits(spec: str) -> dict:
+    """'scrape_info=4,check_result=2' -> {'scrape_info': 4, 'check_result': 2}"""
+    limits = {}
+    for item in spec.split(','):
+        key, _, value = item.partition('=')
+        if key.strip() and value.strip():
+            limits[key.strip()] = int(value)
+    return limits
+
+def current_rss_mb():
+    """現在のメモリ使用量 (RSS、MB)。取得できない環境ではNone"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return None
+
+class Saturated(Exception):
+    """処理能力を超えているためイベントを受け付けなかった"""
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+class EventExecutor:
+    """
+    Pub/Subイベントを締切が近い順に処理するプロセス内の実行キュー
+    同時実行数をEVENT_WORKERS (種別ごとにはEVENT_TYPE_CONCURRENCY) に制限し、
+    空いたワーカーは優先度・期限の順に次のイベントを取る。
+    期限までに終わらない見込みのイベントは実行せずに捨てる。
+    キュー・メモリの上限を超える場合はSaturatedを送出し、呼び出し元 (/pubsub/handler) が再送を求める
+    """
+    def __init__(self, workers: int = EVENT_WORKERS, default_duration: float = EVENT_DEFAULT_DURATION,
+                 type_concurrency: dict = None, queue_limit: int = EVENT_QUEUE_LIMIT,
+                 memory_limit_mb: float = EVENT_MEMORY_LIMIT_MB):
+        self.workers = workers
+        self.default_duration = default_duration
+        self.type_concurrency = parse_limits(EVENT_TYPE_CONCURRENCY) if type_concurrency is None else type_concurrency
+        self.queue_limit = queue_limit
+        self.memory_limit_mb = memory_limit_mb
+        self.heap = []  # [(優先度, 期限, seq, event_type, job, future, キュー投入時刻)]
+        self._seq = itertools.count()
+        self._ready = None
+        self._tasks = []
+        self._loop = None
+        self._capacity = None
+        self.running = 0
+        self.running_by_type = {}
+        # 統計
+        self.estimates = {}
+        self.executed = {}
+        self.dropped = {}
+        self.rejected = {}
+        self._waits = {}
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or all(t.done() for t in self._tasks):
+            if self._loop is not loop:
+                # 別のイベントループ (テスト等) のキューは引き継がない
+                self.heap = []
+            self._loop = loop
+            self._ready = asyncio.Semaphore(len(self.heap))
+            self._capacity = asyncio.Event()
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def due_time(self, event_type: str, deadline: datetime):
+        offset = EVENT_DUE_OFFSET.get(event_type)
+        if offset is None:
+            return None
+        return deadline + timedelta(seconds=offset)
+
+    def estimate(self, event_type: str) -> float:
+        return self.estimates.get(event_type, self.default_duration)
+
+    def is_late(self, event_type: str, due: datetime, now: datetime) -> bool:
+        """見込みの処理時間では期限までに終わらないか"""
+        if due is None:
+            return False
+        return now + timedelta(seconds=self.estimate(event_type)) > due
+
+    def _drop(self, event_type: str, reason: str):
+        self.dropped[event_type] = self.dropped.get(event_type, 0) + 1
+        metrics.EVENTS_DROPPED.inc(event_type=event_type, reason=reason)
+
+    def saturation(self, event_type: str):
+        """受け付けられない場合はその理由を返す (受け付けられればNone)"""
+        share = QUEUE_SHARE.get(EVENT_PRIORITY.get(event_type, 1), 1.0)
+        if len(self.heap) >= self.queue_limit * share:
+            return 'queue_full'
+        if self.memory_limit_mb:
+            rss = current_rss_mb()
+            if rss is not None and rss >= self.memory_limit_mb:
+                return 'memory'
+        return None
+
+    def submit(self, event_type: str, deadline: datetime, job) -> asyncio.Future:
+        """
+        job (引数なしのコルーチン関数) をキューに入れ、完了すると結果が入るFutureを返す
+        (実行すればTrue、期限に間に合わず捨てればFalse)
+        混雑している場合はSaturatedを送出する
+        """
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        due = self.due_time(event_type, deadline)
+        if self.is_late(event_type, due, clock.now()):
+            self._drop(event_type, 'late')
+            future.set_result(False)
+            return future
+
+        reason = self.saturation(event_type)
+        if reason:
+            self.rejected[event_type] = self.rejected.get(event_type, 0) + 1
+            metrics.EVENTS_DROPPED.inc(event_type=event_type, reason=reason)
+            raise Saturated(reason)
+
+        priority = EVENT_PRIORITY.get(event_type, 1)
+        heapq.heappush(self.heap, (priority, due or datetime.max, next(self._seq), event_type, job, future, time.perf_counter()))
+        self._ready.release()
+        return future
+
+    def _pop_runnable(self):
+        """種別ごとの同時実行数に空きがあるイベントのうち、最も優先度の高いものを取り出す"""
+        skipped = []
+        item = None
+        while self.heap:
+            candidate = heapq.heappop(self.heap)
+            event_type = candidate[3]
+            if self.running_by_type.get(event_type, 0) < self.type_concurrency.get(event_type, self.workers):
+                item = candidate
+                break
+            skipped.append(candidate)
+        for candidate in skipped:
+            heapq.heappush(self.heap, candidate)
+        return item
+
+    async def _next(self):
+        await self._ready.acquire()
+        while True:
+            item = self._pop_runnable()
+            if item:
+                return item
+            # 上限に達している種別しか残っていなければ、どれかが終わるまで待つ
+            self._capacity.clear()
+            await self._capacity.wait()
+
+    async def _worker(self):
+        while True:
+            _, due, _, event_type, job, future, enqueued_at = await self._next()
+            wait = time.perf_counter() - enqueued_at
+            self._waits.setdefault(event_type, deque(maxlen=2000)).append(wait)
+            metrics.QUEUE_WAIT_SECONDS.observe(wait, event_type=event_type)
+            if future.done():
+                continue  # 呼び出し元がキャンセルされた
+            if self.is_late(event_type, None if due == datetime.max else due, clock.now()):
+                self._drop(event_type, 'late')
+                future.set_result(False)
+                continue
+
+            self.running += 1
+            self.running_by_type[event_type] = self.running_by_type.get(event_type, 0) + 1
+            start = time.perf_counter()
+            try:
+                await job()
+                if not future.done():
+                    future.set_result(True)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.running -= 1
+                self.running_by_type[event_type] -= 1
+                self._capacity.set()
+                # 期限は仮想時刻 (app.clock) で判定するので、見積もりも仮想時間の秒数にする
+                elapsed = (time.perf_counter() - start) * clock.speed()
+                previous = self.estimates.get(event_type)
+                self.estimates[event_type] = elapsed if previous is None else previous + _ESTIMATE_ALPHA * (elapsed - previous)
+                self.executed[event_type] = self.executed.get(event_type, 0) + 1
+
+    def stats(self) -> dict:
+        types = sorted(set(self.executed) | set(self.dropped) | set(self.rejected) | set(self._waits))
+        return {
+            "workers": self.workers,
+            "queued": len(self.heap),
+            "queue_limit": self.queue_limit,
+            "running": self.running,
+            "memory_mb": current_rss_mb(),
+            "memory_limit_mb": self.memory_limit_mb or None,
+            "events": {
+                t: {
+                    "executed": self.executed.get(t, 0),
+                    "dropped": self.dropped.get(t, 0),
+                    "rejected": self.rejected.get(t, 0),
+                    "running": self.running_by_type.get(t, 0),
+                    "concurrency": self.type_concurrency.get(t, self.workers),
+                    "estimated_seconds": self.estimate(t),
+                    "queue_wait": latency_summary(self._waits.get(t, ())),
+                }
+                for t in types
+            },
+        }
+
+executor_instance = EventExecutor()
+
+def get_executor():
+    return executor_instance
@@ -1,23 +1,226 @@
+import functools
 import os
-from google.cloud import firestore
-from datetime import datetime
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from app import metrics
+from app.cache import TTLCache
+from app.lazy import LazyModule, record_load_time
 
 PROJECT_ID = os.getenv("PROJECT_ID", "dummy-project")
 
+# google.cloud.firestore (gRPC含む) のimportとクライアントの作成は初めて使うときまで遅らせる
+firestore = LazyModule('google.cloud.firestore')
+_db = None
+_db_lock = threading.Lock()
+
 if PROJECT_ID == "dummy-project":
-    db = None
     print("[Mock Firestore] Initialized")
-else:
-    db = firestore.Client(project=PROJECT_ID)
+
+def get_db():
+    """Firestoreクライアントを返す (モックモードではNone)"""
+    global _db
+    if PROJECT_ID == "dummy-project":
+        return None
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                start = time.perf_counter()
+                _db = firestore.Client(project=PROJECT_ID)
+                record_load_time('firestore.Client', time.perf_counter() - start)
+    return _db
+
+def transactional(func):
+    """firestore.transactionalと同じ (ただしgoogle.cloud.firestoreは初回の呼び出し時にimportする)"""
+    wrapped = None
+
+    @functools.wraps(func)
+    def call(transaction, *args, **kwargs):
+        nonlocal wrapped
+        if wrapped is None:
+            wrapped = firestore.transactional(func)
+        return wrapped(transaction, *args, **kwargs)
+    return call
+
+# Firestoreの1バッチあたりの書き込み上限
+MAX_BATCH_WRITES = 500
+
+# 日別収支の集計ドキュメント (ID: YYYY-MM-DD)
+# amount / return_amount / bets / won と、場ごとの同じ値を venues.{place_id} に持つ
+BALANCE_COLLECTION = 'daily_balance'
+
+# 処理済みイベントの記録 (Pub/Subの重複配信で同じ処理を繰り返さないため。ID: イベントキー)
+# expire_atを過ぎたドキュメントはFirestoreのTTLポリシーで削除される (terraform/main.tf)
+EVENT_CLAIM_COLLECTION = 'event_claims'
+# 処理中の記録の有効期限 (秒)。インスタンスが処理中に落ちた場合、これを過ぎると他のインスタンスが引き継げる
+EVENT_CLAIM_LEASE = float(os.getenv("EVENT_CLAIM_LEASE", "300"))
+EVENT_CLAIM_RETENTION = timedelta(days=2)
+
+# インスタンス間で1台だけが担う処理の担当 (リース) の記録 (ID: リース名)
+LEASE_COLLECTION = 'leases'
+
+# レース情報のプロセス内キャッシュ (scrape_info -> predict_5min/1min 間のFirestore読み込みを省く)
+RACE_INFO_CACHE_SIZE = int(os.getenv("RACE_INFO_CACHE_SIZE", "512"))
+RACE_INFO_CACHE_TTL = float(os.getenv("RACE_INFO_CACHE_TTL", "1800"))
+race_info_cache = TTLCache(max_entries=RACE_INFO_CACHE_SIZE, ttl=RACE_INFO_CACHE_TTL)
+
+# 書き込み時に呼ばれるコールバック callback(kind, payload)
+# kind: 'race_info' / 'prediction' / 'bets' / 'result'
+_change_listeners = []
+
+def add_change_listener(callback):
+    """書き込みの通知を受け取るコールバックを登録する (キャッシュの無効化など)"""
+    _change_listeners.append(callback)
+
+def remove_change_listener(callback):
+    if callback in _change_listeners:
+        _change_listeners.remove(callback)
+
+def notify_change(kind: str, date: datetime, place_id: int, race_number: int, **payload):
+    event = {
+        'race_id': get_race_id(date, place_id, race_number),
+        'date': date,
+        'place_id': place_id,
+        'race_number': race_number,
+        **payload
+    }
+    for callback in list(_change_listeners):
+        try:
+            callback(kind, event)
+        except Exception as e:
+            print(f"Error in change listener: {e}")
 
 def get_race_id(date: datetime, place_id: int, race_number: int):
     return f"{date.strftime('%Y%m%d')}-{place_id}-{race_number}"
 
-def save_race_info(date: datetime, place_id: int, race_number: int, data: dict):
-    if not db: return
-    race_id = get_race_id(date, place_id, race_number)
-    doc_ref = db.collection('races').document(race_id)
-    doc_ref.set({
+def get_bet_id(race_id: str, combination: str):
+    return f"{race_id}-{combination}"
+
+def merge_fields(base: dict, fields: dict) -> dict:
+    """set(merge=True)と同じようにネストした辞書をマージする"""
+    for key, value in fields.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            merge_fields(base[key], value)
+        else:
+            base[key] = value
+    return base
+
+def commit_writes(writes: list):
+    """
+    [(op, doc_ref, data)] をバッチでまとめて書き込む (opは 'set' / 'merge' / 'update')
+    上限を超える場合は複数バッチに分割する
+    """
+    db = get_db()
+    if not db or not writes: return
+    for start in range(0, len(writes), MAX_BATCH_WRITES):
+        batch = db.batch()
+        for op, doc_ref, data in writes[start:start + MAX_BATCH_WRITES]:
+            if op == 'update':
+                batch.update(doc_ref, data)
+            else:
+                batch.set(doc_ref, data, merge=(op == 'merge'))
+        batch.commit()
+
+def get_bulk_writer():
+    """大量書き込み (バックフィル等) 用のBulkWriterを返す"""
+    db = get_db()
+    if not db: return None
+    return db.bulk_writer()
+
+class RaceWriteBatch:
+    """
+    1レース分の書き込みを溜めて1回のcommitで送る
+    racesドキュメントへの複数のmergeは1つの書き込みにまとめる
+    """
+    def __init__(self, date: datetime, place_id: int, race_number: int):
+        self.date = date
+        self.place_id = place_id
+        self.race_number = race_number
+        self.race_id = get_race_id(date, place_id, race_number)
+        self.race_fields = {}
+        self.bets = []
+        self.predictions = {}
+
+    def merge_race(self, fields: dict):
+        merge_fields(self.race_fields, fields)
+        return self
+
+    def add_prediction(self, prediction_data, type_key: str):
+        self.predictions[type_key] = prediction_data
+        return self.merge_race(prediction_fields(prediction_data, type_key))
+
+    def add_bet(self, bet_data: dict):
+        self.bets.append(bet_data)
+        return self
+
+    def commit(self):
+        db = get_db()
+        if db:
+            with metrics.span('firestore_commit'):
+                if self.bets:
+                    # ベットがある場合は日別収支の集計と同じトランザクションで書き込む
+                    _commit_race_batch(db.transaction(), self)
+                elif self.race_fields:
+                    commit_writes([('merge', db.collection('races').document(self.race_id), self.race_fields)])
+        self._notify()
+
+    def _notify(self):
+        for type_key, prediction_data in self.predictions.items():
+            notify_change('prediction', self.date, self.place_id, self.race_number,
+                          type_key=type_key, prediction=prediction_data)
+        if self.bets:
+            notify_change('bets', self.date, self.place_id, self.race_number, bets=self.bets)
+
+@transactional
+def _commit_race_batch(transaction, batch: RaceWriteBatch):
+    db = get_db()
+    bet_refs = [db.collection('bets').document(get_bet_id(batch.race_id, b['combination'])) for b in batch.bets]
+    # 同じベットの再保存で二重計上しないよう、既存のベットとの差分だけ集計に加える
+    existing = {snap.id: snap.to_dict() for snap in transaction.get_all(bet_refs) if snap.exists}
+
+    delta = {'amount': 0, 'return_amount': 0, 'bets': 0, 'won': 0}
+    for ref, bet_data in zip(bet_refs, batch.bets):
+        old = existing.get(ref.id)
+        delta['amount'] += bet_data.get('amount', 0) - (old.get('amount', 0) if old else 0)
+        if old:
+            # set()で上書きすると判定結果も消える
+            delta['return_amount'] -= old.get('return_amount') or 0
+            delta['won'] -= 1 if old.get('status') == 'won' else 0
+        else:
+            delta['bets'] += 1
+
+    if batch.race_fields:
+        transaction.set(db.collection('races').document(batch.race_id), batch.race_fields, merge=True)
+    for ref, bet_data in zip(bet_refs, batch.bets):
+        transaction.set(ref, bet_fields(batch.date, batch.place_id, batch.race_number, bet_data))
+    fields = balance_delta_fields(batch.date, batch.place_id, **delta)
+    if fields:
+        transaction.set(get_balance_ref(batch.date), fields, merge=True)
+
+def get_balance_date(date: datetime) -> str:
+    return date.strftime('%Y-%m-%d')
+
+def get_balance_ref(date: datetime):
+    return get_db().collection(BALANCE_COLLECTION).document(get_balance_date(date))
+
+def balance_delta_fields(date: datetime, place_id: int, amount=0, return_amount=0, bets=0, won=0):
+    """
+    日別収支ドキュメントに加算する内容 (全体と場ごと)
+    差分が無ければNoneを返す
+    """
+    delta = {'amount': amount, 'return_amount': return_amount, 'bets': bets, 'won': won}
+    delta = {k: v for k, v in delta.items() if v}
+    if not delta:
+        return None
+    return {
+        'date': get_balance_date(date),
+        **{k: firestore.Increment(v) for k, v in delta.items()},
+        'venues': {str(place_id): {k: firestore.Increment(v) for k, v in delta.items()}},
+        'updated_at': firestore.SERVER_TIMESTAMP
+    }
+
+def race_info_fields(date: datetime, place_id: int, race_number: int, data: dict) -> dict:
+    return {
         'info': data,
         'metadata': {
             'date': date,
@@ -25,69 +228,188 @@ def save_race_info(date: datetime, place_id: int, race_number: int, data: dict):
             'race_number': race_number,
             'updated_at': firestore.SERVER_TIMESTAMP
         }
-    }, merge=True)
-
-def get_race_info_data(date: datetime, place_id: int, race_number: int):
-    if not db: return {}
-    race_id = get_race_id(date, place_id, race_number)
-    doc = db.collection('races').document(race_id).get()
-    if doc.exists:
-        return doc.to_dict().get('info', {})
-    return {}
+    }
 
-def save_prediction(date: datetime, place_id: int, race_number: int, prediction_data: dict, type_key: str):
-    """
-    type_key: 'predict_5min' or 'predict_1min'
-    """
-    if not db: return
-    race_id = get_race_id(date, place_id, race_number)
-    doc_ref = db.collection('races').document(race_id)
-    doc_ref.set({
+def prediction_fields(prediction_data, type_key: str) -> dict:
+    return {
         type_key: prediction_data,
         'metadata': {'updated_at': firestore.SERVER_TIMESTAMP}
-    }, merge=True)
+    }
 
-def save_bet(date: datetime, place_id: int, race_number: int, bet_data: dict):
-    if not db: return
-    race_id = get_race_id(date, place_id, race_number)
+def bet_fields(date: datetime, place_id: int, race_number: int, bet_data: dict) -> dict:
     # betsコレクションは独立させるか、racesのサブコレクションにするか
     # ここでは独立したコレクションにする
-    bet_id = f"{race_id}-{bet_data['combination']}"
-    db.collection('bets').document(bet_id).set({
-        'race_id': race_id,
+    return {
+        'race_id': get_race_id(date, place_id, race_number),
         'date': date,
         'place_id': place_id,
         'race_number': race_number,
         **bet_data,
         'created_at': firestore.SERVER_TIMESTAMP
+    }
+
+def save_race_info(date: datetime, place_id: int, race_number: int, data: dict):
+    race_id = get_race_id(date, place_id, race_number)
+    race_info_cache.set(race_id, data)
+    db = get_db()
+    if db:
+        with metrics.span('firestore_save_race_info'):
+            doc_ref = db.collection('races').document(race_id)
+            doc_ref.set(race_info_fields(date, place_id, race_number, data), merge=True)
+    notify_change('race_info', date, place_id, race_number)
+
+def get_race_info_data(date: datetime, place_id: int, race_number: int):
+    """レース情報を取得する (キャッシュにあればFirestoreを読まない)"""
+    race_id = get_race_id(date, place_id, race_number)
+    cached = race_info_cache.get(race_id)
+    if cached is not None:
+        return cached
+    db = get_db()
+    if not db: return {}
+    with metrics.span('firestore_get_race_info'):
+        doc = db.collection('races').document(race_id).get()
+    if doc.exists:
+        info = doc.to_dict().get('info', {})
+        if info:
+            race_info_cache.set(race_id, info)
+        return info
+    return {}
+
+def save_prediction_and_bets(date: datetime, place_id: int, race_number: int, prediction_data, type_key: str, bets: list):
+    """予測結果とベットをまとめて1回のバッチで保存する"""
+    batch = RaceWriteBatch(date, place_id, race_number).add_prediction(prediction_data, type_key)
+    for bet_data in bets:
+        batch.add_bet(bet_data)
+    batch.commit()
+
+def claim_event(event_key: str) -> bool:
+    """
+    イベントの処理権を取る (トランザクションで他のインスタンスと競合しないようにする)
+    処理済み、または他のインスタンスが処理中ならFalseを返す
+    """
+    db = get_db()
+    if not db: return True
+    with metrics.span('firestore_claim_event'):
+        return _claim_event(db.transaction(), db.collection(EVENT_CLAIM_COLLECTION).document(event_key))
+
+@transactional
+def _claim_event(transaction, ref) -> bool:
+    snap = ref.get(transaction=transaction)
+    now = datetime.now(timezone.utc)
+    if snap.exists:
+        claim = snap.to_dict()
+        if claim.get('status') == 'done':
+            return False
+        lease_until = claim.get('lease_until')
+        if lease_until and lease_until > now:
+            return False
+    transaction.set(ref, {
+        'status': 'processing',
+        'lease_until': now + timedelta(seconds=EVENT_CLAIM_LEASE),
+        'expire_at': now + EVENT_CLAIM_RETENTION,
+        'claimed_at': firestore.SERVER_TIMESTAMP,
     })
+    return True
 
-def save_result(date: datetime, place_id: int, race_number: int, result_data: dict):
+def complete_event(event_key: str):
+    """イベントを処理済みにする (以降の重複配信は処理しない)"""
+    db = get_db()
+    if not db: return
+    db.collection(EVENT_CLAIM_COLLECTION).document(event_key).update({
+        'status': 'done',
+        'completed_at': firestore.SERVER_TIMESTAMP,
+    })
+
+def release_event(event_key: str):
+    """処理に失敗したイベントの処理権を手放す (再配信で処理し直せるようにする)"""
+    db = get_db()
+    if not db: return
+    db.collection(EVENT_CLAIM_COLLECTION).document(event_key).delete()
+
+def acquire_lease(name: str, holder: str, ttl: float) -> bool:
+    """
+    リースを取得・延長する (ttl秒後に期限切れ)
+    他のholderが期限内のリースを持っていればFalseを返す。モックモードでは常に取得できる
+    """
+    db = get_db()
+    if not db: return True
+    return _acquire_lease(db.transaction(), db.collection(LEASE_COLLECTION).document(name), holder, ttl)
+
+@transactional
+def _acquire_lease(transaction, ref, holder: str, ttl: float) -> bool:
+    snap = ref.get(transaction=transaction)
+    now = datetime.now(timezone.utc)
+    if snap.exists:
+        lease = snap.to_dict()
+        expires_at = lease.get('expires_at')
+        if lease.get('holder') != holder and expires_at and expires_at > now:
+            return False
+    transaction.set(ref, {
+        'holder': holder,
+        'expires_at': now + timedelta(seconds=ttl),
+        'renewed_at': firestore.SERVER_TIMESTAMP,
+    })
+    return True
+
+def release_lease(name: str, holder: str):
+    """自分が持っているリースを手放す (他のインスタンスがすぐに引き継げるようにする)"""
+    db = get_db()
     if not db: return
+    _release_lease(db.transaction(), db.collection(LEASE_COLLECTION).document(name), holder)
+
+@transactional
+def _release_lease(transaction, ref, holder: str):
+    snap = ref.get(transaction=transaction)
+    if snap.exists and snap.to_dict().get('holder') == holder:
+        transaction.delete(ref)
+
+def settle_bet(bet_dict: dict, result_data: dict):
+    """結果からベットの判定を行い (status, return_amount) を返す"""
+    if bet_dict['combination'] == result_data['combination']:
+        status = 'won'
+        return_amount = bet_dict['amount'] * (result_data['payout'] / 100.0) # 100円あたりの払戻金なので
+    else:
+        status = 'lost'
+        return_amount = 0
+        if result_data.get('is_returned'): # 返還の場合
+             # ここでは簡易的に全返還とするが、実際は艇番ごとの返還ロジックが必要
+             # 今回は要件にないのでスキップ、または全て返還扱いにするか
+             pass
+    return status, return_amount
+
+def save_result(date: datetime, place_id: int, race_number: int, result_data: dict):
+    """レース結果の保存・ベットの判定・日別収支の更新を1つのトランザクションで書き込む"""
+    db = get_db()
+    if db:
+        with metrics.span('firestore_save_result'):
+            _settle_race(db.transaction(), date, place_id, race_number, result_data)
+    notify_change('result', date, place_id, race_number, result=result_data)
+
+@transactional
+def _settle_race(transaction, date: datetime, place_id: int, race_number: int, result_data: dict):
+    db = get_db()
     race_id = get_race_id(date, place_id, race_number)
-    
+
+    # ベットの取得 (トランザクション内では読み込みを先に行う)
+    bets = list(transaction.get(db.collection('bets').where('race_id', '==', race_id)))
+
     # レース情報更新
-    db.collection('races').document(race_id).set({
-        'result': result_data
-    }, merge=True)
-    
-    # ベットの判定
-    bets = db.collection('bets').where('race_id', '==', race_id).stream()
+    transaction.set(db.collection('races').document(race_id), {'result': result_data}, merge=True)
+
+    # ベットの判定 (再判定の場合は前回との差分だけ集計に加える)
+    delta_return = 0
+    delta_won = 0
     for bet in bets:
         bet_dict = bet.to_dict()
-        if bet_dict['combination'] == result_data['combination']:
-            status = 'won'
-            return_amount = bet_dict['amount'] * (result_data['payout'] / 100.0) # 100円あたりの払戻金なので
-        else:
-            status = 'lost'
-            return_amount = 0
-            if result_data.get('is_returned'): # 返還の場合
-                 # ここでは簡易的に全返還とするが、実際は艇番ごとの返還ロジックが必要
-                 # 今回は要件にないのでスキップ、または全て返還扱いにするか
-                 pass
-
-        db.collection('bets').document(bet.id).update({
+        status, return_amount = settle_bet(bet_dict, result_data)
+        delta_return += return_amount - (bet_dict.get('return_amount') or 0)
+        delta_won += (1 if status == 'won' else 0) - (1 if bet_dict.get('status') == 'won' else 0)
+        transaction.update(bet.reference, {
             'status': status,
             'return_amount': return_amount,
             'result_checked_at': firestore.SERVER_TIMESTAMP
         })
+
+    fields = balance_delta_fields(date, place_id, return_amount=delta_return, won=delta_won)
+    if fields:
+        transaction.set(get_balance_ref(date), fields, merge=True)
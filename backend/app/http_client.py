@@ -0,0 +1,96 @@
+import asyncio
+import os
+import time
+from collections import deque
+import aiohttp
+from urllib.parse import urlsplit
+from app import metrics, page_archive
+from app.stats import latency_summary
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+
+# コネクションプール設定 (環境変数で調整可能)
+HTTP_LIMIT = int(os.getenv("HTTP_LIMIT", "100"))                    # 全体の同時接続数
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", "20"))   # ホストごとの同時接続数
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", "600"))                # DNSキャッシュ秒数
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", "60"))           # Keep-Alive秒数
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "10"))               # リクエスト全体のタイムアウト
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "3"))
+
+# スクレイピング先のオリジンを差し替える (負荷試験用のローカルサーバー等。例: http://127.0.0.1:8081)
+SITE_ORIGIN = "https://www.boatrace.jp"
+BOATRACE_ORIGIN = os.getenv("BOATRACE_ORIGIN", "")
+
+# 直近のフェッチレイテンシ (秒) を保持してp50/p99を計測する
+LATENCY_WINDOW = int(os.getenv("HTTP_LATENCY_WINDOW", "2000"))
+
+_session = None
+_latencies = deque(maxlen=LATENCY_WINDOW)
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    アプリ全体で共有するClientSessionを返す (イベントループ内で呼ぶこと)
+    """
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_LIMIT,
+            limit_per_host=HTTP_LIMIT_PER_HOST,
+            use_dns_cache=True,
+            ttl_dns_cache=HTTP_DNS_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE,
+        )
+        timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout, headers=HEADERS)
+    return _session
+
+async def close_session():
+    """アプリ終了時にセッションを閉じる"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+def resolve_url(url: str) -> str:
+    if BOATRACE_ORIGIN and url.startswith(SITE_ORIGIN):
+        return BOATRACE_ORIGIN.rstrip('/') + url[len(SITE_ORIGIN):]
+    return url
+
+async def fetch_html(url: str):
+    """
+    共有セッションでURLを取得し、ステータス200ならbytesを返す
+    PAGE_ARCHIVE_DIRが設定されていれば取得したページをアーカイブし、
+    replayモードではネットワークに出ずアーカイブから返す
+    """
+    # ステージ名はページの種類 (fetch_racelist, fetch_odds3t, ...)
+    with metrics.span(f"fetch_{urlsplit(url).path.rsplit('/', 1)[-1]}"):
+        return await _fetch_html(url)
+
+async def _fetch_html(url: str):
+    archive = page_archive.get_archive()
+    if archive and page_archive.is_replay():
+        return await asyncio.to_thread(archive.get, url, page_archive.replay_time())
+
+    start = time.perf_counter()
+    try:
+        async with get_session().get(resolve_url(url)) as response:
+            if response.status == 200:
+                html = await response.read()
+                if archive:
+                    # 圧縮・ファイル書き込みはイベントループを止めないようスレッドで行う
+                    try:
+                        await asyncio.to_thread(archive.put, url, html)
+                    except Exception as e:
+                        print(f"Error archiving {url}: {e}")
+                return html
+    except Exception as e:
+        print(f"Error fetching {url}: {e}")
+    finally:
+        _latencies.append(time.perf_counter() - start)
+    return None
+
+def get_latency_stats() -> dict:
+    """直近のフェッチレイテンシ統計 (ミリ秒)"""
+    return latency_summary(_latencies)
@@ -0,0 +1,47 @@
+"""
+重いライブラリ (google.cloud.*, pandas 等) を初めて使う時点でimportする
+
+起動時 (Cloud Runのコールドスタート) に全てのリクエストが使うわけではないライブラリの
+import時間を払わないようにする。読み込みにかかった時間は load_times() で確認できる
+"""
+import importlib
+import threading
+import time
+
+_load_times = {}
+
+class LazyModule:
+    """属性に初めてアクセスした時点でモジュールをimportする代理オブジェクト"""
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    start = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    _load_times[self._name] = time.perf_counter() - start
+                    self._module = module
+        return self._module
+
+    @property
+    def loaded(self) -> bool:
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self.loaded else 'not loaded'
+        return f"<LazyModule {self._name} ({state})>"
+
+def record_load_time(name: str, seconds: float):
+    """LazyModule以外で遅延して初期化したもの (モデル・クライアント等) の所要時間を記録する"""
+    _load_times[name] = seconds
+
+def load_times() -> dict:
+    """遅延して読み込んだモジュール・初期化にかかった秒数"""
+    return dict(_load_times)
@@ -1,13 +1,45 @@
+import asyncio
 import base64
 import json
 import os
-from fastapi import FastAPI, Request, BackgroundTasks
-from app.scheduler import check_and_dispatch
-from app.worker import process_event
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, Response, BackgroundTasks
+from fastapi.responses import PlainTextResponse
+from app.scheduler import check_and_dispatch, stop_dispatcher
+from app.worker import submit_event
 from app.api import dashboard
+from app.ml.batcher import get_batcher
+from app.executor import Saturated, get_executor
+from app.ml import pool
+from app.ml.pool import shutdown_pool, warm_up
+from app.ml.registry import get_registry
+from app.ml import predictor
+from app import http_client, firestore_client, lazy, metrics
 from fastapi.middleware.cors import CORSMiddleware
 
-app = FastAPI()
+# 起動後にバックグラウンドでモデルをロードするか (0なら最初の推論時にロードする)
+MODEL_WARMUP = os.getenv("MODEL_WARMUP", "1") == "1"
+
+async def warm_up_model():
+    try:
+        await warm_up()
+        print("Model warmed up")
+    except Exception as e:
+        print(f"Model warm-up failed: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # モデルのロードは起動を待たせずにバックグラウンドで行う (/dispatch やダッシュボードはモデルを使わない)
+    warmup = asyncio.create_task(warm_up_model()) if MODEL_WARMUP else None
+    # 共有HTTPセッションはアプリのライフタイム全体で使い回す
+    yield
+    if warmup and not warmup.done():
+        warmup.cancel()
+    await stop_dispatcher()
+    await http_client.close_session()
+    shutdown_pool()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -23,15 +55,80 @@ app.include_router(dashboard.router, prefix="/api/dashboard")
 async def root():
     return {"message": "Boat Race Trading System API"}
 
+@app.get("/stats/http")
+async def http_stats():
+    """スクレイピングのフェッチレイテンシ (p50/p99)"""
+    return http_client.get_latency_stats()
+
+@app.get("/stats/cache")
+async def cache_stats():
+    """プロセス内キャッシュのヒット率"""
+    return {
+        "race_info": firestore_client.race_info_cache.stats(),
+        "dashboard": dashboard.response_cache.stats(),
+        "events": dashboard.hub.stats(),
+    }
+
+@app.get("/stats/inference")
+async def inference_stats():
+    """推論マイクロバッチのスループット・レイテンシ"""
+    return get_batcher().stats()
+
+@app.get("/stats/events")
+async def event_stats():
+    """イベント実行キューの待ち時間・破棄件数 (イベント種別ごと)"""
+    return get_executor().stats()
+
+@app.get("/stats/startup")
+async def startup_stats():
+    """遅延して読み込んだライブラリ・クライアント・モデルの読み込み時間 (秒)"""
+    return {"model_loaded": predictor.is_loaded(), "load_seconds": lazy.load_times()}
+
+@app.get("/models")
+async def list_models():
+    """レジストリのモデルのバージョン・推論に使っているバージョン・切り替えの状態"""
+    registry = get_registry()
+    return {
+        "versions": registry.versions(),
+        "current": registry.current_version(),
+        "active": pool.model_version(),
+        "reload": pool.reload_state,
+    }
+
+@app.post("/models/{version}/activate", status_code=202)
+async def activate_model(version: str):
+    """
+    モデルをバックグラウンドでロード・ウォームアップして切り替える (再起動不要)
+    進み具合は GET /models の reload で確認する
+    """
+    try:
+        pool.start_reload(version)
+    except ValueError as e:
+        return Response(content=str(e), status_code=404)
+    except RuntimeError as e:
+        return Response(content=str(e), status_code=409)
+    return {"status": "loading", "version": version}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """ステージごとの処理時間・ベット時の締切までの残り秒数 (Prometheus形式)"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.post("/dispatch")
 async def dispatch_job(background_tasks: BackgroundTasks):
-    """Cloud Schedulerから呼ばれるエンドポイント"""
+    """Cloud Schedulerから呼ばれるエンドポイント (時刻表の更新と発行ループの死活監視)"""
     background_tasks.add_task(check_and_dispatch)
     return {"status": "dispatched"}
 
+# 混雑時に返すRetry-After (秒)。Pub/Subはサブスクリプションの再試行ポリシーで再送する
+EVENT_RETRY_AFTER = int(os.getenv("EVENT_RETRY_AFTER", "2"))
+
 @app.post("/pubsub/handler")
-async def pubsub_handler(request: Request, background_tasks: BackgroundTasks):
-    """Pub/Sub Pushサブスクリプションから呼ばれるエンドポイント"""
+async def pubsub_handler(request: Request):
+    """
+    Pub/Sub Pushサブスクリプションから呼ばれるエンドポイント
+    実行キューが一杯の場合は429を返してnackし、再送で他のインスタンスに回す
+    """
     try:
         envelope = await request.json()
         if not envelope:
@@ -50,11 +147,15 @@ async def pubsub_handler(request: Request, background_tasks: BackgroundTasks):
             data_str = base64.b64decode(pubsub_message["data"]).decode("utf-8").strip()
             try:
                 data = json.loads(data_str)
-                # バックグラウンドで処理を実行
-                background_tasks.add_task(process_event, data)
             except json.JSONDecodeError:
                 print(f"Invalid JSON: {data_str}")
                 return "Invalid JSON", 400
+            try:
+                # 実行キューに入れてすぐに応答する (処理は締切の近い順にバックグラウンドで行う)
+                submit_event(data)
+            except Saturated as e:
+                print(f"Rejecting {data.get('type')} ({e.reason}), Pub/Sub will retry")
+                return Response(status_code=429, headers={"Retry-After": str(EVENT_RETRY_AFTER)})
 
         return ("", 204)
 
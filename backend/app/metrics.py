@@ -0,0 +1,161 @@
+"""
+処理時間の計測とPrometheus形式での出力 (/metrics)
+
+各ステージを span('fetch_odds3t') のように囲むとヒストグラムに記録される。
+event_type / venue ラベルは worker.process_event が event_labels() で設定し、
+同じタスク (とそこから作られたタスク) 内のspanに引き継がれる
+"""
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from app import clock
+
+# 秒単位のバケット (スクレイピング・推論・Firestore書き込みの想定範囲)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# 締切までの残り秒数のバケット (predict_1minは締切60秒前に発行される)
+SLACK_BUCKETS = (0, 5, 10, 15, 20, 30, 40, 50, 60, 90, 120)
+
+_context = contextvars.ContextVar('metrics_labels', default={})
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra: str = '') -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [bucketごとの件数, 合計, 件数]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(n, '')) for n in self.labelnames)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            if idx < len(self.buckets):
+                series[0][idx] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._series.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(n, '')) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+_registry = []
+
+def counter(name: str, help: str, labelnames: tuple = ()) -> Counter:
+    metric = Counter(name, help, labelnames)
+    _registry.append(metric)
+    return metric
+
+def histogram(name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+    metric = Histogram(name, help, labelnames, buckets)
+    _registry.append(metric)
+    return metric
+
+STAGE_SECONDS = histogram(
+    "alchemy_stage_duration_seconds",
+    "Duration of each pipeline stage (stage=total is the whole event)",
+    ("stage", "event_type", "venue"),
+)
+BET_DEADLINE_SLACK = histogram(
+    "alchemy_bet_deadline_slack_seconds",
+    "Seconds remaining before the race deadline when bets were saved",
+    ("venue",),
+    SLACK_BUCKETS,
+)
+QUEUE_WAIT_SECONDS = histogram(
+    "alchemy_event_queue_wait_seconds",
+    "Time events waited in the executor queue before starting",
+    ("event_type",),
+)
+EVENTS_DROPPED = counter(
+    "alchemy_events_dropped_total",
+    "Events that were not processed",
+    ("event_type", "reason"),
+)
+
+@contextmanager
+def event_labels(event_type: str, place_id):
+    """このブロック内 (とそこから作られたタスク) のspanにevent_type / venueラベルを付ける"""
+    token = _context.set({'event_type': event_type, 'venue': place_id})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+@contextmanager
+def span(stage: str):
+    """ブロックの実行時間をステージの処理時間として記録する (例外で抜けた場合も記録する)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage, **_context.get())
+
+def observe_bet_slack(deadline: datetime, place_id):
+    BET_DEADLINE_SLACK.observe((deadline - clock.now()).total_seconds(), venue=place_id)
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def reset():
+    for metric in _registry:
+        metric.clear()
@@ -0,0 +1,112 @@
+import os
+import time
+import asyncio
+from collections import deque
+import numpy as np
+from app.ml.pool import INFERENCE_POOL_SIZE, predict_proba_batch_async
+from app.stats import latency_summary
+
+# マイクロバッチ設定
+INFERENCE_MAX_BATCH = int(os.getenv("INFERENCE_MAX_BATCH", "16"))    # 1回の推論にまとめる最大レース数
+INFERENCE_MAX_WAIT = float(os.getenv("INFERENCE_MAX_WAIT", "0.02"))  # 最初のリクエストからバッチを締め切るまでの秒数
+
+class InferenceBatcher:
+    """
+    同じ時間帯に届いた複数レースの推論リクエストを1つのDataFrameにまとめ、
+    1回のpredict_probaで処理して各呼び出し元に結果を返す
+    """
+    def __init__(self, max_batch: int = INFERENCE_MAX_BATCH, max_wait: float = INFERENCE_MAX_WAIT,
+                 max_in_flight: int = INFERENCE_POOL_SIZE):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_in_flight = max_in_flight
+        self.queue = None
+        self._loop = None
+        self._task = None
+        self._slots = None
+        self._in_flight = set()
+        # 統計
+        self.requests = 0
+        self.batches = 0
+        self.inference_seconds = 0.0
+        self._latencies = deque(maxlen=2000)
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            if self._loop is not loop:
+                # 別のイベントループ (テスト等) のキュー・処理中のバッチは引き継がない
+                self._in_flight = set()
+            self._loop = loop
+            self.queue = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+            self._task = asyncio.create_task(self._run())
+
+    async def predict(self, input_data: dict) -> np.ndarray:
+        """
+        1レース分の入力を推論キューに入れ、確率が返るまで待つ
+        確率はtrifecta.COMBINATIONSの順に並んだ120要素の配列
+        """
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((input_data, future, time.perf_counter()))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # ワーカーが全て埋まっている間はリクエストをキューに溜め、次のバッチを大きくする
+            await self._slots.acquire()
+            batch = [await self.queue.get()]
+            batch_deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = batch_deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            task = asyncio.create_task(self._score(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _infer(self, inputs: list) -> list:
+        return await predict_proba_batch_async(inputs)
+
+    async def _score(self, batch: list):
+        inputs = [item[0] for item in batch]
+        start = time.perf_counter()
+        try:
+            results = await self._infer(inputs)
+        except Exception as e:
+            print(f"Inference failed for batch of {len(batch)}: {e}")
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+
+        finished = time.perf_counter()
+        self.batches += 1
+        self.requests += len(batch)
+        self.inference_seconds += finished - start
+        for (_, future, enqueued_at), probabilities in zip(batch, results):
+            self._latencies.append(finished - enqueued_at)
+            if not future.done():
+                future.set_result(probabilities)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "avg_batch_size": self.requests / self.batches if self.batches else None,
+            "throughput_per_sec": self.requests / self.inference_seconds if self.inference_seconds else None,
+            "latency": latency_summary(self._latencies),
+        }
+
+batcher_instance = InferenceBatcher()
+
+def get_batcher():
+    return batcher_instance
@@ -0,0 +1,134 @@
+import os
+import asyncio
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from app.ml import predictor
+from app.ml.predictor import get_predictor
+from app.ml.registry import get_registry
+
+# 推論を実行するワーカープール
+# 'thread': モデルはプロセス内で1つを共有 (AutoGluonのモデルは推論中GILを解放するものが多い)
+# 'process': ワーカープロセスごとにモデルを1回ロードする (CPUを使い切りたい場合)
+INFERENCE_POOL_KIND = os.getenv("INFERENCE_POOL_KIND", "thread")
+INFERENCE_POOL_SIZE = int(os.getenv("INFERENCE_POOL_SIZE", "2"))
+
+_executor = None
+# モデルの切り替えの状態 (/models で返す)
+reload_state = {'loading': None, 'last_error': None, 'reloaded_at': None, 'reload_seconds': None}
+_reload_task = None
+# 'process' のワーカーが使っているバージョン (Noneは起動時にレジストリで使用中だったバージョン)
+_process_version = None
+
+def _init_worker(version: str = None):
+    # ワーカー起動時にモデルをロードしておく
+    if version:
+        predictor.activate(version)
+    else:
+        get_predictor()
+
+def _predict_batch(inputs: list) -> list:
+    return get_predictor().predict_proba_batch(inputs)
+
+def _model_version():
+    return get_predictor().version
+
+def _create_executor(version: str = None):
+    if INFERENCE_POOL_KIND == 'process':
+        return ProcessPoolExecutor(
+            max_workers=INFERENCE_POOL_SIZE,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(version,),
+        )
+    return ThreadPoolExecutor(
+        max_workers=INFERENCE_POOL_SIZE,
+        thread_name_prefix='inference',
+        initializer=_init_worker,
+    )
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = _create_executor(_process_version)
+    return _executor
+
+async def predict_proba_batch_async(inputs: list) -> list:
+    """イベントループを止めずにワーカープールで推論する"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), _predict_batch, inputs)
+
+async def warm_up():
+    """ワーカープールにモデルをロードしておく (最初の推論がロードを待たないように)"""
+    loop = asyncio.get_running_loop()
+    executor = get_executor()
+    await asyncio.gather(*[loop.run_in_executor(executor, _init_worker) for _ in range(INFERENCE_POOL_SIZE)])
+
+def model_version():
+    """推論に使っているモデルのバージョン (未ロード、またはレジストリを使っていなければNone)"""
+    if INFERENCE_POOL_KIND == 'process':
+        return _process_version or (get_registry().current_version() if _executor else None)
+    return predictor.predictor_instance.version if predictor.is_loaded() else None
+
+async def reload(version: str):
+    """
+    推論に使うモデルを切り替える (ロード・ウォームアップが終わるまでは今のモデルで推論を続ける)
+    'thread': プロセス内のモデルを predictor.activate で入れ替える
+    'process': 新しいバージョンをロードしたワーカープールを作って入れ替える。古いプールは
+              処理中の推論が終わってから終了させ、ワーカープロセスごとメモリを解放する
+    成功したらレジストリの使用中のバージョンも更新する (再起動後も同じバージョンを使う)
+    """
+    global _executor, _process_version
+    get_registry().path(version)
+    start = time.perf_counter()
+    if INFERENCE_POOL_KIND == 'process':
+        executor = _create_executor(version)
+        loop = asyncio.get_running_loop()
+        try:
+            # 全ワーカーを起動し、initializerでのロード・ウォームアップを終わらせておく
+            loaded = await asyncio.gather(*[loop.run_in_executor(executor, _model_version) for _ in range(INFERENCE_POOL_SIZE)])
+        except Exception:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        if set(loaded) != {version}:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise RuntimeError(f"Workers loaded unexpected model versions: {loaded}")
+        old, _executor, _process_version = _executor, executor, version
+        if old is not None:
+            threading.Thread(target=old.shutdown, kwargs={'wait': True}, name='pool-retire', daemon=True).start()
+    else:
+        await asyncio.to_thread(predictor.activate, version)
+    get_registry().set_current(version)
+    reload_state['reloaded_at'] = time.time()
+    reload_state['reload_seconds'] = time.perf_counter() - start
+
+def start_reload(version: str) -> asyncio.Task:
+    """
+    モデルの切り替えをバックグラウンドで始める
+    存在しないバージョンならValueError、切り替え中ならRuntimeErrorを送出する
+    """
+    global _reload_task
+    get_registry().path(version)
+    if reload_state['loading']:
+        raise RuntimeError(f"Model {reload_state['loading']} is already loading")
+    reload_state['loading'] = version
+    reload_state['last_error'] = None
+
+    async def run():
+        try:
+            await reload(version)
+        except Exception as e:
+            print(f"Model reload to {version} failed: {e}")
+            reload_state['last_error'] = f"{version}: {e}"
+        finally:
+            reload_state['loading'] = None
+
+    _reload_task = asyncio.create_task(run())
+    return _reload_task
+
+def shutdown_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
@@ -1,43 +1,170 @@
+import gc
 import os
-import pandas as pd
-try:
-    from autogluon.tabular import TabularPredictor
-except ImportError:
-    print("AutoGluon not installed or failed to import.")
-    TabularPredictor = None
+import threading
+import time
+import numpy as np
+from app.processing import feature_engineering, trifecta
+from app.lazy import LazyModule, record_load_time
+from app.ml.registry import get_registry
+
+# pandas・AutoGluonは推論で初めて使うときにimportする (起動時間を短くするため)
+pd = LazyModule('pandas')
 
 MODEL_PATH = os.getenv("MODEL_PATH", "AutogluonModels/ag-20220904_034430") # Default path or env var
+# 切り替え前にウォームアップで推論する合成レースの数
+MODEL_WARMUP_BATCH = int(os.getenv("MODEL_WARMUP_BATCH", "16"))
+# 切り替え後、古いモデルで処理中の推論が終わるのを待つ最大秒数 (過ぎたら参照が無くなった時点で解放される)
+MODEL_RETIRE_TIMEOUT = float(os.getenv("MODEL_RETIRE_TIMEOUT", "60"))
+
+def synthetic_inputs(n: int) -> list:
+    """ウォームアップ用の合成レース (特徴量エンジニアリング済みの入力)"""
+    records = []
+    for i in range(n):
+        race = {'place_id': i % 24 + 1, 'race_number': i % 12 + 1}
+        for b in feature_engineering.BOATS:
+            race[f'r{b}_global_win_rate'] = round(7.0 - b * 0.6 + (i % 5) * 0.1, 2)
+            race[f'r{b}_motor_3ren'] = 30.0 + (b * 7 + i) % 25
+            race[f'r{b}_exhibition_time'] = round(6.70 + (b + i) % 4 * 0.05, 2)
+            race[f'r{b}_exhibition_st'] = round(0.05 + (b * 3 + i) % 6 * 0.03, 2)
+        records.append(race)
+    return feature_engineering.engineer_boat_features_batch(records)
 
 class Predictor:
-    def __init__(self):
+    def __init__(self, path: str = MODEL_PATH, version: str = None):
+        self.path = path
+        self.version = version
         self.predictor = None
-        if TabularPredictor and os.path.exists(MODEL_PATH):
+        self.retired = False
+        self.warmup_seconds = None
+        self._in_flight = 0
+        self._idle = threading.Condition()
+        try:
+            from autogluon.tabular import TabularPredictor
+        except ImportError:
+            print("AutoGluon not installed or failed to import.")
+            TabularPredictor = None
+        if TabularPredictor and os.path.exists(path):
             try:
-                self.predictor = TabularPredictor.load(MODEL_PATH)
-                print(f"Model loaded from {MODEL_PATH}")
+                self.predictor = TabularPredictor.load(path)
+                print(f"Model loaded from {path}")
             except Exception as e:
                 print(f"Failed to load model: {e}")
         else:
-            print(f"Model not found at {MODEL_PATH}")
+            print(f"Model not found at {path}")
 
     def predict_proba(self, input_data: dict):
         """
-        入力データを受け取り、各クラス（組み合わせ）の確率を返す
+        入力データを受け取り、各クラス（組み合わせ）の確率を
+        trifecta.COMBINATIONSの順に並んだ120要素の配列で返す
+        """
+        return self.predict_proba_batch([input_data])[0]
+
+    def predict_proba_batch(self, inputs: list):
+        """
+        複数レースの入力をまとめて1回の推論で処理し、(レース数 × 120) の確率の配列を返す
         """
-        if not self.predictor:
-            # モック: ランダムな確率を返す
-            print("Using mock prediction")
-            combinations = [f"{i}-{j}-{k}" for i in range(1,7) for j in range(1,7) for k in range(1,7) if i!=j and i!=k and j!=k]
-            return {c: 1.0/len(combinations) for c in combinations}
+        with self._idle:
+            if self.retired:
+                # 切り替え直前に取得した古いモデルが既に解放されていれば、新しいモデルで推論する
+                return get_predictor().predict_proba_batch(inputs)
+            self._in_flight += 1
+            model = self.predictor
+        try:
+            if not model:
+                # モック: 一様な確率を返す
+                print("Using mock prediction")
+                return np.full((len(inputs), trifecta.N_COMBINATIONS), 1.0 / trifecta.N_COMBINATIONS)
+
+            df = pd.DataFrame(inputs)
+            # AutoGluonのpredict_probaはDataFrameを返す (列=クラスラベル)
+            pred_proba = model.predict_proba(df)
 
-        df = pd.DataFrame([input_data])
-        # AutoGluonのpredict_probaはDataFrameを返す
-        pred_proba = self.predictor.predict_proba(df)
-        
-        # 1行目の結果を辞書で返す {class_label: prob, ...}
-        return pred_proba.iloc[0].to_dict()
+            return trifecta.probability_matrix(pred_proba)
+        finally:
+            with self._idle:
+                self._in_flight -= 1
+                self._idle.notify_all()
 
-predictor_instance = Predictor()
+    def warm_up(self, n: int = MODEL_WARMUP_BATCH):
+        """
+        合成レースで推論して、初回の推論の遅さ (遅延初期化) を切り替え前に済ませる
+        出力が確率として不正なら ValueError を送出する
+        """
+        inputs = synthetic_inputs(n)
+        features = getattr(self.predictor, 'features', None)
+        if callable(features):
+            # 学習時の特徴量のうち合成レースに無いものは欠損として渡す
+            inputs = [{**dict.fromkeys(features()), **row} for row in inputs]
+        start = time.perf_counter()
+        probabilities = self.predict_proba_batch(inputs)
+        self.warmup_seconds = time.perf_counter() - start
+        if probabilities.shape != (n, trifecta.N_COMBINATIONS):
+            raise ValueError(f"Unexpected prediction shape: {probabilities.shape}")
+        sums = probabilities.sum(axis=1)
+        if not np.all(np.isfinite(probabilities)) or probabilities.min() < 0 or np.any(sums > 1 + 1e-6) or np.any(sums <= 0):
+            raise ValueError("Model returned invalid probabilities")
+
+    def retire(self, timeout: float = MODEL_RETIRE_TIMEOUT):
+        """処理中の推論が終わるのを待ってからモデルを解放する"""
+        with self._idle:
+            if not self._idle.wait_for(lambda: self._in_flight == 0, timeout):
+                print(f"Model {self.version} still has {self._in_flight} predictions in flight; releasing after they finish")
+            self.retired = True
+            model, self.predictor = self.predictor, None
+        unpersist = getattr(model, 'unpersist', None) or getattr(model, 'unpersist_models', None)
+        if unpersist:
+            try:
+                unpersist()
+            except Exception as e:
+                print(f"Failed to unpersist model {self.version}: {e}")
+        del model
+        gc.collect()
+        print(f"Model {self.version or self.path} released")
+
+predictor_instance = None
+_lock = threading.Lock()
+
+def load_version(version: str = None) -> Predictor:
+    """
+    レジストリのバージョンをロードする
+    Noneならレジストリで使用中のバージョン (レジストリが空なら MODEL_PATH)
+    """
+    registry = get_registry()
+    version = version or registry.current_version()
+    if version is None:
+        return Predictor(MODEL_PATH)
+    return Predictor(registry.path(version), version)
 
 def get_predictor():
+    """モデルを返す (初回の呼び出しでロードする)"""
+    global predictor_instance
+    if predictor_instance is None:
+        with _lock:
+            if predictor_instance is None:
+                start = time.perf_counter()
+                predictor_instance = load_version()
+                record_load_time('model', time.perf_counter() - start)
     return predictor_instance
+
+def activate(version: str) -> Predictor:
+    """
+    バージョンをロード・ウォームアップしてから get_predictor() の返すモデルを切り替える
+    切り替えまでは今のモデルで推論を続け、切り替え前に始まった推論は古いモデルで最後まで処理する。
+    古いモデルはそれらが終わってから解放する
+    """
+    global predictor_instance
+    start = time.perf_counter()
+    candidate = load_version(version)
+    if candidate.predictor is None:
+        raise RuntimeError(f"Failed to load model version {version}")
+    candidate.warm_up()
+    with _lock:
+        old, predictor_instance = predictor_instance, candidate
+    record_load_time('model', time.perf_counter() - start)
+    if old is not None:
+        threading.Thread(target=old.retire, name='model-retire', daemon=True).start()
+    print(f"Model switched to {version} (warm-up {candidate.warmup_seconds * 1000:.1f} ms)")
+    return candidate
+
+def is_loaded() -> bool:
+    return predictor_instance is not None
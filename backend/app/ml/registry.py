@@ -0,0 +1,74 @@
+"""
+バージョン付きモデルのローカルレジストリ
+
+MODEL_REGISTRY_DIR/
+  <version>/   AutoGluonのモデルディレクトリ (TabularPredictor.save の出力)
+  CURRENT      使用中のバージョン名 (再起動時もこのバージョンをロードする)
+
+CURRENTが無ければ最も新しい (名前順で最後の) バージョンを使う。
+レジストリが空の場合は従来どおり MODEL_PATH のモデルを使う
+"""
+import os
+import shutil
+
+MODEL_REGISTRY_DIR = os.getenv("MODEL_REGISTRY_DIR", "model_registry")
+CURRENT_FILE = 'CURRENT'
+
+class ModelRegistry:
+    def __init__(self, directory: str = MODEL_REGISTRY_DIR):
+        self.directory = directory
+
+    def versions(self) -> list:
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            name for name in os.listdir(self.directory)
+            if not name.startswith('.') and os.path.isdir(os.path.join(self.directory, name))
+        )
+
+    def path(self, version: str) -> str:
+        if not version or os.sep in version or version.startswith('.'):
+            raise ValueError(f"Invalid model version: {version!r}")
+        path = os.path.join(self.directory, version)
+        if not os.path.isdir(path):
+            raise ValueError(f"Model version not found: {version}")
+        return path
+
+    def current_version(self):
+        """使用中のバージョン (レジストリが空ならNone)"""
+        try:
+            with open(os.path.join(self.directory, CURRENT_FILE), encoding='utf-8') as f:
+                version = f.read().strip()
+            if version in self.versions():
+                return version
+            print(f"Model version in {CURRENT_FILE} not found: {version}")
+        except FileNotFoundError:
+            pass
+        versions = self.versions()
+        return versions[-1] if versions else None
+
+    def set_current(self, version: str):
+        self.path(version)
+        tmp = os.path.join(self.directory, f'.{CURRENT_FILE}.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(version + '\n')
+        os.replace(tmp, os.path.join(self.directory, CURRENT_FILE))
+
+    def add(self, source: str, version: str) -> str:
+        """モデルディレクトリをコピーして新しいバージョンとして登録する"""
+        if version in self.versions():
+            raise ValueError(f"Model version already exists: {version}")
+        if not version or os.sep in version or version.startswith('.'):
+            raise ValueError(f"Invalid model version: {version!r}")
+        os.makedirs(self.directory, exist_ok=True)
+        # コピー途中のディレクトリをバージョンとして読まないよう、隠しディレクトリにコピーしてからリネームする
+        tmp = os.path.join(self.directory, f'.{version}.tmp')
+        shutil.rmtree(tmp, ignore_errors=True)
+        shutil.copytree(source, tmp)
+        os.replace(tmp, os.path.join(self.directory, version))
+        return os.path.join(self.directory, version)
+
+registry_instance = ModelRegistry()
+
+def get_registry():
+    return registry_instance
@@ -0,0 +1,253 @@
+"""
+取得したHTMLのアーカイブ (パーサーの不具合の再現や過去データの作り直し用)
+
+ページ本文は内容のハッシュ (SHA-256) で重複を除き、圧縮してセグメントファイルに追記する。
+取得の記録は (URL, 取得時刻) をキーにした固定長レコードの索引に追記し、mmapで読む。
+
+    {PAGE_ARCHIVE_DIR}/
+        segment-00000.dat  圧縮済みの本文 (追記のみ)
+        blobs.idx          ハッシュ -> (セグメント, オフセット, 長さ, 圧縮形式)
+        fetches.idx        (URLのハッシュ, 取得時刻, 本文のハッシュ)
+        urls.txt           URLの一覧 (一覧表示用)
+
+zstandardがあればzstd、無ければzlibで圧縮する (レコードごとに形式を持つので混在してよい)
+"""
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime
+import numpy as np
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 空ならアーカイブしない
+PAGE_ARCHIVE_DIR = os.getenv("PAGE_ARCHIVE_DIR", "")
+# record: 取得したページを保存する / replay: ネットワークに出ずアーカイブから返す
+PAGE_ARCHIVE_MODE = os.getenv("PAGE_ARCHIVE_MODE", "record")
+# replay時に返す時点 (ISO8601)。未設定なら最新の取得結果を返す
+PAGE_ARCHIVE_REPLAY_AT = os.getenv("PAGE_ARCHIVE_REPLAY_AT", "")
+PAGE_ARCHIVE_SEGMENT_SIZE = int(os.getenv("PAGE_ARCHIVE_SEGMENT_SIZE", str(256 * 1024 * 1024)))
+PAGE_ARCHIVE_LEVEL = int(os.getenv("PAGE_ARCHIVE_LEVEL", "3"))
+
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+
+BLOB_RECORD = struct.Struct('<32sIQIB')   # digest, segment, offset, length, codec
+# 'S'型は末尾のNULを落とすので、URLのハッシュは整数・本文のハッシュはバイト列で持つ
+FETCH_DTYPE = np.dtype([('url', '<u8'), ('fetched_at', '<f8'), ('digest', 'u1', (32,))])
+
+def url_key(url: str) -> int:
+    return int.from_bytes(hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest(), 'little')
+
+class PageArchive:
+    def __init__(self, directory: str, segment_size: int = PAGE_ARCHIVE_SEGMENT_SIZE, level: int = PAGE_ARCHIVE_LEVEL):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.codec = CODEC_ZSTD if zstandard else CODEC_ZLIB
+        self.level = level
+        self._lock = threading.Lock()
+        self._compressor = zstandard.ZstdCompressor(level=level) if zstandard else None
+        self._decompressor = zstandard.ZstdDecompressor() if zstandard else None
+
+        self._blob_path = os.path.join(directory, 'blobs.idx')
+        self._fetch_path = os.path.join(directory, 'fetches.idx')
+        self._url_path = os.path.join(directory, 'urls.txt')
+        # 書き込み途中で落ちた場合の半端なレコードを切り捨てる
+        self._truncate_partial(self._blob_path, BLOB_RECORD.size)
+        self._truncate_partial(self._fetch_path, FETCH_DTYPE.itemsize)
+
+        self.blobs = {}
+        with open(self._blob_path, 'rb') as f:
+            data = f.read()
+        for (digest, *location) in BLOB_RECORD.iter_unpack(data):
+            self.blobs[digest] = tuple(location)
+        self.urls = {}
+        if os.path.exists(self._url_path):
+            with open(self._url_path, encoding='utf-8') as f:
+                for line in f:
+                    url = line.rstrip('\n')
+                    if url:
+                        self.urls[url_key(url)] = url
+
+        self.segment = max((loc[0] for loc in self.blobs.values()), default=0)
+        self._segment_file = open(self._segment_path(self.segment), 'ab')
+        self._blob_file = open(self._blob_path, 'ab')
+        self._fetch_file = open(self._fetch_path, 'ab')
+        self._url_file = open(self._url_path, 'a', encoding='utf-8')
+
+        self._fetch_map = None
+        self._fetch_records = np.empty(0, dtype=FETCH_DTYPE)
+        # (索引, (URLのハッシュ, 取得時刻) 順の並び, 並べた順のURLのハッシュ)
+        self._fetch_order = (self._fetch_records, np.empty(0, dtype=np.intp), np.empty(0, dtype='<u8'))
+        self.puts = 0
+        self.deduplicated = 0
+        self.bytes_in = 0
+        self.bytes_stored = 0
+
+    @staticmethod
+    def _truncate_partial(path: str, record_size: int):
+        if not os.path.exists(path):
+            open(path, 'wb').close()
+            return
+        size = os.path.getsize(path)
+        if size % record_size:
+            with open(path, 'r+b') as f:
+                f.truncate(size - size % record_size)
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"segment-{segment:05d}.dat")
+
+    def _compress(self, content: bytes) -> bytes:
+        if self.codec == CODEC_ZSTD:
+            return self._compressor.compress(content)
+        return zlib.compress(content, min(self.level, 9))
+
+    def _decompress(self, data: bytes, codec: int) -> bytes:
+        if codec == CODEC_ZSTD:
+            if not zstandard:
+                raise RuntimeError("zstandard is required to read this archive")
+            return self._decompressor.decompress(data)
+        return zlib.decompress(data)
+
+    def put(self, url: str, content: bytes, fetched_at: float = None) -> bytes:
+        """ページを保存して本文のハッシュを返す (同じ内容の本文は1回だけ書き込む)"""
+        digest = hashlib.sha256(content).digest()
+        key = url_key(url)
+        record = np.zeros(1, dtype=FETCH_DTYPE)
+        record['url'] = key
+        record['fetched_at'] = fetched_at if fetched_at is not None else time.time()
+        record['digest'] = np.frombuffer(digest, dtype=np.uint8)
+        with self._lock:
+            self.puts += 1
+            self.bytes_in += len(content)
+            if digest in self.blobs:
+                self.deduplicated += 1
+            else:
+                compressed = self._compress(content)
+                offset = self._segment_file.tell()
+                if offset and offset + len(compressed) > self.segment_size:
+                    self._segment_file.close()
+                    self.segment += 1
+                    self._segment_file = open(self._segment_path(self.segment), 'ab')
+                    offset = self._segment_file.tell()
+                self._segment_file.write(compressed)
+                self._segment_file.flush()
+                location = (self.segment, offset, len(compressed), self.codec)
+                self._blob_file.write(BLOB_RECORD.pack(digest, *location))
+                self._blob_file.flush()
+                self.blobs[digest] = location
+                self.bytes_stored += len(compressed)
+            if key not in self.urls:
+                self.urls[key] = url
+                self._url_file.write(url + "\n")
+                self._url_file.flush()
+            # 本文を書いてから索引に載せる
+            self._fetch_file.write(record.tobytes())
+            self._fetch_file.flush()
+        return digest
+
+    def read_blob(self, digest: bytes) -> bytes:
+        location = self.blobs.get(digest)
+        if not location:
+            return None
+        segment, offset, length, codec = location
+        with open(self._segment_path(segment), 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        return self._decompress(data, codec)
+
+    def _records(self) -> np.ndarray:
+        """取得の索引をmmapした配列 (追記されていれば作り直す)"""
+        with self._lock:
+            size = os.path.getsize(self._fetch_path)
+            if size != self._fetch_records.nbytes:
+                # 古いmmapは参照が無くなった時点で閉じられる (読み出し中の配列があってもよい)
+                self._fetch_map = None
+                if size:
+                    with open(self._fetch_path, 'rb') as f:
+                        self._fetch_map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+                    self._fetch_records = np.frombuffer(self._fetch_map, dtype=FETCH_DTYPE)
+                else:
+                    self._fetch_records = np.empty(0, dtype=FETCH_DTYPE)
+            return self._fetch_records
+
+    def _sorted_records(self):
+        """索引と (URLのハッシュ, 取得時刻) 順の並び (追記されたときだけ並べ直す)"""
+        records = self._records()
+        ordered = self._fetch_order
+        if ordered[0] is not records:
+            order = np.lexsort((records['fetched_at'], records['url']))
+            ordered = (records, order, records['url'][order])
+            self._fetch_order = ordered
+        return ordered
+
+    def fetches(self, url: str) -> np.ndarray:
+        """URLの取得記録 (取得時刻順)"""
+        records, order, urls = self._sorted_records()
+        key = np.uint64(url_key(url))
+        start, end = np.searchsorted(urls, key, side='left'), np.searchsorted(urls, key, side='right')
+        return records[order[start:end]]
+
+    def get(self, url: str, at: float = None) -> bytes:
+        """指定時刻 (省略時は最新) 以前で最後に取得したページの本文"""
+        matched = self.fetches(url)
+        if at is not None:
+            matched = matched[:np.searchsorted(matched['fetched_at'], at, side='right')]
+        if not len(matched):
+            return None
+        return self.read_blob(matched[-1]['digest'].tobytes())
+
+    def iter_pages(self, since: float = None, until: float = None):
+        """(url, 取得時刻, 本文) を取得時刻順に返す"""
+        records = self._records()
+        order = np.argsort(records['fetched_at'], kind='stable')
+        for record in records[order]:
+            fetched_at = float(record['fetched_at'])
+            if (since is not None and fetched_at < since) or (until is not None and fetched_at > until):
+                continue
+            yield self.urls.get(int(record['url'])), fetched_at, self.read_blob(record['digest'].tobytes())
+
+    def stats(self) -> dict:
+        return {
+            "directory": self.directory,
+            "codec": "zstd" if self.codec == CODEC_ZSTD else "zlib",
+            "fetches": len(self._records()),
+            "blobs": len(self.blobs),
+            "urls": len(self.urls),
+            "segments": self.segment + 1,
+            "puts": self.puts,
+            "deduplicated": self.deduplicated,
+            "bytes_in": self.bytes_in,
+            "bytes_stored": self.bytes_stored,
+        }
+
+    def close(self):
+        with self._lock:
+            for f in (self._segment_file, self._blob_file, self._fetch_file, self._url_file):
+                f.close()
+            self._fetch_records = np.empty(0, dtype=FETCH_DTYPE)
+            self._fetch_map = None
+
+_archive = None
+_replay_at = datetime.fromisoformat(PAGE_ARCHIVE_REPLAY_AT).timestamp() if PAGE_ARCHIVE_REPLAY_AT else None
+_replay = PAGE_ARCHIVE_MODE == "replay"
+
+def get_archive() -> PageArchive:
+    """PAGE_ARCHIVE_DIRが設定されていればアーカイブを返す (未設定ならNone)"""
+    global _archive
+    if _archive is None and PAGE_ARCHIVE_DIR:
+        _archive = PageArchive(PAGE_ARCHIVE_DIR)
+    return _archive
+
+def is_replay() -> bool:
+    return _replay and get_archive() is not None
+
+def replay_time() -> float:
+    return _replay_at
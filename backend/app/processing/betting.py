@@ -0,0 +1,128 @@
+import os
+import numpy as np
+from app.processing import trifecta
+
+# 舟券は100円単位
+BET_UNIT = 100
+
+# 期待値の閾値 (%)。100円賭けて110円戻る期待値以上なら買う
+EV_THRESHOLD = float(os.getenv("EV_THRESHOLD", "110.0"))
+# 使用する買い方 ('threshold' / 'topk' / 'kelly')
+BET_STRATEGY = os.getenv("BET_STRATEGY", "threshold")
+# topk: 1レースで買う最大点数
+BET_TOP_K = int(os.getenv("BET_TOP_K", "5"))
+# kelly: ケリー比率に掛ける割合と1レースの予算 (円)
+KELLY_FRACTION = float(os.getenv("KELLY_FRACTION", "0.25"))
+KELLY_BUDGET = float(os.getenv("KELLY_BUDGET", "10000"))
+
+def expected_values(odds: np.ndarray, probabilities: np.ndarray) -> np.ndarray:
+    """
+    回収率期待値 (%) = 100円賭けた場合の期待払い戻し額
+    (レース数 × 120) でも (120,) でも計算できる。オッズが無い組み合わせはNaN
+    """
+    return probabilities * odds * 100
+
+def _floor_to_unit(amounts: np.ndarray) -> np.ndarray:
+    return np.floor(amounts / BET_UNIT) * BET_UNIT
+
+class ThresholdStrategy:
+    """期待値が閾値以上の組み合わせを全て固定額で買う"""
+    name = 'threshold'
+
+    def __init__(self, threshold: float = EV_THRESHOLD, amount: int = BET_UNIT):
+        self.threshold = threshold
+        self.amount = amount
+
+    def stakes(self, odds: np.ndarray, probabilities: np.ndarray) -> np.ndarray:
+        ev = expected_values(odds, probabilities)
+        return np.where(ev >= self.threshold, float(self.amount), 0.0)
+
+class TopKStrategy:
+    """期待値の高い順にk点まで (期待値が閾値以上のもののみ) 固定額で買う"""
+    name = 'topk'
+
+    def __init__(self, k: int = BET_TOP_K, threshold: float = EV_THRESHOLD, amount: int = BET_UNIT):
+        self.k = k
+        self.threshold = threshold
+        self.amount = amount
+
+    def stakes(self, odds: np.ndarray, probabilities: np.ndarray) -> np.ndarray:
+        ev = np.atleast_2d(expected_values(odds, probabilities))
+        ranked = np.where(np.isnan(ev), -np.inf, ev)
+        k = min(self.k, ranked.shape[1])
+        # 各レースで期待値上位k点のインデックス
+        top = np.argpartition(-ranked, k - 1, axis=1)[:, :k]
+        selected = np.zeros(ranked.shape, dtype=bool)
+        np.put_along_axis(selected, top, True, axis=1)
+        selected &= ranked >= self.threshold
+        result = np.where(selected, float(self.amount), 0.0)
+        return result if np.ndim(odds) > 1 else result[0]
+
+class KellyStrategy:
+    """
+    フラクショナル・ケリー
+    各組み合わせのケリー比率 f = (p * o - 1) / (o - 1) に fraction を掛けて1レースの予算に配分する。
+    合計が予算を超える場合は比例縮小し、100円単位に切り捨てる
+    (組み合わせ同士が排反であることは考慮しない簡易版)
+    """
+    name = 'kelly'
+
+    def __init__(self, fraction: float = KELLY_FRACTION, budget: float = KELLY_BUDGET, threshold: float = 100.0):
+        self.fraction = fraction
+        self.budget = budget
+        self.threshold = threshold
+
+    def stakes(self, odds: np.ndarray, probabilities: np.ndarray) -> np.ndarray:
+        odds2 = np.atleast_2d(odds)
+        probs2 = np.atleast_2d(probabilities)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            kelly = (probs2 * odds2 - 1.0) / (odds2 - 1.0)
+        ev = expected_values(odds2, probs2)
+        kelly = np.where((odds2 > 1.0) & (ev >= self.threshold) & (kelly > 0), kelly, 0.0)
+
+        raw = kelly * self.fraction * self.budget
+        total = raw.sum(axis=1, keepdims=True)
+        scale = np.where(total > self.budget, self.budget / np.where(total > 0, total, 1.0), 1.0)
+        result = _floor_to_unit(raw * scale)
+        return result if np.ndim(odds) > 1 else result[0]
+
+STRATEGIES = {
+    ThresholdStrategy.name: ThresholdStrategy,
+    TopKStrategy.name: TopKStrategy,
+    KellyStrategy.name: KellyStrategy,
+}
+
+def get_strategy(name: str = None, **params):
+    """
+    名前とパラメータから買い方を作る
+    どちらも省略した場合は環境変数の設定で起動時に作ったものを返す
+    """
+    if name is None and not params:
+        return default_strategy
+    name = name or BET_STRATEGY
+    if name not in STRATEGIES:
+        raise ValueError(f"Unknown bet strategy: {name}")
+    return STRATEGIES[name](**params)
+
+default_strategy = get_strategy(BET_STRATEGY)
+
+def select_bets(odds: np.ndarray, probabilities: np.ndarray, strategy=None) -> np.ndarray:
+    """
+    オッズと確率 ((レース数 × 120) または (120,)) から各組み合わせの賭け金を一括で決める
+    1日分のレースをまとめて渡せばシミュレーションも1回の呼び出しで済む
+    """
+    strategy = strategy or get_strategy()
+    return strategy.stakes(odds, probabilities)
+
+def bets_from_stakes(odds: np.ndarray, ev: np.ndarray, stakes: np.ndarray) -> list:
+    """1レース分の賭け金の配列をFirestoreに保存するベットのリストにする"""
+    return [
+        {
+            'combination': trifecta.COMBINATIONS[idx],
+            'odds': float(odds[idx]),
+            'amount': int(stakes[idx]),
+            'expected_value': float(ev[idx]),
+            'status': 'pending'
+        }
+        for idx in np.flatnonzero(stakes > 0)
+    ]
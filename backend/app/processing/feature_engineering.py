@@ -1,74 +1,138 @@
-import pandas as pd
 import numpy as np
 
-def engineer_boat_features(data_dict: dict) -> dict:
+BOATS = range(1, 7)
+
+# 特徴量の元になるカラム (r{b}_{name})
+# 勝率・モーター（数値が大きい方が偉い）
+RATE_FEATURES = ['global_win_rate', 'motor_3ren']
+# 展示タイム・ST（数値が小さい方が偉い）
+TIME_FEATURES = ['exhibition_time', 'exhibition_st']
+FEATURES = RATE_FEATURES + TIME_FEATURES
+ST_FEATURE = 'exhibition_st'
+
+def to_float(value):
+    if value is None:
+        return np.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+def build_feature_array(records: list):
     """
-    辞書形式のレースデータに特徴量を追加して返す
+    レースデータのリストを (レース数 × 6艇 × 特徴量) の配列にする
+    戻り値: (values, present)
+      values: 欠損はNaN
+      present: (レース数 × 特徴量) 6艇分のカラムが全て存在するか
     """
-    # DataFrameに変換して処理（pandasの便利な機能を使うため）
-    df = pd.DataFrame([data_dict])
-    
-    boats = range(1, 7)
-
-    # 各データのカラム名パターン定義
-    col_win_rate = [f'r{b}_global_win_rate' for b in boats]   # 勝率
-    col_motor    = [f'r{b}_motor_3ren' for b in boats] # モーター3連対率
-    col_tenji    = [f'r{b}_exhibition_time' for b in boats]      # 展示タイム
-    col_st       = [f'r{b}_exhibition_st' for b in boats]         # スタート展示
-
-    # -------------------------------------------------
-    # 2. 偏差値・相対評価 (Z-Score & Relative)
-    # -------------------------------------------------
-    target_groups = {
-        'win_rate': col_win_rate,
-        'motor': col_motor
-    }
+    n = len(records)
+    values = np.full((n, 6, len(FEATURES)), np.nan)
+    present = np.zeros((n, len(FEATURES)), dtype=bool)
+    for r, record in enumerate(records):
+        for f, name in enumerate(FEATURES):
+            keys = [f'r{b}_{name}' for b in BOATS]
+            present[r, f] = all(k in record for k in keys)
+            for b, key in enumerate(keys):
+                values[r, b, f] = to_float(record.get(key))
+    return values, present
+
+def compute_features(values: np.ndarray) -> dict:
+    """
+    (レース数 × 6艇 × 特徴量) の配列から全レース分の特徴量を一度に計算する
+    戻り値は名前 -> (レース数 × 6艇 × 特徴量) の配列の辞書
+    """
+    valid = ~np.isnan(values)
+    count = valid.sum(axis=1)  # (レース数 × 特徴量)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # 行ごとの平均と標準偏差 (pandasと同じく欠損を除外し、標準偏差は不偏)
+        mean = np.where(count > 0, np.nansum(values, axis=1) / count, np.nan)
+        sq = np.nansum((values - mean[:, None, :]) ** 2, axis=1)
+        std = np.where(count > 1, np.sqrt(sq / (count - 1)), np.nan)
+        std = np.where(std == 0, 1.0, std)
+
+        z = (values - mean[:, None, :]) / std[:, None, :]
+        diff_1 = values - values[:, :1, :]
+        gap_avg = values - mean[:, None, :]
 
-    for name, cols in target_groups.items():
-        # 存在チェック (DataFrameなのでカラムがあるか)
-        if not all(c in df.columns for c in cols):
-            continue
-
-        # 行ごとの平均と標準偏差を計算
-        row_mean = df[cols].mean(axis=1)
-        row_std = df[cols].std(axis=1).replace(0, 1)
-
-        for col in cols:
-            df[f'{col}_z'] = (df[col] - row_mean) / row_std
-            if col != cols[0]: # 1号艇以外の場合
-                df[f'{col}_diff_1'] = df[col] - df[cols[0]]
-
-    # -------------------------------------------------
-    # 3. ランク付け (Ranking)
-    # -------------------------------------------------
-    # 勝率・モーター（数値が大きい方が偉い -> ascending=False）
-    for name, cols in target_groups.items():
-        if not all(c in df.columns for c in cols): continue
-        ranks = df[cols].rank(axis=1, ascending=False, method='min')
-        for i, col in enumerate(cols):
-            df[f'{col}_rank'] = ranks[cols[i]]
-
-    # 展示タイム・ST（数値が小さい方が偉い -> ascending=True）
-    time_groups = {
-        'tenji': col_tenji,
-        'st': col_st
+    # ランク付け (method='min'、欠損はNaNのまま)
+    # 自分より上位の艇の数 + 1
+    a = values[:, :, None, :]  # 自艇
+    b = values[:, None, :, :]  # 比較対象
+    higher = (b > a).sum(axis=2)
+    lower = (b < a).sum(axis=2)
+    is_rate = np.array([name in RATE_FEATURES for name in FEATURES])
+    rank = np.where(is_rate, higher, lower) + 1.0
+    rank = np.where(valid, rank, np.nan)
+    is_top = (rank == 1).astype(int)
+
+    return {
+        'z': z,
+        'diff_1': diff_1,
+        'rank': rank,
+        'is_top': is_top,
+        'gap_avg': gap_avg,
     }
 
-    for name, cols in time_groups.items():
-        if not all(c in df.columns for c in cols): continue
-        ranks = df[cols].rank(axis=1, ascending=True, method='min')
-        for i, col in enumerate(cols):
-            df[f'{col}_rank'] = ranks[cols[i]]
-            df[f'{col}_is_top'] = (ranks[cols[i]] == 1).astype(int)
-
-    # -------------------------------------------------
-    # 4. スタート展示の深掘り (ST Gap)
-    # -------------------------------------------------
-    if all(c in df.columns for c in col_st):
-        row_st_mean = df[col_st].mean(axis=1)
-        for col in col_st:
-            df[f'{col}_gap_avg'] = df[col] - row_st_mean
-
-    # 辞書に戻して返す (NaNはNoneに変換)
-    result = df.iloc[0].replace({np.nan: None}).to_dict()
-    return result
+def _clean(value):
+    return None if value != value else value  # NaN -> None
+
+def engineer_boat_features_batch(records: list) -> list:
+    """
+    複数レースのデータにまとめて特徴量を追加して返す (入力順)
+    """
+    if not records:
+        return []
+    values, present = build_feature_array(records)
+    computed = compute_features(values)
+    # Python型に変換 (numpyのスカラーを辞書に入れない)
+    z, diff_1, rank, is_top, gap_avg = (computed[k].tolist() for k in ('z', 'diff_1', 'rank', 'is_top', 'gap_avg'))
+
+    results = []
+    for r, record in enumerate(records):
+        out = dict(record)
+
+        # 2. 偏差値・相対評価 (Z-Score & Relative)
+        for name in RATE_FEATURES:
+            f = FEATURES.index(name)
+            if not present[r, f]: continue
+            for b in BOATS:
+                col = f'r{b}_{name}'
+                out[f'{col}_z'] = _clean(z[r][b - 1][f])
+                if b != 1: # 1号艇以外の場合
+                    out[f'{col}_diff_1'] = _clean(diff_1[r][b - 1][f])
+
+        # 3. ランク付け (Ranking)
+        for name in RATE_FEATURES:
+            f = FEATURES.index(name)
+            if not present[r, f]: continue
+            for b in BOATS:
+                out[f'r{b}_{name}_rank'] = _clean(rank[r][b - 1][f])
+
+        for name in TIME_FEATURES:
+            f = FEATURES.index(name)
+            if not present[r, f]: continue
+            for b in BOATS:
+                col = f'r{b}_{name}'
+                out[f'{col}_rank'] = _clean(rank[r][b - 1][f])
+                out[f'{col}_is_top'] = is_top[r][b - 1][f]
+
+        # 4. スタート展示の深掘り (ST Gap)
+        f = FEATURES.index(ST_FEATURE)
+        if present[r, f]:
+            for b in BOATS:
+                out[f'r{b}_{ST_FEATURE}_gap_avg'] = _clean(gap_avg[r][b - 1][f])
+
+        # 元の値もNaNはNoneにそろえる
+        for key, value in out.items():
+            if isinstance(value, float) and value != value:
+                out[key] = None
+        results.append(out)
+
+    return results
+
+def engineer_boat_features(data_dict: dict) -> dict:
+    """
+    辞書形式のレースデータに特徴量を追加して返す
+    """
+    return engineer_boat_features_batch([data_dict])[0]
@@ -0,0 +1,83 @@
+import numpy as np
+
+# 3連単の全120通りを固定順 (組番の昇順) で並べたインデックス
+COMBINATIONS = [
+    f"{i}-{j}-{k}"
+    for i in range(1, 7) for j in range(1, 7) for k in range(1, 7)
+    if i != j and i != k and j != k
+]
+N_COMBINATIONS = len(COMBINATIONS)  # 120
+COMBINATION_INDEX = {c: idx for idx, c in enumerate(COMBINATIONS)}
+
+# 艇番 (1-6) -> インデックスの表。存在しない組み合わせは-1
+INDEX_TABLE = np.full((7, 7, 7), -1, dtype=np.int16)
+FIRST = np.zeros(N_COMBINATIONS, dtype=np.int8)
+SECOND = np.zeros(N_COMBINATIONS, dtype=np.int8)
+THIRD = np.zeros(N_COMBINATIONS, dtype=np.int8)
+for _idx, _combo in enumerate(COMBINATIONS):
+    _i, _j, _k = (int(x) for x in _combo.split('-'))
+    INDEX_TABLE[_i, _j, _k] = _idx
+    FIRST[_idx], SECOND[_idx], THIRD[_idx] = _i, _j, _k
+
+# Firestoreに保存する予測スナップショットの形式名
+RECORD_FORMAT = 'trifecta120'
+
+def combination_index(first: int, second: int, third: int) -> int:
+    """艇番からインデックスを返す (不正な組み合わせは-1)"""
+    if not (1 <= first <= 6 and 1 <= second <= 6 and 1 <= third <= 6):
+        return -1
+    return int(INDEX_TABLE[first, second, third])
+
+def empty_vector(fill: float = np.nan) -> np.ndarray:
+    return np.full(N_COMBINATIONS, fill, dtype=np.float64)
+
+def odds_from_list(odds_list: list) -> np.ndarray:
+    """[{'combination': '1-2-3', 'odds': 12.3}, ...] -> 120要素の配列 (欠損はNaN)"""
+    vec = empty_vector()
+    for item in odds_list:
+        idx = COMBINATION_INDEX.get(item['combination'])
+        if idx is not None:
+            vec[idx] = item['odds']
+    return vec
+
+def probability_matrix(frame) -> np.ndarray:
+    """
+    predict_proba (DataFrame: 行=レース, 列=クラスラベル) を (レース数 × 120) の配列に並べ替える
+    """
+    matrix = np.zeros((len(frame), N_COMBINATIONS), dtype=np.float64)
+    for col in frame.columns:
+        idx = COMBINATION_INDEX.get(str(col))
+        if idx is not None:
+            matrix[:, idx] = frame[col].to_numpy(dtype=np.float64)
+    return matrix
+
+def _to_json_list(vec: np.ndarray) -> list:
+    # FirestoreにNaNを入れないようにNoneにする
+    return [None if v != v else v for v in vec.tolist()]
+
+def to_record(odds: np.ndarray, probabilities: np.ndarray, expected_values: np.ndarray) -> dict:
+    """予測スナップショットをFirestore保存用のコンパクトな形にする"""
+    return {
+        'format': RECORD_FORMAT,
+        'odds': _to_json_list(odds),
+        'probability': _to_json_list(probabilities),
+        'expected_value': _to_json_list(expected_values),
+    }
+
+def from_record(record) -> list:
+    """
+    保存された予測スナップショットを組み合わせごとの辞書のリストに展開する
+    (以前のリスト形式で保存されたものはそのまま返す)
+    """
+    if not isinstance(record, dict) or record.get('format') != RECORD_FORMAT:
+        return record
+    return [
+        {
+            'combination': combo,
+            'probability': prob,
+            'odds': odd,
+            'expected_value': ev,
+        }
+        for combo, odd, prob, ev in zip(COMBINATIONS, record['odds'], record['probability'], record['expected_value'])
+        if odd is not None
+    ]
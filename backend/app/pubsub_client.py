@@ -1,24 +1,124 @@
 import os
 import json
-from google.cloud import pubsub_v1
+import asyncio
+import threading
+import itertools
+import time
+from concurrent.futures import Future
+from app.lazy import LazyModule, record_load_time
 
 PROJECT_ID = os.getenv("PROJECT_ID", "dummy-project")
 TOPIC_ID = "alchemy-events"
+# PublisherClient.topic_path と同じ形式
+topic_path = f"projects/{PROJECT_ID}/topics/{TOPIC_ID}"
 
-publisher = pubsub_v1.PublisherClient()
-topic_path = publisher.topic_path(PROJECT_ID, TOPIC_ID)
+# google.cloud.pubsub_v1 のimportとクライアントの作成は初めて発行するときまで遅らせる
+pubsub_v1 = LazyModule('google.cloud.pubsub_v1')
+
+# バッチ送信設定 (クライアントライブラリ側のバッチング)
+PUBSUB_BATCH_MAX_MESSAGES = int(os.getenv("PUBSUB_BATCH_MAX_MESSAGES", "100"))
+PUBSUB_BATCH_MAX_LATENCY = float(os.getenv("PUBSUB_BATCH_MAX_LATENCY", "0.01"))  # 秒
+PUBSUB_BATCH_MAX_BYTES = int(os.getenv("PUBSUB_BATCH_MAX_BYTES", str(1024 * 1024)))
+# publish_messagesで一度に結果を待つメッセージ数
+PUBSUB_BATCH_SIZE = int(os.getenv("PUBSUB_BATCH_SIZE", "50"))
+# モック使用時の擬似レイテンシ (秒)
+PUBSUB_MOCK_LATENCY = float(os.getenv("PUBSUB_MOCK_LATENCY", "0"))
+
+class MockPublisher:
+    """
+    GCPなしで動くPublisherClientの代替
+    publish()は即座にFutureを返し、擬似レイテンシ後に別スレッドで完了させる
+    """
+    def __init__(self, latency: float = 0.0, verbose: bool = True):
+        self.latency = latency
+        self.verbose = verbose
+        self.published = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def topic_path(self, project, topic):
+        return f"projects/{project}/topics/{topic}"
+
+    def publish(self, topic, data: bytes) -> Future:
+        future = Future()
+        with self._lock:
+            message_id = str(next(self._ids))
+            self.published.append(data)
+        if self.verbose:
+            print(f"[Mock Pub/Sub] Publishing: {data.decode('utf-8')}")
+        if self.latency > 0:
+            threading.Timer(self.latency, future.set_result, args=(message_id,)).start()
+        else:
+            future.set_result(message_id)
+        return future
+
+# 差し替える場合 (負荷試験等) はこの変数に代入する
+publisher = None
+_publisher_lock = threading.Lock()
+
+def get_publisher():
+    global publisher
+    if publisher is None:
+        with _publisher_lock:
+            if publisher is None:
+                if PROJECT_ID == "dummy-project":
+                    publisher = MockPublisher(latency=PUBSUB_MOCK_LATENCY)
+                else:
+                    start = time.perf_counter()
+                    publisher = pubsub_v1.PublisherClient(
+                        batch_settings=pubsub_v1.types.BatchSettings(
+                            max_messages=PUBSUB_BATCH_MAX_MESSAGES,
+                            max_latency=PUBSUB_BATCH_MAX_LATENCY,
+                            max_bytes=PUBSUB_BATCH_MAX_BYTES,
+                        )
+                    )
+                    record_load_time('pubsub_v1.PublisherClient', time.perf_counter() - start)
+    return publisher
+
+def encode_message(data: dict) -> bytes:
+    return json.dumps(data).encode("utf-8")
 
 def publish_message(data: dict):
-    """Pub/Subにメッセージを送信する"""
-    if PROJECT_ID == "dummy-project":
-        print(f"[Mock Pub/Sub] Publishing: {data}")
-        return
-
-    data_str = json.dumps(data)
-    data_bytes = data_str.encode("utf-8")
-    
+    """Pub/Subにメッセージを送信する (同期。送信完了まで待つ)"""
     try:
-        future = publisher.publish(topic_path, data_bytes)
+        future = get_publisher().publish(topic_path, encode_message(data))
         print(f"Published message ID: {future.result()}")
     except Exception as e:
         print(f"Error publishing message: {e}")
+
+async def publish_messages(messages: list, batch_size: int = None, client=None) -> dict:
+    """
+    複数メッセージを非同期に送信する
+    batch_size件ずつpublishして各バッチのFutureをまとめて待つので、イベントループを止めない
+    戻り値: {'published': 成功件数, 'failed': [{'batch': バッチ番号, 'message': ..., 'error': ...}]}
+    """
+    client = client or get_publisher()
+    batch_size = batch_size or PUBSUB_BATCH_SIZE
+    published = 0
+    failed = []
+
+    for batch_idx, start in enumerate(range(0, len(messages), batch_size)):
+        batch = messages[start:start + batch_size]
+        futures = []
+        for data in batch:
+            try:
+                futures.append(asyncio.wrap_future(client.publish(topic_path, encode_message(data))))
+            except Exception as e:
+                futures.append(None)
+                failed.append({'batch': batch_idx, 'message': data, 'error': str(e)})
+
+        pending = [(data, f) for data, f in zip(batch, futures) if f is not None]
+        results = await asyncio.gather(*[f for _, f in pending], return_exceptions=True)
+
+        batch_failed = 0
+        for (data, _), res in zip(pending, results):
+            if isinstance(res, Exception):
+                batch_failed += 1
+                failed.append({'batch': batch_idx, 'message': data, 'error': str(res)})
+            else:
+                published += 1
+        batch_failed += len(batch) - len(pending)
+        if batch_failed:
+            print(f"Pub/Sub batch {batch_idx}: {batch_failed}/{len(batch)} messages failed")
+
+    return {'published': published, 'failed': failed}
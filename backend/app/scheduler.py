@@ -1,106 +1,275 @@
-import aiohttp
 import asyncio
-from bs4 import BeautifulSoup
+import heapq
+import itertools
+import os
+import time
+import uuid
 from datetime import datetime, timedelta
 import re
-from app.pubsub_client import publish_message
+from app import clock, firestore_client, http_client, metrics
+from app.scraping.html_parser import make_soup
+from app.pubsub_client import publish_messages
 
-HEADERS = {
-    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+INDEX_URL = "https://www.boatrace.jp/owpc/pc/race/index"
+
+# 各ステージを発行するタイミング (締切の何秒前か。負の値は締切後)
+STAGE_OFFSETS = {
+    'scrape_info': 360,     # 6分前
+    'predict_5min': 300,    # 5分前
+    'predict_1min': 60,     # 1分前
+    'check_result': -1200,  # 結果確認 (レース後20分程度)
 }
 
-async def fetch_html(session, url):
-    try:
-        async with session.get(url, headers=HEADERS, timeout=10) as response:
-            if response.status == 200:
-                return await response.read()
-    except Exception as e:
-        print(f"Error fetching {url}: {e}")
-    return None
+# 締切時刻の変更 (遅延など) を拾うためにレース一覧を再取得する間隔 (秒)
+TIMETABLE_REFRESH_INTERVAL = float(os.getenv("TIMETABLE_REFRESH_INTERVAL", "300"))
+# 発行予定時刻を過ぎたイベントをこの秒数までは遅れて発行する
+DISPATCH_MAX_LATENESS = float(os.getenv("DISPATCH_MAX_LATENESS", "600"))
+# 発行ループはどのインスタンスでも起動するが、イベントを発行するのはリースを持つ1台だけ (重複発行を防ぐ)
+# リースの有効期限 (実秒)。担当のインスタンスが落ちると、これを過ぎてから他のインスタンスが引き継ぐ
+DISPATCHER_LEASE_TTL = float(os.getenv("DISPATCHER_LEASE_TTL", "30"))
+DISPATCHER_LEASE = 'dispatcher'
+INSTANCE_ID = f"{os.getenv('K_REVISION', 'local')}-{uuid.uuid4().hex[:8]}"
 
-async def check_and_dispatch():
+def parse_race_index(soup, day: datetime) -> list:
     """
-    当日の全レースを確認し、タイミングに応じてイベントを発行する
+    レース一覧ページから当日の締切時刻表を作る
+    [(締切時刻, place_id, race_number), ...] を締切順で返す
     """
-    url = "https://www.boatrace.jp/owpc/pc/race/index"
-    
-    async with aiohttp.ClientSession() as session:
-        html = await fetch_html(session, url)
+    races = []
+
+    # テーブルからレース情報を抽出
+    # div.table1 -> table -> tbody -> tr (各場)
+    table_div = soup.select_one("div.table1")
+    if not table_div: return races
+
+    for tbody in table_div.select("table tbody"):
+        # 各場
+        first_tr = tbody.select_one("tr")
+        if not first_tr: continue
+
+        # 場ID取得
+        img = first_tr.select_one("td a img")
+        if not img or not img.get('src'): continue
+
+        match = re.search(r'(\d{1,2})\.png', img['src'])
+        if not match: continue
+        place_id = int(match.group(1))
+
+        # レース一覧 (2行目以降のtd)
+        # trs[1] にレース番号と時間が並んでいる
+        trs = tbody.select("tr")
+        if len(trs) < 2: continue
+
+        for race_td in trs[1].select("td"):
+            # レース番号と時間を取得
+            # 例: 1R 10:30
+            text = race_td.text.strip()
+            match = re.search(r'(\d{1,2})R\s*(\d{1,2}:\d{2})', text)
+            if not match: continue
+
+            race_number = int(match.group(1))
+            time_str = match.group(2)
+
+            # 締切時間
+            deadline = datetime.strptime(f"{day.strftime('%Y/%m/%d')} {time_str}", "%Y/%m/%d %H:%M")
+            races.append((deadline, place_id, race_number))
+
+    races.sort()
+    return races
+
+def is_in_time(event_type: str, deadline: datetime, fire_at: datetime, now: datetime) -> bool:
+    """遅れて発行しても意味があるか (締切前のステージは締切を過ぎたら発行しない)"""
+    if (now - fire_at).total_seconds() > DISPATCH_MAX_LATENESS:
+        return False
+    if event_type != 'check_result' and now >= deadline:
+        return False
+    return True
+
+class Dispatcher:
+    """
+    当日の締切時刻表を保持し、各ステージのイベントを発行時刻ちょうどに送るスケジューラ
+    発行予定はヒープで管理し、先頭のイベントの時刻までsleepする
+    """
+    def __init__(self):
+        self.day = None
+        self.timetable = []        # [(締切時刻, place_id, race_number)] 締切順
+        self.refreshed_at = None
+        self.heap = []             # [(発行時刻, seq, event_type, place_id, race_number, 締切時刻)]
+        self.fired = set()         # 発行済みの (event_type, place_id, race_number, 締切時刻)
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._tasks = []
+        self.lease_until = 0.0     # リースが有効な期限 (time.monotonic)
+
+    async def refresh_timetable(self, force: bool = False) -> bool:
+        """
+        レース一覧を取得し、締切時刻表が変わっていれば発行予定を組み直す
+        時刻表が変わった場合Trueを返す
+        """
+        now = clock.now()
+        day = now.strftime('%Y%m%d')
+        if (not force and self.day == day and self.refreshed_at
+                and (now - self.refreshed_at).total_seconds() < TIMETABLE_REFRESH_INTERVAL):
+            return False
+
+        html = await http_client.fetch_html(INDEX_URL)
         if not html:
+            return False
+        self.refreshed_at = now
+
+        with metrics.span('parse_index'):
+            timetable = parse_race_index(make_soup(html), now)
+        if day == self.day and timetable == self.timetable:
+            return False
+
+        if day != self.day:
+            self.fired.clear()
+        self.day = day
+        self.timetable = timetable
+        self._reschedule(now)
+        print(f"Timetable updated: {len(timetable)} races")
+        return True
+
+    def _reschedule(self, now: datetime):
+        heap = []
+        for deadline, place_id, race_number in self.timetable:
+            for event_type, offset in STAGE_OFFSETS.items():
+                fire_at = deadline - timedelta(seconds=offset)
+                if (event_type, place_id, race_number, deadline) in self.fired:
+                    continue
+                if fire_at <= now and not is_in_time(event_type, deadline, fire_at, now):
+                    continue
+                heap.append((fire_at, next(self._seq), event_type, place_id, race_number, deadline))
+        heapq.heapify(heap)
+        self.heap = heap
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def fire_due(self, now: datetime) -> int:
+        """発行時刻を迎えたイベントをまとめて発行し、発行した件数を返す (リースを持たない間は発行しない)"""
+        if not self.is_leader():
+            return 0
+        messages = []
+        while self.heap and self.heap[0][0] <= now:
+            fire_at, _, event_type, place_id, race_number, deadline = heapq.heappop(self.heap)
+            key = (event_type, place_id, race_number, deadline)
+            if key in self.fired:
+                continue
+            self.fired.add(key)
+            if not is_in_time(event_type, deadline, fire_at, now):
+                print(f"Skipping late event: {event_type} {place_id}R{race_number}")
+                continue
+
+            message = {
+                "type": event_type,
+                "place_id": place_id,
+                "race_number": race_number,
+                "deadline": deadline.isoformat()
+            }
+            print(f"Dispatching: {message}")
+            messages.append(message)
+
+        if not messages:
+            return 0
+        # 同じ時刻に締切が重なる場のイベントは1回のバッチで送る
+        result = await publish_messages(messages)
+        for failure in result['failed']:
+            print(f"Failed to dispatch: {failure['message']} ({failure['error']})")
+        return result['published']
+
+    def is_leader(self) -> bool:
+        return time.monotonic() < self.lease_until
+
+    async def renew_lease(self) -> bool:
+        """発行担当のリースを取得・延長する"""
+        was_leader = self.is_leader()
+        try:
+            acquired = await asyncio.to_thread(
+                firestore_client.acquire_lease, DISPATCHER_LEASE, INSTANCE_ID, DISPATCHER_LEASE_TTL)
+        except Exception as e:
+            print(f"Error renewing dispatcher lease: {e}")
+            acquired = False
+        # 延長の往復時間とインスタンス間の時計のずれの分、期限より早めに担当を降りる
+        self.lease_until = time.monotonic() + DISPATCHER_LEASE_TTL * 0.8 if acquired else 0.0
+        if acquired and not was_leader:
+            print(f"Dispatcher lease acquired by {INSTANCE_ID}")
+            self._wakeup.set()
+        elif was_leader and not acquired:
+            print(f"Dispatcher lease lost by {INSTANCE_ID}")
+        return acquired
+
+    async def _lease_loop(self):
+        while True:
+            await self.renew_lease()
+            await asyncio.sleep(DISPATCHER_LEASE_TTL / 3)
+
+    async def _fire_loop(self):
+        while True:
+            self._wakeup.clear()
+            if not self.is_leader():
+                # 担当でない間は発行しない (リースを取れたら _lease_loop が起こす)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=DISPATCHER_LEASE_TTL / 3)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self.fire_due(clock.now())
+            except Exception as e:
+                print(f"Error dispatching events: {e}")
+            delay = TIMETABLE_REFRESH_INTERVAL
+            if self.heap:
+                delay = min(delay, (self.heap[0][0] - clock.now()).total_seconds())
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=clock.to_real(delay))
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                await self.refresh_timetable()
+            except Exception as e:
+                print(f"Error refreshing timetable: {e}")
+            await clock.sleep(TIMETABLE_REFRESH_INTERVAL)
+
+    def is_running(self) -> bool:
+        return any(not t.done() for t in self._tasks)
+
+    def start(self):
+        """発行ループを開始する (起動済みなら何もしない)"""
+        if self.is_running():
             return
+        self._wakeup = asyncio.Event()
+        self._tasks = [
+            asyncio.create_task(self._lease_loop()),
+            asyncio.create_task(self._fire_loop()),
+            asyncio.create_task(self._refresh_loop()),
+        ]
 
-        soup = BeautifulSoup(html, 'html.parser')
-        
-        # テーブルからレース情報を抽出
-        # div.table1 -> table -> tbody -> tr (各場)
-        
-        table_div = soup.select_one("div.table1")
-        if not table_div: return
-        
-        tbodies = table_div.select("table tbody")
-        
-        now = datetime.now()
-        
-        for tbody in tbodies:
-            # 各場
-            first_tr = tbody.select_one("tr")
-            if not first_tr: continue
-            
-            # 場ID取得
-            img = first_tr.select_one("td a img")
-            if not img or not img.get('src'): continue
-            
-            match = re.search(r'(\d{1,2})\.png', img['src'])
-            if not match: continue
-            place_id = int(match.group(1))
-            
-            # レース一覧 (2行目以降のtd)
-            # trs[1] にレース番号と時間が並んでいる
-            trs = tbody.select("tr")
-            if len(trs) < 2: continue
-            
-            race_tds = trs[1].select("td")
-            
-            for race_td in race_tds:
-                # レース番号と時間を取得
-                # 例: 1R 10:30
-                text = race_td.text.strip()
-                match = re.search(r'(\d{1,2})R\s*(\d{1,2}:\d{2})', text)
-                if not match: continue
-                
-                race_number = int(match.group(1))
-                time_str = match.group(2)
-                
-                # 締切時間
-                deadline = datetime.strptime(f"{now.strftime('%Y/%m/%d')} {time_str}", "%Y/%m/%d %H:%M")
-                
-                diff_seconds = (deadline - now).total_seconds()
-                
-                event_type = None
-                
-                # 6分前 (360s ~ 420s) -> scrape_info
-                if 360 <= diff_seconds < 420:
-                    event_type = "scrape_info"
-                
-                # 5分前 (300s ~ 360s) -> predict_5min
-                elif 300 <= diff_seconds < 360:
-                    event_type = "predict_5min"
-                
-                # 1分前 (60s ~ 120s) -> predict_1min
-                elif 60 <= diff_seconds < 120:
-                    event_type = "predict_1min"
-                
-                # 結果確認 (レース後20分程度) (-1260s ~ -1200s)
-                elif -1260 <= diff_seconds < -1200:
-                    event_type = "check_result"
-                
-                if event_type:
-                    message = {
-                        "type": event_type,
-                        "place_id": place_id,
-                        "race_number": race_number,
-                        "deadline": deadline.isoformat()
-                    }
-                    print(f"Dispatching: {message}")
-                    publish_message(message)
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.is_leader():
+            self.lease_until = 0.0
+            try:
+                await asyncio.to_thread(firestore_client.release_lease, DISPATCHER_LEASE, INSTANCE_ID)
+            except Exception as e:
+                print(f"Error releasing dispatcher lease: {e}")
+
+dispatcher = Dispatcher()
+
+async def check_and_dispatch():
+    """
+    Cloud Schedulerからの定期呼び出し
+    時刻表を(必要なら)更新し、発行ループが止まっていれば再開する。
+    イベント自体は発行ループが締切からの所定時刻ちょうどに送る
+    """
+    await dispatcher.refresh_timetable()
+    dispatcher.start()
 
+async def stop_dispatcher():
+    await dispatcher.stop()
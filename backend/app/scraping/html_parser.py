@@ -0,0 +1,50 @@
+import os
+from bs4 import BeautifulSoup
+
+try:
+    import lxml.html
+    LXML_AVAILABLE = True
+except ImportError:
+    LXML_AVAILABLE = False
+
+# HTMLパーサーのバックエンド
+# 'lxml': C実装で高速 (html.parserの数倍)。未インストールならhtml.parserにフォールバック
+#         レースごとに読む出走表・オッズはbs4を通さずlxml.htmlの木をXPathで直接読む (make_tree)
+# 'html.parser': 標準ライブラリのみで動く (全ページbs4で読む)
+AVAILABLE_BACKENDS = ['lxml', 'html.parser'] if LXML_AVAILABLE else ['html.parser']
+DEFAULT_BACKEND = os.getenv("HTML_PARSER", AVAILABLE_BACKENDS[0])
+
+def resolve_backend(backend: str = None) -> str:
+    """指定されたバックエンドが使えなければhtml.parserを返す"""
+    backend = backend or DEFAULT_BACKEND
+    if backend not in AVAILABLE_BACKENDS:
+        return 'html.parser'
+    return backend
+
+def make_soup(html, backend: str = None) -> BeautifulSoup:
+    """
+    HTML (bytes/str) からBeautifulSoupを作る
+    どのバックエンドでも同じbs4のAPIで扱えるので、各パーサーの出力は変わらない
+    """
+    return BeautifulSoup(html, resolve_backend(backend))
+
+def use_tree(backend: str = None) -> bool:
+    """bs4を通さないlxml.htmlの高速パスを使うか"""
+    return resolve_backend(backend) == 'lxml'
+
+def make_tree(html):
+    """
+    HTML (bytes/str) からlxml.htmlの木を作る (bs4の木・soupsieveを通さない)
+    boatrace.jpはUTF-8なので、bytesはUTF-8として読む (lxmlはmetaが無いとLatin-1とみなすため)
+    """
+    if isinstance(html, bytes):
+        html = html.decode('utf-8', errors='replace')
+    return lxml.html.document_fromstring(html)
+
+def has_class(name: str) -> str:
+    """classに指定のクラスを含む要素を選ぶXPathの条件 (CSSの .name と同じ)"""
+    return f'contains(concat(" ", normalize-space(@class), " "), " {name} ")'
+
+def stripped_strings(element) -> list:
+    """bs4のstripped_stringsと同じ (要素内のテキストを前後の空白を除いて空でないものだけ返す)"""
+    return [text.strip() for text in element.itertext() if text.strip()]
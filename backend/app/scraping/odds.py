@@ -1,37 +1,50 @@
-import aiohttp
 import asyncio
-from bs4 import BeautifulSoup
 from datetime import datetime
 import re
-
-HEADERS = {
-    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-}
-
-async def fetch_html(session, url):
-    try:
-        async with session.get(url, headers=HEADERS, timeout=10) as response:
-            if response.status == 200:
-                return await response.read()
-    except Exception as e:
-        print(f"Error fetching {url}: {e}")
-    return None
+from app import http_client, metrics
+from app.scraping.html_parser import has_class, make_soup, make_tree, use_tree
+from app.processing import trifecta
 
 def parse_odds(soup):
-    """3連単オッズをパースする"""
-    odds_list = []
-    
+    """
+    3連単オッズをパースする (bs4)
+    trifecta.COMBINATIONSの順に並んだ120要素の配列を返す (取得できなかった組み合わせはNaN)
+    """
     # div.contentsFrame1_inner -> div.table1 (2つ目)
     tables = soup.select("div.contentsFrame1_inner div.table1")
     if len(tables) < 2:
-        return []
-    
+        return trifecta.empty_vector()
+
     tbody = tables[1].select_one("table tbody")
     if not tbody:
-        return []
+        return trifecta.empty_vector()
+
+    return odds_from_cells([[td.text for td in row.select("td")] for row in tbody.select("tr")])
+
+def parse_odds_tree(doc):
+    """parse_oddsと同じ (lxml.htmlの木をXPathで読む高速パス)"""
+    tables = doc.xpath(f'//div[{has_class("contentsFrame1_inner")}]//div[{has_class("table1")}]')
+    if len(tables) < 2:
+        return trifecta.empty_vector()
+
+    tbodies = tables[1].xpath('.//table//tbody')
+    if not tbodies:
+        return trifecta.empty_vector()
+
+    return odds_from_cells([[td.text_content() for td in row.xpath('.//td')] for row in tbodies[0].xpath('.//tr')])
+
+def parse_odds_html(html, backend: str = None):
+    """HTMLからオッズを読む (lxmlがあれば高速パス、無ければbs4)"""
+    if use_tree(backend):
+        return parse_odds_tree(make_tree(html))
+    return parse_odds(make_soup(html, backend))
+
+def odds_from_cells(rows: list):
+    """
+    オッズ表の行ごとのセルのテキスト ([[td, ...], ...]) から120要素の配列を作る
+    """
+    odds_vec = trifecta.empty_vector()
 
-    rows = tbody.select("tr")
-    
     # 1-2-3 ... 6-5-4 (全120通り)
     # テーブル構造が複雑なので注意深くパース
     # 20行 x 6列 (各セルに3つのオッズが入っている場合とそうでない場合がある)
@@ -39,9 +52,7 @@ def parse_odds(soup):
     
     rows_with_second_boat = None
     
-    for row_index, row in enumerate(rows):
-        tds = row.select("td")
-        
+    for row_index, tds in enumerate(rows):
         for index in range(6): # 1号艇〜6号艇が頭
             first_boat = index + 1
             
@@ -53,26 +64,24 @@ def parse_odds(soup):
                 rows_with_second_boat = tds
                 target_index = index * 3
                 try:
-                    second_boat = int(rows_with_second_boat[target_index].text.strip())
-                    third_boat = int(tds[target_index + 1].text.strip())
-                    odds_val = float(tds[target_index + 2].text.strip())
+                    second_boat = int(rows_with_second_boat[target_index].strip())
+                    third_boat = int(tds[target_index + 1].strip())
+                    odds_val = float(tds[target_index + 2].strip())
                 except: pass
             else:
                 try:
-                    second_boat = int(rows_with_second_boat[index * 3].text.strip())
+                    second_boat = int(rows_with_second_boat[index * 3].strip())
                     target_index = index * 2
-                    third_boat = int(tds[target_index].text.strip())
-                    odds_val = float(tds[target_index + 1].text.strip())
+                    third_boat = int(tds[target_index].strip())
+                    odds_val = float(tds[target_index + 1].strip())
                 except: pass
             
             if second_boat != 0 and third_boat != 0:
-                combination = f"{first_boat}-{second_boat}-{third_boat}"
-                odds_list.append({
-                    "combination": combination,
-                    "odds": odds_val
-                })
+                idx = trifecta.combination_index(first_boat, second_boat, third_boat)
+                if idx >= 0:
+                    odds_vec[idx] = odds_val
 
-    return sorted(odds_list, key=lambda x: x['combination'])
+    return odds_vec
 
 def check_time(soup, deadline_time: datetime):
     """オッズ更新時間と締切までの時間を確認"""
@@ -106,16 +115,17 @@ async def get_odds(date: datetime, place_id: int, race_number: int):
     
     url = f"https://www.boatrace.jp/owpc/pc/race/odds3t?rno={race_number}&jcd={str_place}&hd={str_date}"
     
-    async with aiohttp.ClientSession() as session:
-        html = await fetch_html(session, url)
-        if not html:
-            return None
-        
-        soup = BeautifulSoup(html, 'html.parser')
-        odds = parse_odds(soup)
-        
-        # 締切時間との差分などは呼び出し元で計算するためにここでは返さないか、
-        # 必要なら引数でdeadlineを受け取る。
-        # ここでは純粋にオッズデータを返す。
-        
-        return odds
+    html = await http_client.fetch_html(url)
+    if not html:
+        return None
+    
+    with metrics.span('parse_odds'):
+        odds = parse_odds_html(html)
+    
+    # 締切時間との差分などは呼び出し元で計算するためにここでは返さないか、
+    # 必要なら引数でdeadlineを受け取る。
+    # ここでは純粋にオッズデータ (120要素の配列) を返す。
+    if not (odds == odds).any():
+        return None # 1つも取れなかった
+    
+    return odds
@@ -1,12 +1,8 @@
-import aiohttp
 import asyncio
-from bs4 import BeautifulSoup
 import re
 from datetime import datetime
-
-HEADERS = {
-    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-}
+from app import http_client, metrics
+from app.scraping.html_parser import has_class, make_soup, make_tree, stripped_strings, use_tree
 
 def parse_float(text, is_zero_to_none=False):
     """文字列をfloatに変換"""
@@ -24,24 +20,26 @@ def parse_float(text, is_zero_to_none=False):
     except ValueError:
         return None
 
-async def fetch_html(session, url):
+# ページが無い・データが無い場合の文言
+NO_DATA_TEXTS = ("データがありません", "指定されたページが見つかりません")
+
+def is_no_data(text: str) -> bool:
+    return any(t in text for t in NO_DATA_TEXTS)
+
+async def fetch_html(url):
     """URLからHTMLを取得"""
-    try:
-        async with session.get(url, headers=HEADERS, timeout=10) as response:
-            if response.status == 200:
-                html = await response.read()
-                soup = BeautifulSoup(html, 'html.parser')
-                if "データがありません" in soup.text or "指定されたページが見つかりません" in soup.text:
-                    return None
-                return soup
-    except Exception as e:
-        print(f"Error fetching {url}: {e}")
-    return None
+    html = await http_client.fetch_html(url)
+    if not html:
+        return None
+    with metrics.span('make_soup'):
+        soup = make_soup(html)
+    if is_no_data(soup.text):
+        return None
+    return soup
 
 def parse_racelist(soup, data, r_idx):
-    """出走表の解析ロジック"""
+    """出走表の解析ロジック (bs4)"""
     try:
-        prefix = f'r{r_idx}_'
         table_div = soup.find('div', class_='table1 is-tableFixed__3rdadd')
         if not table_div: return
 
@@ -54,50 +52,98 @@ def parse_racelist(soup, data, r_idx):
         if not rows: return
         tds = rows[0].find_all('td', recursive=False)
 
-        # 登録番号
-        try:
-            data[prefix + 'toban'] = rows[0].find('div', class_='is-fs11').text.strip().split('/')[0].strip()
-        except: pass
+        try: toban = rows[0].find('div', class_='is-fs11').text
+        except: toban = None
+        class_span = rows[0].find('span', class_='is-fColor1')
+        cells = [list(td.stripped_strings) for td in tds]
+        fill_racelist(data, r_idx, toban, class_span.text if class_span else None, rows[0].text, cells)
+    except Exception: pass
 
-        # 級別
-        try:
-            class_span = rows[0].find('span', class_='is-fColor1')
-            if class_span:
-                data[prefix + 'class'] = class_span.text.strip()
-            else:
-                match = re.search(r'(A1|A2|B1|B2)', rows[0].text)
-                data[prefix + 'class'] = match.group(1) if match else None
-        except: pass
+def parse_racelist_tree(doc, data, r_idx):
+    """parse_racelistと同じ (lxml.htmlの木をXPathで読む高速パス)"""
+    try:
+        table_divs = doc.xpath('//div[@class="table1 is-tableFixed__3rdadd"]')
+        if not table_divs: return
 
-        # 体重
-        try:
-            match = re.search(r'(\d{2}\.\d)kg', rows[0].text)
-            data[prefix + 'weight'] = parse_float(match.group(1)) if match else None
-        except: pass
+        tbodies = table_divs[0].xpath('(.//table)[1]//tbody')
+        if len(tbodies) < r_idx: return
+        tbody = tbodies[r_idx - 1]
 
-        # F/L/ST
-        try:
-            fl_lines = [line.strip() for line in tds[3].stripped_strings]
-            data[prefix + 'f_count'] = int(fl_lines[0].replace('F', ''))
-            data[prefix + 'l_count'] = int(fl_lines[1].replace('L', ''))
-            data[prefix + 'avg_st'] = parse_float(fl_lines[2])
-        except: pass
+        rows = tbody.xpath('.//tr')
+        if not rows: return
+        tds = rows[0].xpath('./td')
 
-        # 成績
-        try:
-            g_lines = [line.strip() for line in tds[4].stripped_strings] # 全国
-            data[prefix + 'global_win_rate'] = parse_float(g_lines[0], is_zero_to_none=True) if g_lines[0] != '-' else None
-            data[prefix + 'global_3ren_rate'] = parse_float(g_lines[2], is_zero_to_none=True) if g_lines[2] != '-' else None
+        toban_divs = rows[0].xpath(f'.//div[{has_class("is-fs11")}]')
+        toban = toban_divs[0].text_content() if toban_divs else None
+        class_spans = rows[0].xpath(f'.//span[{has_class("is-fColor1")}]')
+        cells = [stripped_strings(td) for td in tds]
+        fill_racelist(data, r_idx, toban, class_spans[0].text_content() if class_spans else None, rows[0].text_content(), cells)
+    except Exception: pass
 
-            l_lines = [line.strip() for line in tds[5].stripped_strings] # 当地
-            data[prefix + 'local_win_rate'] = parse_float(l_lines[0], is_zero_to_none=True) if l_lines[0] != '-' else None
-            data[prefix + 'local_3ren_rate'] = parse_float(l_lines[2], is_zero_to_none=True) if l_lines[2] != '-' else None
+def fill_racelist(data, r_idx, toban, racer_class, row_text, cells):
+    """
+    出走表の1艇分の値を data に入れる
+    toban: 登録番号のdivのテキスト、racer_class: 級別のspanのテキスト (無ければNone)、
+    row_text: 行全体のテキスト、cells: tdごとのstripped_strings
+    """
+    prefix = f'r{r_idx}_'
 
-            m_lines = [line.strip() for line in tds[6].stripped_strings] # モーター
-            data[prefix + 'motor_3ren'] = parse_float(m_lines[2], is_zero_to_none=True) if m_lines[2] != '-' else None
-        except: pass
+    # 登録番号
+    try:
+        data[prefix + 'toban'] = toban.strip().split('/')[0].strip()
+    except: pass
 
-    except Exception: pass
+    # 級別
+    try:
+        if racer_class is not None:
+            data[prefix + 'class'] = racer_class.strip()
+        else:
+            match = re.search(r'(A1|A2|B1|B2)', row_text)
+            data[prefix + 'class'] = match.group(1) if match else None
+    except: pass
+
+    # 体重
+    try:
+        match = re.search(r'(\d{2}\.\d)kg', row_text)
+        data[prefix + 'weight'] = parse_float(match.group(1)) if match else None
+    except: pass
+
+    # F/L/ST
+    try:
+        fl_lines = cells[3]
+        data[prefix + 'f_count'] = int(fl_lines[0].replace('F', ''))
+        data[prefix + 'l_count'] = int(fl_lines[1].replace('L', ''))
+        data[prefix + 'avg_st'] = parse_float(fl_lines[2])
+    except: pass
+
+    # 成績
+    try:
+        g_lines = cells[4] # 全国
+        data[prefix + 'global_win_rate'] = parse_float(g_lines[0], is_zero_to_none=True) if g_lines[0] != '-' else None
+        data[prefix + 'global_3ren_rate'] = parse_float(g_lines[2], is_zero_to_none=True) if g_lines[2] != '-' else None
+
+        l_lines = cells[5] # 当地
+        data[prefix + 'local_win_rate'] = parse_float(l_lines[0], is_zero_to_none=True) if l_lines[0] != '-' else None
+        data[prefix + 'local_3ren_rate'] = parse_float(l_lines[2], is_zero_to_none=True) if l_lines[2] != '-' else None
+
+        m_lines = cells[6] # モーター
+        data[prefix + 'motor_3ren'] = parse_float(m_lines[2], is_zero_to_none=True) if m_lines[2] != '-' else None
+    except: pass
+
+def parse_racelist_html(html, data, backend: str = None):
+    """出走表のHTMLから6艇分の値を data に入れる (lxmlがあれば高速パス、無ければbs4)"""
+    if use_tree(backend):
+        doc = make_tree(html)
+        if is_no_data(doc.text_content()):
+            return
+        for i in range(1, 7):
+            parse_racelist_tree(doc, data, i)
+    else:
+        soup = make_soup(html, backend)
+        if is_no_data(soup.text):
+            return
+        for i in range(1, 7):
+            parse_racelist(soup, data, i)
 
 def parse_beforeinfo(soup, data, r_idx):
     """直前情報の解析ロジック"""
@@ -187,16 +233,16 @@ async def get_race_info(date: datetime, place_id: int, race_number: int):
         'race_number': race_number
     }
 
-    async with aiohttp.ClientSession() as session:
-        task1 = fetch_html(session, url_race)
-        task2 = fetch_html(session, url_info)
-        soup_race, soup_info = await asyncio.gather(task1, task2)
+    task1 = http_client.fetch_html(url_race)
+    task2 = fetch_html(url_info)
+    html_race, soup_info = await asyncio.gather(task1, task2)
 
-        if soup_race:
-            for i in range(1, 7):
-                parse_racelist(soup_race, data, i)
+    if html_race:
+        with metrics.span('parse_racelist'):
+            parse_racelist_html(html_race, data)
 
-        if soup_info:
+    if soup_info:
+        with metrics.span('parse_beforeinfo'):
             for i in range(1, 7):
                 parse_beforeinfo(soup_info, data, i)
             parse_start_exhibition(soup_info, data)
@@ -1,99 +1,155 @@
-import aiohttp
 import asyncio
-from bs4 import BeautifulSoup
+import os
 from datetime import datetime
 import re
+from app import clock, http_client, metrics
+from app.scraping.html_parser import make_soup
 
-HEADERS = {
-    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-}
+# 払戻金一覧ページ (1日分) のキャッシュ設定
+# 未確定のレースを問い合わせた場合のみ再取得するが、直近の取得からこの秒数は再取得しない
+RESULT_REFRESH_INTERVAL = float(os.getenv("RESULT_REFRESH_INTERVAL", "30"))
+# 最後の取得からこの秒数が経過した日付のキャッシュは破棄する
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", str(6 * 60 * 60)))
 
-async def fetch_html(session, url):
+# {'YYYYMMDD': {'fetched_at': monotonic秒, 'index': {(place_id, race_number): result}}}
+_pay_cache = {}
+_pay_locks = {}
+
+def parse_cell(tds, col_idx: int):
+    """1場分の3連単セル (組番, 払戻金, 人気) をパースする"""
+    # 3連単は各場の列ごとに3つのセルを使う (組番, 払戻金, 人気)
+    # col_idx * 3 が開始位置
+    start_idx = col_idx * 3
+
+    if len(tds) <= start_idx + 1:
+        return None
+
+    # 組番 (spanタグ内の数字を結合)
+    combo_td = tds[start_idx]
+    spans = combo_td.select("span")
+    combination = "-".join([s.text.strip() for s in spans])
+    if not combination:
+        return None # 未確定
+
+    # 払戻金
+    price_td = tds[start_idx + 1]
+    price_span = price_td.select_one("span")
+    if not price_span:
+        return None
+
+    price_text = price_span.text.strip().replace('¥', '').replace(',', '')
     try:
-        async with session.get(url, headers=HEADERS, timeout=10) as response:
-            if response.status == 200:
-                return await response.read()
-    except Exception as e:
-        print(f"Error fetching {url}: {e}")
-    return None
+        payout = int(price_text)
+    except:
+        payout = 0
 
-async def get_race_result(date: datetime, place_id: int, race_number: int):
-    """レース結果（3連単の払戻金）を取得する"""
+    # 返還かどうか
+    is_returned = False
+    if len(tds) > start_idx + 2:
+        return_span = tds[start_idx + 2].select_one("span")
+        if return_span and return_span.text.strip() == "返":
+            is_returned = True
+
+    return {
+        "combination": combination,
+        "payout": payout,
+        "is_returned": is_returned
+    }
+
+def parse_pay_index(soup) -> dict:
+    """
+    払戻金一覧ページを1回だけ走査し、全場・全レースの結果を
+    {(place_id, race_number): result} の形で返す
+    """
+    index = {}
+
+    # 場は画像ファイル名(src)で判定する (checkHitPredict.tsと同じ)
+    tables = soup.select("table.is-strited1")
+
+    for table in tables:
+        thead = table.find("thead")
+        if not thead: continue
+
+        places = []
+        for area in thead.select("p.table1_areaName"):
+            img = area.select_one("p img")
+            match = re.search(r'(\d{1,2})\.png', img['src']) if img and img.get('src') else None
+            places.append(int(match.group(1)) if match else None)
+
+        # tbodyはレース番号順に並んでいる
+        for race_idx, tbody in enumerate(table.select("tbody")):
+            tds = tbody.select("td")
+            for col_idx, place_id in enumerate(places):
+                if place_id is None: continue
+                race_result = parse_cell(tds, col_idx)
+                if race_result:
+                    index[(place_id, race_idx + 1)] = race_result
+
+    return index
+
+def parse_result(soup, place_id: int, race_number: int):
+    """払戻金一覧ページから指定レースの3連単結果をパースする"""
+    return parse_pay_index(soup).get((place_id, race_number))
+
+def invalidate_result_cache(date: datetime = None, before: datetime = None):
+    """
+    キャッシュを破棄する。dateを指定した場合はその日付のみ、beforeを指定した場合はその日より前の日付
+    """
+    if date is not None:
+        dates = [date.strftime('%Y%m%d')]
+    elif before is not None:
+        dates = [d for d in _pay_cache if d < before.strftime('%Y%m%d')]
+    else:
+        dates = list(_pay_cache)
+    for d in dates:
+        _pay_cache.pop(d, None)
+        _pay_locks.pop(d, None)
+
+def _evict_expired(now: float):
+    expired = [d for d, entry in _pay_cache.items() if now - entry['fetched_at'] > RESULT_CACHE_TTL]
+    for d in expired:
+        del _pay_cache[d]
+        _pay_locks.pop(d, None)
+
+async def get_day_results(date: datetime, place_id: int = None, race_number: int = None) -> dict:
+    """
+    指定日の全レースの結果インデックスを返す
+    (place_id, race_number) を指定した場合、そのレースがキャッシュに無ければ再取得する
+    """
     str_date = date.strftime('%Y%m%d')
-    url = f"https://www.boatrace.jp/owpc/pc/race/pay?hd={str_date}"
-    
-    async with aiohttp.ClientSession() as session:
-        html = await fetch_html(session, url)
+    now = clock.monotonic()
+    _evict_expired(now)
+    # 新しい日付の問い合わせが来たら、それより前の日付は判定し終えているので破棄する
+    invalidate_result_cache(before=date)
+
+    entry = _pay_cache.get(str_date)
+    key = (place_id, race_number)
+    if entry and (place_id is None or key in entry['index']):
+        return entry['index']
+
+    lock = _pay_locks.setdefault(str_date, asyncio.Lock())
+    async with lock:
+        # ロック待ちの間に他のタスクが取得済みかもしれない
+        entry = _pay_cache.get(str_date)
+        if entry and (place_id is None or key in entry['index']):
+            return entry['index']
+        if entry and clock.monotonic() - entry['fetched_at'] < RESULT_REFRESH_INTERVAL:
+            return entry['index']
+
+        url = f"https://www.boatrace.jp/owpc/pc/race/pay?hd={str_date}"
+        html = await http_client.fetch_html(url)
         if not html:
-            return None
-        
-        soup = BeautifulSoup(html, 'html.parser')
-        
-        # 該当する場のテーブルを探す
-        # 画像alt属性で場名を判定するか、画像ファイル名で判定
-        # checkHitPredict.tsでは画像ファイル名(src)で判定している
-        
-        target_table = None
-        target_col_idx = -1
-        
-        tables = soup.select("table.is-strited1")
-        
-        for table in tables:
-            thead = table.find("thead")
-            if not thead: continue
-            
-            areas = thead.select("p.table1_areaName")
-            for idx, area in enumerate(areas):
-                img = area.select_one("p img")
-                if img and img.get('src'):
-                    match = re.search(r'(\d{1,2})\.png', img['src'])
-                    if match and int(match.group(1)) == place_id:
-                        target_table = table
-                        target_col_idx = idx
-                        break
-            if target_table:
-                break
-        
-        if not target_table or target_col_idx == -1:
-            return None
-            
-        # 結果行を取得 (race_number - 1)
-        tbody = target_table.select("tbody")[race_number - 1]
-        tds = tbody.select("td")
-        
-        # 3連単は各場の列ごとに3つのセルを使う (組番, 払戻金, 人気)
-        # target_col_idx * 3 が開始位置
-        start_idx = target_col_idx * 3
-        
-        if len(tds) <= start_idx + 1:
-            return None
-            
-        # 組番 (spanタグ内の数字を結合)
-        combo_td = tds[start_idx]
-        spans = combo_td.select("span")
-        combination = "-".join([s.text.strip() for s in spans])
-        
-        # 払戻金
-        price_td = tds[start_idx + 1]
-        price_span = price_td.select_one("span")
-        if not price_span:
-            return None
-            
-        price_text = price_span.text.strip().replace('¥', '').replace(',', '')
-        try:
-            payout = int(price_text)
-        except:
-            payout = 0
-            
-        # 返還かどうか
-        is_returned = False
-        if len(tds) > start_idx + 2:
-            return_span = tds[start_idx + 2].select_one("span")
-            if return_span and return_span.text.strip() == "返":
-                is_returned = True
-
-        return {
-            "combination": combination,
-            "payout": payout,
-            "is_returned": is_returned
-        }
+            return entry['index'] if entry else {}
+
+        with metrics.span('parse_pay'):
+            index = parse_pay_index(make_soup(html))
+        if entry:
+            # 確定済みの結果は変わらないので、過去の結果も残しておく
+            index = {**entry['index'], **index}
+        _pay_cache[str_date] = {'fetched_at': clock.monotonic(), 'index': index}
+        return index
+
+async def get_race_result(date: datetime, place_id: int, race_number: int):
+    """レース結果（3連単の払戻金）を取得する"""
+    index = await get_day_results(date, place_id, race_number)
+    return index.get((place_id, race_number))
@@ -0,0 +1,18 @@
+def percentile(values, q: float):
+    """ソート済みでないリストからq (0-100) パーセンタイルを求める"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, int(round(q / 100.0 * (len(ordered) - 1)))))
+    return ordered[idx]
+
+def latency_summary(values) -> dict:
+    """秒単位のレイテンシ列から件数とp50/p99 (ミリ秒) を返す"""
+    values = list(values)
+    if not values:
+        return {"count": 0, "p50_ms": None, "p99_ms": None}
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 50) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+    }
@@ -1,12 +1,18 @@
 import asyncio
+import os
 from datetime import datetime
 from app.scraping import race_info, odds, result
-from app.processing import feature_engineering
-from app.ml.predictor import get_predictor
-from app import firestore_client
+from app.processing import feature_engineering, trifecta, betting
+from app.ml.batcher import get_batcher
+from app import firestore_client, metrics
+from app.executor import Saturated, get_executor
+from app.cache import TTLCache
 
-# 期待値の閾値 (設定ファイルや環境変数にするのが望ましい)
-EV_THRESHOLD = 110.0 # 100円賭けて110円戻る期待値以上なら買う
+# 受け付けたイベントの記録 (Pub/Subの重複配信を即座に捨てる)。
+# インスタンスをまたぐ重複はFirestoreの処理権 (firestore_client.claim_event) で防ぐ
+EVENT_DEDUPE_TTL = float(os.getenv("EVENT_DEDUPE_TTL", "21600"))
+EVENT_DEDUPE_SIZE = int(os.getenv("EVENT_DEDUPE_SIZE", "8192"))
+_seen_events = TTLCache(max_entries=EVENT_DEDUPE_SIZE, ttl=EVENT_DEDUPE_TTL)
 
 async def handle_scrape_info(place_id: int, race_number: int, deadline: datetime):
     print(f"Handling scrape_info for {place_id}R{race_number}")
@@ -17,7 +23,8 @@ async def handle_scrape_info(place_id: int, race_number: int, deadline: datetime
         return
 
     # 2. 特徴量エンジニアリング
-    processed_data = feature_engineering.engineer_boat_features(data)
+    with metrics.span('engineer_features'):
+        processed_data = feature_engineering.engineer_boat_features(data)
     
     # 3. 保存
     firestore_client.save_race_info(deadline, place_id, race_number, processed_data)
@@ -26,14 +33,15 @@ async def handle_scrape_info(place_id: int, race_number: int, deadline: datetime
 async def handle_predict(place_id: int, race_number: int, deadline: datetime, type_key: str):
     print(f"Handling {type_key} for {place_id}R{race_number}")
     
-    # 1. オッズ取得
+    # 1. オッズ取得 (trifecta.COMBINATIONS順の120要素の配列)
     odds_data = await odds.get_odds(deadline, place_id, race_number)
-    if not odds_data:
+    if odds_data is None:
         print("Failed to scrape odds")
         return
 
     # 2. レース情報ロード
-    race_info_data = firestore_client.get_race_info_data(deadline, place_id, race_number)
+    with metrics.span('load_race_info'):
+        race_info_data = firestore_client.get_race_info_data(deadline, place_id, race_number)
     if not race_info_data:
         print("Race info not found")
         # レース情報がないと予測できないので終了 (またはここでスクレイピングを試みる手もあるが)
@@ -42,46 +50,28 @@ async def handle_predict(place_id: int, race_number: int, deadline: datetime, ty
     # 3. 予測 (モデル入力作成 -> 推論)
     # モデル入力には race_info_data と オッズ情報の一部(人気順など)が必要かもしれない
     # ここでは簡易的に race_info_data をそのまま入力とする
-    predictor = get_predictor()
-    probabilities = predictor.predict_proba(race_info_data)
+    # 同時刻に締切が重なる他場のレースとまとめて1回で推論する
+    with metrics.span('predict'):
+        probabilities = await get_batcher().predict(race_info_data)
     
-    # 4. 期待値計算 & 投票判断
-    bets_to_place = []
-    prediction_record = []
-    
-    for odd in odds_data:
-        combo = odd['combination']
-        val = odd['odds']
-        prob = probabilities.get(combo, 0.0)
-        
-        expected_value = prob * val * 100 # 100円賭けた場合の期待払い戻し額 (または単に prob * val で回収率期待値)
-        
-        # 回収率期待値 (%)
-        ev_percent = prob * val * 100
-        
-        prediction_record.append({
-            'combination': combo,
-            'probability': prob,
-            'odds': val,
-            'expected_value': ev_percent
-        })
-        
-        if type_key == 'predict_1min' and ev_percent >= EV_THRESHOLD:
-            bets_to_place.append({
-                'combination': combo,
-                'odds': val,
-                'amount': 100, # 固定額
-                'expected_value': ev_percent,
-                'status': 'pending'
-            })
+    # 4. 期待値計算 & 投票判断 (買い方は BET_STRATEGY で切り替え)
+    with metrics.span('select_bets'):
+        ev_percent = betting.expected_values(odds_data, probabilities)
+        prediction_record = trifecta.to_record(odds_data, probabilities, ev_percent)
+
+        bets_to_place = []
+        if type_key == 'predict_1min':
+            stakes = betting.select_bets(odds_data, probabilities)
+            bets_to_place = betting.bets_from_stakes(odds_data, ev_percent, stakes)
             
-    # 5. 保存
-    firestore_client.save_prediction(deadline, place_id, race_number, prediction_record, type_key)
-    
+    # 5. 保存 (予測結果とベットを1回のバッチで書き込む)
+    firestore_client.save_prediction_and_bets(deadline, place_id, race_number, prediction_record, type_key, bets_to_place)
     if type_key == 'predict_1min':
-        for bet in bets_to_place:
-            firestore_client.save_bet(deadline, place_id, race_number, bet)
-            print(f"Bet placed: {bet['combination']} (EV: {bet['expected_value']:.1f}%)")
+        # 締切の何秒前にベットを保存できたか
+        metrics.observe_bet_slack(deadline, place_id)
+    
+    for bet in bets_to_place:
+        print(f"Bet placed: {bet['combination']} (EV: {bet['expected_value']:.1f}%)")
 
 async def handle_check_result(place_id: int, race_number: int, deadline: datetime):
     print(f"Handling check_result for {place_id}R{race_number}")
@@ -93,9 +83,20 @@ async def handle_check_result(place_id: int, race_number: int, deadline: datetim
     firestore_client.save_result(deadline, place_id, race_number, result_data)
     print(f"Result saved: {result_data['combination']}")
 
-async def process_event(data: dict):
+def event_key(event_type: str, place_id: int, race_number: int, deadline: datetime) -> str:
+    """重複判定に使うイベントのキー (締切が変更された場合は別のイベントとして扱う)"""
+    race_id = firestore_client.get_race_id(deadline, place_id, race_number)
+    return f"{event_type}-{race_id}-{deadline.strftime('%H%M%S')}"
+
+def _drop_duplicate(event_type: str, key: str):
+    print(f"Duplicate event: {key}")
+    metrics.EVENTS_DROPPED.inc(event_type=event_type, reason='duplicate')
+
+def submit_event(data: dict):
     """
-    Pub/Subメッセージを処理する
+    Pub/Subメッセージを実行キューに入れ、処理が終わると結果 (実行したか) が入るFutureを返す
+    締切が近いイベント (predict_1min) から順に処理し、間に合わないものは捨てる
+    不正なメッセージ・受け付け済みのイベントならNone、混雑している場合はexecutor.Saturatedを送出する
     """
     event_type = data.get('type')
     place_id = data.get('place_id')
@@ -104,10 +105,54 @@ async def process_event(data: dict):
     
     if not (event_type and place_id and race_number and deadline_str):
         print("Invalid event data")
-        return
+        return None
 
     deadline = datetime.fromisoformat(deadline_str)
-    
+    key = event_key(event_type, place_id, race_number, deadline)
+    if key in _seen_events:
+        _drop_duplicate(event_type, key)
+        return None
+
+    async def job():
+        # 他のインスタンスが処理中・処理済みなら何もしない
+        # Firestoreの呼び出しは同期なのでイベントループを止めないようスレッドで行う
+        if not await asyncio.to_thread(firestore_client.claim_event, key):
+            _drop_duplicate(event_type, key)
+            return
+        try:
+            with metrics.event_labels(event_type, place_id), metrics.span('total'):
+                await run_event(event_type, place_id, race_number, deadline)
+        except Exception:
+            # Pub/Subには受け付けた時点で応答済み (ack) なので再送はされない。
+            # 処理権を手放し、同じイベントが再度発行・配信された場合は処理し直せるようにする
+            _seen_events.pop(key)
+            await asyncio.to_thread(firestore_client.release_event, key)
+            raise
+        await asyncio.to_thread(firestore_client.complete_event, key)
+
+    future = get_executor().submit(event_type, deadline, job)
+    # 受け付けた時点で記録する (混雑で断った場合は再送を受け付ける)
+    _seen_events.set(key, True)
+    future.add_done_callback(_log_failure)
+    return future
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception():
+        print(f"Error processing event: {future.exception()}")
+
+async def process_event(data: dict):
+    """
+    Pub/Subメッセージを処理する (処理が終わるまで待つ)
+    """
+    try:
+        future = submit_event(data)
+    except Saturated as e:
+        print(f"Rejected event ({e.reason}): {data}")
+        return
+    if future is not None and not await future:
+        print(f"Dropped late event: {data.get('type')} {data.get('place_id')}R{data.get('race_number')}")
+
+async def run_event(event_type: str, place_id: int, race_number: int, deadline: datetime):
     if event_type == 'scrape_info':
         await handle_scrape_info(place_id, race_number, deadline)
     elif event_type == 'predict_5min':
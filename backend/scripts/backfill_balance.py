@@ -0,0 +1,65 @@
+"""
+日別収支の集計ドキュメント (daily_balance) を既存のベットから作り直す
+
+集計はベットの保存・判定時に差分で更新されるため、通常は不要。
+集計導入前のベットを反映する場合や、集計がずれた場合に一度だけ実行する。
+実行中に新しいベットが保存されると反映漏れになるので、レースの無い時間帯に実行すること。
+
+使い方 (backendディレクトリで実行、PROJECT_IDを設定):
+    python -m scripts.backfill_balance --since 2025-01-01
+    python -m scripts.backfill_balance --dry-run
+"""
+import argparse
+from datetime import datetime
+from app import firestore_client
+
+def aggregate_bets(bets) -> dict:
+    """ベットを日付・場ごとに集計する"""
+    days = {}
+    for bet in bets:
+        data = bet.to_dict()
+        date_str = firestore_client.get_balance_date(data['date'])
+        amount = data.get('amount', 0)
+        return_amount = data.get('return_amount') or 0
+        won = 1 if data.get('status') == 'won' else 0
+
+        day = days.setdefault(date_str, {'date': date_str, 'amount': 0, 'return_amount': 0, 'bets': 0, 'won': 0, 'venues': {}})
+        venue = day['venues'].setdefault(str(data['place_id']), {'amount': 0, 'return_amount': 0, 'bets': 0, 'won': 0})
+        for target in (day, venue):
+            target['amount'] += amount
+            target['return_amount'] += return_amount
+            target['bets'] += 1
+            target['won'] += won
+    return days
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--since", help="この日付 (YYYY-MM-DD) 以降のベットのみ集計する")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    db = firestore_client.get_db()
+    if not db:
+        print("PROJECT_ID is not set")
+        return
+
+    query = db.collection('bets')
+    if args.since:
+        query = query.where('date', '>=', datetime.strptime(args.since, '%Y-%m-%d'))
+    days = aggregate_bets(query.stream())
+
+    for date_str in sorted(days):
+        day = days[date_str]
+        print(f"{date_str}: bets={day['bets']} amount={day['amount']} return={day['return_amount']}")
+    if args.dry_run:
+        return
+
+    writer = firestore_client.get_bulk_writer()
+    for date_str, day in days.items():
+        ref = db.collection(firestore_client.BALANCE_COLLECTION).document(date_str)
+        writer.set(ref, {**day, 'updated_at': firestore_client.firestore.SERVER_TIMESTAMP})
+    writer.close()
+    print(f"Wrote {len(days)} daily_balance documents")
+
+if __name__ == "__main__":
+    main()
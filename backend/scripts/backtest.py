@@ -0,0 +1,120 @@
+"""
+保存済みのレースで買い方をバックテストする (app/backtest.py)
+
+使い方 (backendディレクトリで実行):
+    # Firestoreのracesコレクションを一度だけJSON Linesに書き出す (PROJECT_IDを設定)
+    python -m scripts.backtest export races.jsonl --since 2024-01-01
+
+    # 以降はGCP無しで何度でも実行できる
+    python -m scripts.backtest run races.jsonl --strategy threshold --grid threshold=100,110,120,130
+    python -m scripts.backtest run races.jsonl --strategy topk --grid k=1,3,5 --grid threshold=100,120 --workers 4
+    python -m scripts.backtest run races.jsonl --strategy kelly --grid fraction=0.1,0.25 --output result.json --venues
+"""
+import argparse
+import json
+import time
+from datetime import datetime
+from app import backtest
+
+def parse_value(value: str):
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+def parse_grid(specs: list) -> dict:
+    """['threshold=100,110', 'amount=100'] -> {'threshold': [100, 110], 'amount': [100]}"""
+    grid = {}
+    for spec in specs or []:
+        key, _, values = spec.partition('=')
+        if not values:
+            raise SystemExit(f"invalid --grid: {spec} (expected key=v1,v2,...)")
+        grid[key.strip()] = [parse_value(v.strip()) for v in values.split(',') if v.strip()]
+    return grid
+
+def to_jsonable(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return {k: to_jsonable(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [to_jsonable(v) for v in value]
+    return value
+
+def export(args):
+    from app import firestore_client
+    db = firestore_client.get_db()
+    if not db:
+        print("PROJECT_ID is not set")
+        return
+
+    query = db.collection('races')
+    if args.since:
+        query = query.where('metadata.date', '>=', datetime.strptime(args.since, '%Y-%m-%d'))
+    count = 0
+    with open(args.path, 'w', encoding='utf-8') as f:
+        for doc in query.stream():
+            data = doc.to_dict()
+            # 結果の無いレースはバックテストに使えない
+            if not data.get('result') or not data.get('predict_1min'):
+                continue
+            f.write(json.dumps({'race_id': doc.id, **to_jsonable(data)}, ensure_ascii=False) + "\n")
+            count += 1
+    print(f"exported {count} races to {args.path}")
+
+def run(args):
+    started = time.perf_counter()
+    races = backtest.load_races(args.path)
+    loaded = time.perf_counter()
+    print(f"loaded {len(races)} races in {loaded - started:.1f}s")
+
+    prepared = backtest.prepare(races, workers=args.workers, chunk_size=args.chunk_size)
+    predicted = time.perf_counter()
+    print(f"predicted in {predicted - loaded:.1f}s (workers={args.workers})")
+
+    results = backtest.run_grid(prepared, args.strategy, parse_grid(args.grid))
+    print(f"evaluated {len(results)} parameter sets in {time.perf_counter() - predicted:.1f}s\n")
+
+    results.sort(key=lambda r: r['roi'] if r['roi'] is not None else float('-inf'), reverse=True)
+    print(f"{'params':<36} {'bet':>7} {'hit%':>6} {'stake':>12} {'return':>12} {'roi%':>7} {'max_dd':>10}")
+    for r in results:
+        params = ' '.join(f"{k}={v}" for k, v in r['params'].items()) or '(default)'
+        hit_rate = f"{r['hit_rate'] * 100:.1f}" if r['hit_rate'] is not None else '-'
+        roi = f"{r['roi'] * 100:.1f}" if r['roi'] is not None else '-'
+        print(f"{params:<36} {r['races_bet']:>7} {hit_rate:>6} {r['stake']:>12.0f} {r['return']:>12.0f} {roi:>7} {r['max_drawdown']:>10.0f}")
+        if args.venues:
+            for place_id, v in sorted(r['venues'].items()):
+                v_roi = f"{v['roi'] * 100:.1f}" if v['roi'] is not None else '-'
+                print(f"    place {place_id:>2}: bet={v['races_bet']} stake={v['stake']:.0f} return={v['return']:.0f} roi%={v_roi}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\nsaved to {args.output}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_export = sub.add_parser("export", help="Firestoreのレースを書き出す")
+    p_export.add_argument("path")
+    p_export.add_argument("--since", help="この日付 (YYYY-MM-DD) 以降のレースのみ")
+    p_export.set_defaults(func=export)
+
+    p_run = sub.add_parser("run", help="バックテストを実行する")
+    p_run.add_argument("path")
+    p_run.add_argument("--strategy", default="threshold", help="threshold / topk / kelly")
+    p_run.add_argument("--grid", action="append", help="key=v1,v2,... (複数指定で全組み合わせ)")
+    p_run.add_argument("--workers", type=int, default=1, help="予測を並列に行うプロセス数")
+    p_run.add_argument("--chunk-size", type=int, default=2000)
+    p_run.add_argument("--venues", action="store_true", help="場ごとの内訳も表示する")
+    p_run.add_argument("--output", help="結果をJSONで保存する")
+    p_run.set_defaults(func=run)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+フェッチレイテンシのベンチマーク
+
+レースごとに新しいClientSessionを作る方式 (fresh) と、共有セッション (pooled) の
+p50/p99 を比較する。
+
+使い方 (backendディレクトリで実行):
+    python -m scripts.bench_fetch --requests 200 --concurrency 24
+    python -m scripts.bench_fetch --url http://localhost:8081/owpc/pc/race/index
+"""
+import argparse
+import asyncio
+import time
+import aiohttp
+from app import http_client
+from app.stats import percentile
+
+DEFAULT_URL = "https://www.boatrace.jp/owpc/pc/race/index"
+
+async def fetch_fresh(url):
+    """変更前の挙動: 1リクエストごとにセッションを作って捨てる"""
+    start = time.perf_counter()
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url, headers=http_client.HEADERS, timeout=10) as response:
+                await response.read()
+    except Exception as e:
+        print(f"Error fetching {url}: {e}")
+    return time.perf_counter() - start
+
+async def fetch_pooled(url):
+    start = time.perf_counter()
+    await http_client.fetch_html(url)
+    return time.perf_counter() - start
+
+async def run(mode, url, n_requests, concurrency):
+    sem = asyncio.Semaphore(concurrency)
+    fetch = fetch_fresh if mode == "fresh" else fetch_pooled
+
+    async def one():
+        async with sem:
+            return await fetch(url)
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*[one() for _ in range(n_requests)])
+    elapsed = time.perf_counter() - start
+
+    p50 = percentile(latencies, 50) * 1000
+    p99 = percentile(latencies, 99) * 1000
+    print(f"{mode:>6}: n={n_requests} total={elapsed:.2f}s p50={p50:.1f}ms p99={p99:.1f}ms")
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default=DEFAULT_URL)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=24)
+    parser.add_argument("--mode", choices=["fresh", "pooled", "both"], default="both")
+    args = parser.parse_args()
+
+    modes = ["fresh", "pooled"] if args.mode == "both" else [args.mode]
+    for mode in modes:
+        await run(mode, args.url, args.requests, args.concurrency)
+    await http_client.close_session()
+
+if __name__ == "__main__":
+    asyncio.run(main())
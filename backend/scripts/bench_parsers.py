@@ -0,0 +1,259 @@
+"""
+HTMLパーサーのベンチマーク
+
+保存済みHTMLフィクスチャに対して全パーサーを各方式で実行し、ページごとのパース時間と
+ピークメモリを表示する。方式間で出力が一致するかも確認する。
+  lxml.html       : bs4を通さずXPathで読む高速パス (出走表・オッズのみ)
+  bs4/lxml        : bs4 + lxmlのツリービルダー
+  bs4/html.parser : bs4 + 標準ライブラリ (フォールバック)
+メモリはページごとに新しいプロセスでパースし、ピークRSS (VmHWM) の増分を測る
+(tracemallocではlxmlのC側の確保が数えられないため)。Linux以外ではtracemallocで測る。
+
+フィクスチャはファイル名の先頭でページ種別を判定する:
+    odds3t*.html, racelist*.html, beforeinfo*.html, pay*.html
+scripts/fixtures には疑似boatrace.jp (scripts/fake_boatrace.py) で生成したページを置いている。
+実際のページで測る場合は --save で取得して置き換える。
+--archiveを指定するとページアーカイブ (app/page_archive.py) に保存された全ページを対象にする
+
+使い方 (backendディレクトリで実行):
+    python -m scripts.bench_parsers --save --date 20250101 --place 4 --race 1
+    python -m scripts.bench_parsers --generate --date 20250101 --place 4 --race 1
+    python -m scripts.bench_parsers --repeat 20
+    python -m scripts.bench_parsers --archive /data/page_archive --repeat 1
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+from app import http_client, page_archive
+from app.scraping import odds, race_info, result
+from app.scraping.html_parser import AVAILABLE_BACKENDS, LXML_AVAILABLE, make_soup, make_tree
+
+DEFAULT_FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+def run_racelist(soup, args):
+    data = {}
+    for i in range(1, 7):
+        race_info.parse_racelist(soup, data, i)
+    return data
+
+def run_racelist_tree(doc, args):
+    data = {}
+    for i in range(1, 7):
+        race_info.parse_racelist_tree(doc, data, i)
+    return data
+
+def run_beforeinfo(soup, args):
+    data = {}
+    for i in range(1, 7):
+        race_info.parse_beforeinfo(soup, data, i)
+    race_info.parse_start_exhibition(soup, data)
+    race_info.parse_weather(soup, data)
+    return data
+
+def run_odds(soup, args):
+    return odds.parse_odds(soup)
+
+def run_pay(soup, args):
+    return result.parse_result(soup, args.place, args.race)
+
+PARSERS = {
+    'odds3t': run_odds,
+    'racelist': run_racelist,
+    'beforeinfo': run_beforeinfo,
+    'pay': run_pay,
+}
+# bs4を通さない高速パスがあるページ
+TREE_PARSERS = {
+    'odds3t': lambda doc, args: odds.parse_odds_tree(doc),
+    'racelist': run_racelist_tree,
+}
+# 出力の比較の基準 (フォールバック)
+BASELINE = 'bs4/html.parser'
+
+def page_kind(filename):
+    for kind in PARSERS:
+        if filename.startswith(kind):
+            return kind
+    return None
+
+def variants(kind) -> list:
+    names = [f'bs4/{backend}' for backend in AVAILABLE_BACKENDS]
+    if LXML_AVAILABLE and kind in TREE_PARSERS:
+        names.insert(0, 'lxml.html')
+    return names
+
+def parse_page(html, kind, variant, args):
+    if variant == 'lxml.html':
+        return TREE_PARSERS[kind](make_tree(html), args)
+    soup = make_soup(html, variant.split('/', 1)[1])
+    return PARSERS[kind](soup, args)
+
+def _read_status_kb(field: str):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return None
+
+def _peak_memory_bytes(html, kind, variant, args) -> int:
+    """新しいプロセス内で1回パースし、パース中のピークRSSの増分を返す"""
+    try:
+        # ピークRSS (VmHWM) を現在のRSSにリセットする
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        before = _read_status_kb('VmRSS')
+        parse_page(html, kind, variant, args)
+        return (_read_status_kb('VmHWM') - before) * 1024
+    except OSError:
+        tracemalloc.start()
+        parse_page(html, kind, variant, args)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak
+
+def measure_memory(html, kind, variant, args) -> int:
+    # 前のパースで確保したメモリの再利用の影響を受けないよう、毎回新しいプロセスで測る
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(_peak_memory_bytes, html, kind, variant, args).result()
+
+def same_output(a, b) -> bool:
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return np.array_equal(a, b, equal_nan=True)
+    return a == b
+
+def archive_page_kind(url):
+    """アーカイブのURL (.../race/odds3t?rno=1&jcd=04&hd=...) からページ種別と場・レースを判定する"""
+    parsed = urlparse(url or '')
+    kind = page_kind(parsed.path.rsplit('/', 1)[-1])
+    query = parse_qs(parsed.query)
+    place = int(query['jcd'][0]) if 'jcd' in query else None
+    race = int(query['rno'][0]) if 'rno' in query else None
+    return kind, place, race
+
+def bench_file(path, kind, args):
+    with open(path, 'rb') as f:
+        html = f.read()
+    bench_html(os.path.basename(path), html, kind, args)
+
+def bench_html(name, html, kind, args):
+    outputs = {}
+    for variant in variants(kind):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            outputs[variant] = parse_page(html, kind, variant, args)
+        elapsed_ms = (time.perf_counter() - start) / args.repeat * 1000
+
+        memory = '' if args.no_memory else f"  peak {measure_memory(html, kind, variant, args) / 1024 / 1024:7.2f} MiB"
+        print(f"{name:<28} {variant:<16} {elapsed_ms:8.2f} ms/page{memory}")
+
+    baseline = outputs[BASELINE]
+    for variant, output in outputs.items():
+        if not same_output(output, baseline):
+            print(f"  !! output mismatch: {variant} != {BASELINE}")
+
+async def save_fixtures(args):
+    """指定レースのページを取得してフィクスチャとして保存する"""
+    os.makedirs(args.fixtures, exist_ok=True)
+    str_place = str(args.place).zfill(2)
+    base = "https://www.boatrace.jp/owpc/pc/race"
+    query = f"rno={args.race}&jcd={str_place}&hd={args.date}"
+    urls = {
+        'odds3t': f"{base}/odds3t?{query}",
+        'racelist': f"{base}/racelist?{query}",
+        'beforeinfo': f"{base}/beforeinfo?{query}",
+        'pay': f"{base}/pay?hd={args.date}",
+    }
+    for kind, url in urls.items():
+        html = await http_client.fetch_html(url)
+        if not html:
+            print(f"Failed to fetch {url}")
+            continue
+        path = os.path.join(args.fixtures, f"{kind}_{args.date}_{str_place}_{args.race}.html")
+        with open(path, 'wb') as f:
+            f.write(html)
+        print(f"Saved {path}")
+    await http_client.close_session()
+
+def generate_fixtures(args):
+    """疑似boatrace.jpで生成したページをフィクスチャとして保存する (boatrace.jpに繋がらない環境用)"""
+    from scripts.fake_boatrace import FakeBoatrace
+    os.makedirs(args.fixtures, exist_ok=True)
+    server = FakeBoatrace(day=datetime.strptime(args.date, '%Y%m%d'))
+    str_place = str(args.place).zfill(2)
+    query = {'jcd': str_place, 'rno': str(args.race), 'hd': args.date}
+    for kind in PARSERS:
+        html = getattr(server, f"render_{kind}")(query)
+        path = os.path.join(args.fixtures, f"{kind}_{args.date}_{str_place}_{args.race}.html")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(html)
+        print(f"Saved {path}")
+
+def bench_archive(args):
+    """アーカイブの全ページを取得時刻順に再パースする (payは--place/--raceのレースを対象にする)"""
+    archive = page_archive.PageArchive(args.archive)
+    print(f"backends: {', '.join(AVAILABLE_BACKENDS)}  archive: {archive.stats()['fetches']} fetches")
+    start = time.perf_counter()
+    count = 0
+    for url, fetched_at, html in archive.iter_pages():
+        kind, place, race = archive_page_kind(url)
+        if not kind or html is None:
+            continue
+        if kind == 'pay':
+            place, race = args.place, args.race
+        page_args = argparse.Namespace(**{**vars(args), 'place': place or args.place, 'race': race or args.race})
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(fetched_at))
+        name = f"{kind}_{place or ''}_{race or ''}@{stamp}"
+        bench_html(name, html, kind, page_args)
+        count += 1
+    print(f"{count} pages in {time.perf_counter() - start:.1f}s")
+    archive.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fixtures", default=DEFAULT_FIXTURE_DIR)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--place", type=int, default=1, help="pay/保存対象の場ID")
+    parser.add_argument("--race", type=int, default=1, help="pay/保存対象のレース番号")
+    parser.add_argument("--date", help="保存対象の日付 (YYYYMMDD)")
+    parser.add_argument("--save", action="store_true", help="boatrace.jpからフィクスチャを取得して保存する")
+    parser.add_argument("--generate", action="store_true", help="疑似boatrace.jpのページをフィクスチャとして保存する")
+    parser.add_argument("--no-memory", action="store_true", help="メモリを測らない (ページごとにプロセスを起動しない)")
+    parser.add_argument("--archive", help="フィクスチャの代わりにページアーカイブのディレクトリを使う")
+    args = parser.parse_args()
+
+    if args.archive:
+        bench_archive(args)
+        return
+
+    if args.save:
+        if not args.date:
+            parser.error("--save requires --date")
+        asyncio.run(save_fixtures(args))
+        return
+
+    if args.generate:
+        if not args.date:
+            parser.error("--generate requires --date")
+        generate_fixtures(args)
+        return
+
+    if not os.path.isdir(args.fixtures):
+        print(f"No fixtures found at {args.fixtures}")
+        return
+
+    print(f"backends: {', '.join(AVAILABLE_BACKENDS)}")
+    for filename in sorted(os.listdir(args.fixtures)):
+        kind = page_kind(filename)
+        if not kind:
+            continue
+        bench_file(os.path.join(args.fixtures, filename), kind, args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+Pub/Sub送信のベンチマーク (GCP不要、MockPublisherを使用)
+
+1件ずつfuture.result()で待つ方式 (sync) と publish_messages (async) のスループットを比較する。
+
+使い方 (backendディレクトリで実行):
+    python -m scripts.bench_pubsub --messages 96 --latency 0.05 --batch-size 50
+"""
+import argparse
+import asyncio
+import time
+from app import pubsub_client
+from app.pubsub_client import MockPublisher
+
+def make_messages(n):
+    return [
+        {"type": "predict_1min", "place_id": i % 24 + 1, "race_number": i // 24 + 1, "deadline": "2025-01-01T10:30:00"}
+        for i in range(n)
+    ]
+
+def bench_sync(messages, latency):
+    client = MockPublisher(latency=latency, verbose=False)
+    start = time.perf_counter()
+    for data in messages:
+        client.publish(pubsub_client.topic_path, pubsub_client.encode_message(data)).result()
+    return time.perf_counter() - start
+
+async def bench_async(messages, latency, batch_size):
+    client = MockPublisher(latency=latency, verbose=False)
+    start = time.perf_counter()
+    result = await pubsub_client.publish_messages(messages, batch_size=batch_size, client=client)
+    elapsed = time.perf_counter() - start
+    assert result['published'] == len(messages), result['failed']
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=96)
+    parser.add_argument("--latency", type=float, default=0.05, help="1メッセージあたりの擬似送信レイテンシ (秒)")
+    parser.add_argument("--batch-size", type=int, default=pubsub_client.PUBSUB_BATCH_SIZE)
+    args = parser.parse_args()
+
+    messages = make_messages(args.messages)
+    for mode, elapsed in [
+        ("sync", bench_sync(messages, args.latency)),
+        ("async", asyncio.run(bench_async(messages, args.latency, args.batch_size))),
+    ]:
+        print(f"{mode:>5}: {len(messages)} msgs in {elapsed:.3f}s ({len(messages) / elapsed:.0f} msg/s)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+起動時間のベンチマーク (Cloud Runのコールドスタート相当)
+
+新しいPythonプロセスで app.main をimportし、-X importtime の結果からモジュールごとの
+import時間を集計する。続けて、起動後に遅延して読み込むもの (google.cloud.firestore /
+pubsub_v1 / pandas / AutoGluon、各クライアントとモデル) の初期化時間を1つずつ測る。
+遅延読み込みは依存ライブラリ (gRPC等) を共有するため、先に読み込んだものの時間に含まれる。
+
+使い方 (backendディレクトリで実行):
+    python -m scripts.bench_startup
+    python -m scripts.bench_startup --runs 5 --top 15
+    PROJECT_ID=my-project python -m scripts.bench_startup  # 実際のクライアントの作成時間も測る
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+# 遅延読み込みを起動後に行われる順で実行し、lazy.load_times() を出力する子プロセスのコード
+INIT_CODE = """
+import json, time
+start = time.perf_counter()
+import app.main
+import_seconds = time.perf_counter() - start
+from app import firestore_client, lazy, pubsub_client
+from app.ml import predictor
+steps = [
+    ('google.cloud.firestore', firestore_client.firestore.load),
+    ('firestore.Client', firestore_client.get_db),
+    ('google.cloud.pubsub_v1', pubsub_client.pubsub_v1.load),
+    ('pubsub_v1.PublisherClient', pubsub_client.get_publisher),
+    ('pandas', predictor.pd.load),
+    ('model', predictor.get_predictor),
+]
+seconds = {}
+for name, load in steps:
+    start = time.perf_counter()
+    try:
+        load()
+    except Exception as e:
+        print(f"{name}: {e}")
+    seconds[name] = time.perf_counter() - start
+print('RESULT ' + json.dumps({'import': import_seconds, 'init': seconds, 'recorded': lazy.load_times()}))
+"""
+
+def run_python(code: str, importtime: bool = False):
+    cmd = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', code]
+    return subprocess.run(cmd, capture_output=True, text=True, cwd=os.getcwd(), check=True)
+
+def parse_importtime(stderr: str) -> dict:
+    """-X importtime の出力 -> {モジュール名: (自身の秒数, 依存を含む秒数)}"""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(self_us) / 1e6, int(cumulative_us) / 1e6)
+    return modules
+
+def package_of(name: str) -> str:
+    """集計の単位 (google.cloud.* はサブパッケージ、app.* はモジュールごと)"""
+    parts = name.split('.')
+    if parts[0] == 'app':
+        return name
+    if parts[:2] == ['google', 'cloud'] and len(parts) > 2:
+        return '.'.join(parts[:3])
+    return parts[0]
+
+def bench_imports(runs: int) -> dict:
+    """モジュールごとのimport時間 (runs回の中央値)"""
+    samples = defaultdict(list)
+    for _ in range(runs):
+        modules = parse_importtime(run_python('import app.main', importtime=True).stderr)
+        by_package = defaultdict(float)
+        for name, (self_s, _) in modules.items():
+            by_package[package_of(name)] += self_s
+        for package, seconds in by_package.items():
+            samples[package].append(seconds)
+        samples['app.main (total)'].append(modules['app.main'][1])
+    return {name: statistics.median(values) for name, values in samples.items()}
+
+def bench_init(runs: int) -> dict:
+    """import後に遅延して行う初期化の時間 (runs回の中央値)"""
+    samples = defaultdict(list)
+    for _ in range(runs):
+        out = run_python(INIT_CODE).stdout
+        result = json.loads(out.split('RESULT ', 1)[1])
+        samples['import app.main'].append(result['import'])
+        for name, seconds in result['init'].items():
+            samples[name].append(seconds)
+    return {name: statistics.median(values) for name, values in samples.items()}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=3, help="計測回数 (中央値を表示する)")
+    parser.add_argument("--top", type=int, default=20, help="import時間の上位何件を表示するか")
+    parser.add_argument("--output", help="結果をJSONで保存する")
+    args = parser.parse_args()
+
+    imports = bench_imports(args.runs)
+    total = imports.pop('app.main (total)')
+    print(f"import app.main: {total * 1000:.1f} ms (median of {args.runs})\n")
+    print(f"{'module / package':<40} {'self ms':>9} {'share':>6}")
+    for name, seconds in sorted(imports.items(), key=lambda kv: -kv[1])[:args.top]:
+        print(f"{name:<40} {seconds * 1000:>9.1f} {seconds / total:>6.1%}")
+
+    init = bench_init(args.runs)
+    init.pop('import app.main')
+    print(f"\n{'deferred initialization':<40} {'ms':>9}")
+    for name, seconds in init.items():
+        print(f"{name:<40} {seconds * 1000:>9.1f}")
+    print(f"{'(total if loaded at startup)':<40} {(total + sum(init.values())) * 1000:>9.1f}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'import_total': total, 'imports': imports, 'init': init}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
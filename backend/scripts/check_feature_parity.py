@@ -0,0 +1,126 @@
+"""
+特徴量エンジニアリングのパリティチェック & ベンチマーク
+
+NumPy版 (app.processing.feature_engineering) の出力を、以前のpandas版の実装と
+ランダムなレースデータ (欠損・同値・キー欠落を含む) で比較する。
+
+使い方 (backendディレクトリで実行):
+    python -m scripts.check_feature_parity --races 2000
+"""
+import argparse
+import math
+import random
+import time
+import numpy as np
+import pandas as pd
+from app.processing import feature_engineering
+
+def engineer_boat_features_pandas(data_dict: dict) -> dict:
+    """以前の実装 (1行のDataFrameで計算する)"""
+    df = pd.DataFrame([data_dict])
+
+    boats = range(1, 7)
+    col_win_rate = [f'r{b}_global_win_rate' for b in boats]
+    col_motor    = [f'r{b}_motor_3ren' for b in boats]
+    col_tenji    = [f'r{b}_exhibition_time' for b in boats]
+    col_st       = [f'r{b}_exhibition_st' for b in boats]
+
+    target_groups = {'win_rate': col_win_rate, 'motor': col_motor}
+    for name, cols in target_groups.items():
+        if not all(c in df.columns for c in cols):
+            continue
+        row_mean = df[cols].mean(axis=1)
+        row_std = df[cols].std(axis=1).replace(0, 1)
+        for col in cols:
+            df[f'{col}_z'] = (df[col] - row_mean) / row_std
+            if col != cols[0]:
+                df[f'{col}_diff_1'] = df[col] - df[cols[0]]
+
+    for name, cols in target_groups.items():
+        if not all(c in df.columns for c in cols): continue
+        ranks = df[cols].rank(axis=1, ascending=False, method='min')
+        for i, col in enumerate(cols):
+            df[f'{col}_rank'] = ranks[cols[i]]
+
+    time_groups = {'tenji': col_tenji, 'st': col_st}
+    for name, cols in time_groups.items():
+        if not all(c in df.columns for c in cols): continue
+        ranks = df[cols].rank(axis=1, ascending=True, method='min')
+        for i, col in enumerate(cols):
+            df[f'{col}_rank'] = ranks[cols[i]]
+            df[f'{col}_is_top'] = (ranks[cols[i]] == 1).astype(int)
+
+    if all(c in df.columns for c in col_st):
+        row_st_mean = df[col_st].mean(axis=1)
+        for col in col_st:
+            df[f'{col}_gap_avg'] = df[col] - row_st_mean
+
+    return df.iloc[0].replace({np.nan: None}).to_dict()
+
+def random_race(rng: random.Random) -> dict:
+    data = {'date': '20250101', 'place_id': rng.randint(1, 24), 'race_number': rng.randint(1, 12)}
+    generators = {
+        'global_win_rate': lambda: round(rng.uniform(2.0, 8.0), 2),
+        'motor_3ren': lambda: round(rng.uniform(20.0, 60.0), 1),
+        'exhibition_time': lambda: rng.choice([6.7, 6.75, 6.8, 6.85]),  # 同タイムを多めに
+        'exhibition_st': lambda: rng.choice([-0.01, 0.05, 0.1, 0.12, 0.15, 1.0]),
+    }
+    for name, gen in generators.items():
+        if rng.random() < 0.05: continue  # 1艇分のキーが欠落
+        for b in range(1, 7):
+            if b == 6 and rng.random() < 0.1: continue
+            data[f'r{b}_{name}'] = None if rng.random() < 0.1 else gen()
+        data[f'r1_weight'] = 52.0
+    return data
+
+def same(a, b) -> bool:
+    if a is None or b is None:
+        return a is None and b is None
+    if isinstance(a, float) or isinstance(b, float):
+        return math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-12)
+    return a == b
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--races", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    races = [random_race(rng) for _ in range(args.races)]
+
+    start = time.perf_counter()
+    expected = [engineer_boat_features_pandas(r) for r in races]
+    t_pandas = time.perf_counter() - start
+
+    start = time.perf_counter()
+    single = [feature_engineering.engineer_boat_features(r) for r in races]
+    t_single = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch = feature_engineering.engineer_boat_features_batch(races)
+    t_batch = time.perf_counter() - start
+
+    mismatches = 0
+    for i, (exp, got_single, got_batch) in enumerate(zip(expected, single, batch)):
+        for got in (got_single, got_batch):
+            if set(exp) != set(got):
+                mismatches += 1
+                print(f"race {i}: key mismatch {set(exp) ^ set(got)}")
+                break
+            bad = [k for k in exp if not same(exp[k], got[k])]
+            if bad:
+                mismatches += 1
+                print(f"race {i}: value mismatch {[(k, exp[k], got[k]) for k in bad[:5]]}")
+                break
+
+    n = len(races)
+    print(f"pandas : {t_pandas / n * 1e6:8.1f} us/race")
+    print(f"single : {t_single / n * 1e6:8.1f} us/race")
+    print(f"batch  : {t_batch / n * 1e6:8.1f} us/race")
+    print("OK" if mismatches == 0 else f"{mismatches} mismatches")
+    if mismatches:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""
+負荷試験用のローカルの疑似boatrace.jp
+
+レース一覧 (index)・出走表 (racelist)・直前情報 (beforeinfo)・3連単オッズ (odds3t)・払戻金一覧 (pay) を
+スクレイパーが読める形で生成して返す。レイテンシとエラー率は設定できる。
+--archive / --fixtures を指定すると、記録済みのページがあればそちらを返す。
+
+時刻はapp.clockに従うので、scripts.load_testから使うと早回しした時刻で結果が確定する。
+単体でも起動できる (スクレイパーは BOATRACE_ORIGIN=http://127.0.0.1:8081 で向き先を変える):
+    python -m scripts.fake_boatrace --port 8081 --latency 0.05 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import os
+import random
+from collections import Counter
+from datetime import datetime, timedelta
+from aiohttp import web
+from app import clock, http_client, page_archive
+from app.processing import trifecta
+
+N_BOATS = 6
+WEATHERS = ['晴', '曇り', '雨']
+CLASSES = ['A1', 'A2', 'B1', 'B2']
+
+class FakeBoatrace:
+    def __init__(self, day: datetime = None, venues: int = 24, races: int = 12, first_deadline: str = "10:30",
+                 interval: int = 30, result_delay: int = 600, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, seed: int = 0, archive: str = None, fixtures: str = None):
+        """
+        venues場 × racesレースの1日分の時刻表を作る
+        場ごとに締切を1分ずつずらし、各場はinterval分おきに締切を迎える。
+        結果は締切のresult_delay秒後に払戻金一覧に載る
+        """
+        day = (day or clock.now()).replace(hour=0, minute=0, second=0, microsecond=0)
+        hour, minute = map(int, first_deadline.split(':'))
+        first = day + timedelta(hours=hour, minutes=minute)
+        self.day = day
+        self.timetable = sorted(
+            (first + timedelta(minutes=v + r * interval), v + 1, r + 1)
+            for v in range(venues) for r in range(races)
+        )
+        self.deadlines = {(place_id, race_number): deadline for deadline, place_id, race_number in self.timetable}
+        self.result_delay = result_delay
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.seed = seed
+        self._rng = random.Random(seed)
+        self.archive = page_archive.PageArchive(archive) if archive else None
+        self.fixtures = load_fixtures(fixtures) if fixtures else {}
+        self.requests = Counter()
+        self.errors = Counter()
+        self.recorded = Counter()
+        self._runner = None
+
+    def race_rng(self, place_id: int, race_number: int, kind: str) -> random.Random:
+        return random.Random(f"{self.seed}-{self.day:%Y%m%d}-{place_id}-{race_number}-{kind}")
+
+    def strengths(self, place_id: int, race_number: int) -> list:
+        """各艇の強さ (オッズと着順を同じ分布から作る)"""
+        rng = self.race_rng(place_id, race_number, 'strength')
+        return [rng.lognormvariate(0, 0.6) * (2.0 if boat == 1 else 1.0) for boat in range(1, N_BOATS + 1)]
+
+    def trifecta_probabilities(self, place_id: int, race_number: int) -> list:
+        s = self.strengths(place_id, race_number)
+        probs = []
+        for combination in trifecta.COMBINATIONS:
+            first, second, third = (int(b) - 1 for b in combination.split('-'))
+            rest = sum(s)
+            p = s[first] / rest
+            rest -= s[first]
+            p *= s[second] / rest
+            rest -= s[second]
+            probs.append(p * s[third] / rest)
+        return probs
+
+    def odds(self, place_id: int, race_number: int) -> list:
+        # 控除率25%
+        return [round(max(1.0, 0.75 / p), 1) for p in self.trifecta_probabilities(place_id, race_number)]
+
+    def result(self, place_id: int, race_number: int):
+        deadline = self.deadlines.get((place_id, race_number))
+        if not deadline or clock.now() < deadline + timedelta(seconds=self.result_delay):
+            return None
+        rng = self.race_rng(place_id, race_number, 'result')
+        combination = rng.choices(trifecta.COMBINATIONS, weights=self.trifecta_probabilities(place_id, race_number))[0]
+        payout = int(self.odds(place_id, race_number)[trifecta.COMBINATION_INDEX[combination]] * 100)
+        return combination, payout
+
+    # --- ページ生成 ---
+
+    def render_index(self, query) -> str:
+        venues = {}
+        for deadline, place_id, race_number in self.timetable:
+            venues.setdefault(place_id, []).append((race_number, deadline))
+        bodies = []
+        for place_id, races in sorted(venues.items()):
+            cells = ''.join(f"<td>{r}R {d:%H:%M}</td>" for r, d in races)
+            bodies.append(
+                f'<tbody><tr><td><a href="#"><img src="/static_extra/pc/images/text_place1_{place_id:02d}.png"></a></td></tr>'
+                f'<tr>{cells}</tr></tbody>'
+            )
+        return f'<html><body><div class="table1"><table>{"".join(bodies)}</table></div></body></html>'
+
+    def render_racelist(self, query) -> str:
+        place_id, race_number = int(query['jcd']), int(query['rno'])
+        rng = self.race_rng(place_id, race_number, 'racelist')
+        bodies = []
+        for boat in range(1, N_BOATS + 1):
+            rate = lambda lo, hi: f"{rng.uniform(lo, hi):.2f}"
+            bodies.append(
+                f'<tbody><tr><td>{boat}</td><td></td>'
+                f'<td><div class="is-fs11">{rng.randint(3000, 5200)} / <span class="is-fColor1">{rng.choice(CLASSES)}</span></div>'
+                f'<div>{rng.randint(20, 55)}歳/{rng.uniform(46, 60):.1f}kg</div></td>'
+                f'<td>F{rng.randint(0, 1)}<br>L0<br>0.{rng.randint(10, 22)}</td>'
+                f'<td>{rate(3, 8)}<br>{rate(10, 50)}<br>{rate(20, 70)}</td>'
+                f'<td>{rate(0, 8)}<br>{rate(0, 50)}<br>{rate(0, 70)}</td>'
+                f'<td>{rng.randint(1, 80)}<br>{rate(20, 50)}<br>{rate(30, 60)}</td></tr></tbody>'
+            )
+        return f'<html><body><div class="table1 is-tableFixed__3rdadd"><table>{"".join(bodies)}</table></div></body></html>'
+
+    def render_beforeinfo(self, query) -> str:
+        place_id, race_number = int(query['jcd']), int(query['rno'])
+        rng = self.race_rng(place_id, race_number, 'beforeinfo')
+        racers = ''.join(
+            f'<tbody><tr><td>{boat}</td><td></td><td></td><td>{rng.uniform(46, 60):.1f}kg</td>'
+            f'<td>{rng.uniform(6.6, 7.0):.2f}</td><td>{rng.choice([-0.5, 0.0, 0.5])}</td></tr></tbody>'
+            for boat in range(1, N_BOATS + 1)
+        )
+        courses = list(range(1, N_BOATS + 1))
+        if rng.random() < 0.2:
+            rng.shuffle(courses)
+        starts = ''.join(
+            f'<tr><td><div><span class="table1_boatImage1Number is-type{boat}">{boat}</span>'
+            f'<span class="table1_boatImage1Time">{"F" if rng.random() < 0.02 else ""}.{rng.randint(1, 25):02d}</span></div></td></tr>'
+            for boat in courses
+        )
+        unit = lambda cls, inner: f'<div class="weather1_bodyUnit {cls}">{inner}</div>'
+        data = lambda text: f'<span class="weather1_bodyUnitLabelData">{text}</span>'
+        weather = (
+            unit('is-direction', f'<span class="weather1_bodyUnitLabelTitle">気温</span>{data(f"{rng.uniform(5, 35):.1f}℃")}')
+            + unit('is-weather', f'<span class="weather1_bodyUnitLabelTitle">{rng.choice(WEATHERS)}</span>')
+            + unit('is-wind', data(f"{rng.randint(0, 8)}m"))
+            + unit('is-windDirection', f'<p class="weather1_bodyUnitImage is-wind{rng.randint(1, 16)}"></p>')
+            + unit('is-waterTemperature', data(f"{rng.uniform(8, 30):.1f}℃"))
+        )
+        return (
+            f'<html><body><table class="is-w748">{racers}</table>'
+            f'<table class="is-w238"><tbody>{starts}</tbody></table>'
+            f'<div class="weather1_body">{weather}</div></body></html>'
+        )
+
+    def render_odds3t(self, query) -> str:
+        odds = self.odds(int(query['jcd']), int(query['rno']))
+        rows = []
+        for block in range(N_BOATS - 1):
+            for k in range(N_BOATS - 2):
+                cells = []
+                for first in range(1, N_BOATS + 1):
+                    second = [b for b in range(1, N_BOATS + 1) if b != first][block]
+                    third = [b for b in range(1, N_BOATS + 1) if b not in (first, second)][k]
+                    value = odds[trifecta.combination_index(first, second, third)]
+                    if k == 0:
+                        cells.append(f'<td rowspan="4">{second}</td>')
+                    cells.append(f'<td>{third}</td><td>{value:.1f}</td>')
+                rows.append(f"<tr>{''.join(cells)}</tr>")
+        return (
+            '<html><body><div class="contentsFrame1_inner"><div class="table1"></div>'
+            f'<div class="table1"><table><tbody>{"".join(rows)}</tbody></table></div></div></body></html>'
+        )
+
+    def render_pay(self, query) -> str:
+        places = sorted({place_id for _, place_id, _ in self.timetable})
+        n_races = max(race_number for _, _, race_number in self.timetable)
+        tables = []
+        for start in range(0, len(places), 6):
+            group = places[start:start + 6]
+            head = ''.join(
+                f'<th colspan="3"><p class="table1_areaName"><img src="/static_extra/pc/images/text_place2_{p:02d}.png"></p></th>'
+                for p in group
+            )
+            bodies = []
+            for race_number in range(1, n_races + 1):
+                cells = []
+                for place_id in group:
+                    result = self.result(place_id, race_number)
+                    if result:
+                        combination, payout = result
+                        spans = '-'.join(f'<span>{b}</span>' for b in combination.split('-'))
+                        cells.append(f'<td>{spans}</td><td><span>¥{payout:,}</span></td><td>1</td>')
+                    else:
+                        cells.append('<td></td><td></td><td></td>')
+                bodies.append(f"<tbody><tr><th>{race_number}R</th>{''.join(cells)}</tr></tbody>")
+            tables.append(f'<table class="is-strited1"><thead><tr><th></th>{head}</tr></thead>{"".join(bodies)}</table>')
+        return f"<html><body>{''.join(tables)}</body></html>"
+
+    # --- サーバー ---
+
+    def recorded_page(self, kind: str, path_qs: str):
+        if self.archive:
+            html = self.archive.get(http_client.SITE_ORIGIN + path_qs, at=clock.now().timestamp())
+            if html:
+                return html
+        return self.fixtures.get(kind)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        kind = request.match_info['kind']
+        self.requests[kind] += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self._rng.gauss(self.latency, self.jitter)))
+        if self._rng.random() < self.error_rate:
+            self.errors[kind] += 1
+            return web.Response(status=503, text="Service Unavailable")
+
+        html = self.recorded_page(kind, request.path_qs)
+        if html is not None:
+            self.recorded[kind] += 1
+            return web.Response(body=html, content_type='text/html')
+        render = getattr(self, f"render_{kind}", None)
+        if not render:
+            return web.Response(status=404)
+        return web.Response(text=render(request.query), content_type='text/html')
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/owpc/pc/race/{kind}', self.handle)
+        return app
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """サーバーを起動してオリジン (http://host:port) を返す。port=0なら空いているポートを使う"""
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        bound_host, bound_port = self._runner.addresses[0][:2]
+        return f"http://{bound_host}:{bound_port}"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+        if self.archive:
+            self.archive.close()
+
+    def stats(self) -> dict:
+        return {
+            "requests": dict(self.requests),
+            "errors": dict(self.errors),
+            "recorded": dict(self.recorded),
+        }
+
+def load_fixtures(directory: str) -> dict:
+    """bench_parsersと同じ命名 (odds3t*.html等) のフィクスチャを種別ごとに1つ読み込む"""
+    pages = {}
+    for filename in sorted(os.listdir(directory)):
+        kind = filename.split('_')[0].split('.')[0]
+        if kind not in pages and filename.endswith('.html'):
+            with open(os.path.join(directory, filename), 'rb') as f:
+                pages[kind] = f.read()
+    return pages
+
+def add_server_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--venues", type=int, default=24)
+    parser.add_argument("--races", type=int, default=12)
+    parser.add_argument("--first-deadline", default="10:30", help="1場目の1Rの締切 (HH:MM)")
+    parser.add_argument("--interval", type=int, default=30, help="各場のレース間隔 (分)")
+    parser.add_argument("--latency", type=float, default=0.05, help="レスポンスの平均レイテンシ (秒)")
+    parser.add_argument("--jitter", type=float, default=0.02, help="レイテンシの標準偏差 (秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="503を返す割合")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--archive", help="記録済みページを返すページアーカイブのディレクトリ")
+    parser.add_argument("--fixtures", help="記録済みページを返すフィクスチャのディレクトリ")
+
+def server_from_args(args, day: datetime = None) -> FakeBoatrace:
+    return FakeBoatrace(
+        day=day, venues=args.venues, races=args.races, first_deadline=args.first_deadline,
+        interval=args.interval, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        seed=args.seed, archive=args.archive, fixtures=args.fixtures,
+    )
+
+async def serve(args):
+    server = server_from_args(args)
+    origin = await server.start(args.host, args.port)
+    print(f"Serving {len(server.timetable)} races at {origin}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""
+パイプライン全体の負荷試験
+
+疑似boatrace.jp (scripts/fake_boatrace.py) を立て、1日分 (既定は24場×12R) のレースについて
+check_and_dispatch -> Pub/Sub -> process_event を時間を早回しして流す。
+Firestore・Pub/Subは使わずプロセス内で代替する:
+  - Firestore: PROJECT_ID未設定のモックモード。書き込み通知 (add_change_listener) を記録し、
+    --firestore-latency でクライアントの同期書き込みの待ち時間を再現する
+  - Pub/Sub: 発行したメッセージを --pubsub-latency 後にprocess_eventへ直接配送する (pushサブスクリプション相当)
+
+ステージごとに処理件数・成功率・処理時間と、締切までの余裕 (slack) を表示する。
+slackは早回しの影響を除くため、実時間で測った配送遅れ・処理時間を使って
+「締切 - 発行予定時刻 - (配送遅れ + 処理時間)」として求める。
+
+使い方 (backendディレクトリで、PROJECT_IDを設定せずに実行):
+    python -m scripts.load_test
+    python -m scripts.load_test --speed 60 --latency 0.2 --error-rate 0.02 --firestore-latency 0.02
+    python -m scripts.load_test --venues 6 --races 4 --output load_test.json
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from app import clock, firestore_client, http_client, pubsub_client, worker
+from app.executor import get_executor
+from app.pubsub_client import MockPublisher
+from app.scheduler import STAGE_OFFSETS, check_and_dispatch, stop_dispatcher
+from app.stats import percentile
+from scripts.fake_boatrace import add_server_arguments, server_from_args
+
+# イベントの種類ごとに、成功すると書き込まれる内容
+EXPECTED_WRITES = {
+    'scrape_info': 'race_info',
+    'predict_5min': 'prediction',
+    'predict_1min': 'prediction',
+    'check_result': 'result',
+}
+
+class MemoryStore:
+    """Firestoreへの書き込み通知を記録する"""
+    def __init__(self, write_latency: float = 0.0):
+        self.write_latency = write_latency
+        self.writes = defaultdict(int)  # (kind, race_id) -> 件数
+        self.bets = 0
+
+    def on_change(self, kind: str, event: dict):
+        if self.write_latency:
+            # 本番のFirestoreクライアントは同期呼び出しなので、イベントループを止めて待つ
+            time.sleep(self.write_latency)
+        self.writes[(kind, event['race_id'])] += 1
+        if kind == 'bets':
+            self.bets += len(event.get('bets', []))
+
+class LoopbackPublisher(MockPublisher):
+    """発行したメッセージを遅延後にイベントループ上のdeliverへ渡す"""
+    def __init__(self, loop, deliver, latency: float = 0.0):
+        super().__init__(latency=latency, verbose=False)
+        self.loop = loop
+        self.deliver = deliver
+
+    def publish(self, topic, data: bytes):
+        future = super().publish(topic, data)
+        message = json.loads(data)
+        self.loop.call_soon_threadsafe(self.loop.call_later, self.latency, self.deliver, message)
+        return future
+
+class Recorder:
+    def __init__(self, store: MemoryStore):
+        self.store = store
+        self.events = []
+        self.in_flight = set()
+
+    def deliver(self, message: dict):
+        task = asyncio.create_task(self.run(message))
+        self.in_flight.add(task)
+        task.add_done_callback(self.in_flight.discard)
+
+    async def run(self, message: dict):
+        deadline = datetime.fromisoformat(message['deadline'])
+        fire_at = deadline - timedelta(seconds=STAGE_OFFSETS[message['type']])
+        race_id = firestore_client.get_race_id(deadline, message['place_id'], message['race_number'])
+        key = (EXPECTED_WRITES[message['type']], race_id)
+        writes_before = self.store.writes[key]
+
+        delivered_at = clock.now()
+        started = time.perf_counter()
+        error = None
+        try:
+            await worker.process_event(message)
+        except Exception as e:
+            error = str(e)
+        elapsed = time.perf_counter() - started
+
+        # 早回しの影響を除き、実時間の遅れ・処理時間で締切までの余裕を求める
+        # (check_resultは締切後のステージなので求めない)
+        delay = (delivered_at - fire_at).total_seconds() / clock.speed()
+        lead = (deadline - fire_at).total_seconds()
+        self.events.append({
+            'type': message['type'],
+            'place_id': message['place_id'],
+            'race_number': message['race_number'],
+            'ok': error is None and self.store.writes[key] > writes_before,
+            'error': error,
+            'delay': delay,
+            'elapsed': elapsed,
+            'slack': lead - delay - elapsed if lead > 0 else None,
+        })
+
+def summarize(events: list) -> dict:
+    by_type = defaultdict(list)
+    for e in events:
+        by_type[e['type']].append(e)
+
+    stages = {}
+    for event_type in STAGE_OFFSETS:
+        items = by_type.get(event_type, [])
+        elapsed = [e['elapsed'] for e in items]
+        delay = [e['delay'] for e in items]
+        slack = [e['slack'] for e in items if e['slack'] is not None]
+        stages[event_type] = {
+            'count': len(items),
+            'ok': sum(1 for e in items if e['ok']),
+            'errors': sum(1 for e in items if e['error']),
+            'elapsed_p50_ms': percentile(elapsed, 50) * 1000 if items else None,
+            'elapsed_p99_ms': percentile(elapsed, 99) * 1000 if items else None,
+            'delay_p99_ms': percentile(delay, 99) * 1000 if items else None,
+            'slack_p50_s': percentile(slack, 50),
+            'slack_min_s': min(slack) if slack else None,
+            'late': sum(1 for s in slack if s < 0),
+        }
+    return stages
+
+def print_report(report: dict):
+    print(f"races: {report['races']}  speed: x{report['speed']}  "
+          f"virtual: {report['virtual_hours']:.1f}h  real: {report['real_seconds']:.1f}s")
+    print(f"events: {report['dispatched']} dispatched, {report['processed']} processed "
+          f"({report['throughput']:.1f} events/s)  bets: {report['bets']}")
+    fmt = lambda v, spec: format(v, spec) if v is not None else format('-', '>' + spec.split('.')[0])
+    print(f"\n{'stage':<14} {'count':>6} {'ok':>6} {'err':>4} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'delay p99':>10} {'slack p50':>10} {'slack min':>10} {'late':>5}")
+    for event_type, s in report['stages'].items():
+        print(f"{event_type:<14} {s['count']:>6} {s['ok']:>6} {s['errors']:>4} "
+              f"{fmt(s['elapsed_p50_ms'], '8.1f')} {fmt(s['elapsed_p99_ms'], '8.1f')} "
+              f"{fmt(s['delay_p99_ms'], '10.1f')} {fmt(s['slack_p50_s'], '10.1f')} "
+              f"{fmt(s['slack_min_s'], '10.1f')} {s['late']:>5}")
+    for event_type, e in report['executor']['events'].items():
+        print(f"  {event_type:<12} queue wait p99 {fmt(e['queue_wait']['p99_ms'], '.1f')} ms  dropped {e['dropped']}")
+    http = report['http']
+    print(f"\nfetch latency: p50 {fmt(http['p50_ms'], '.1f')} ms  p99 {fmt(http['p99_ms'], '.1f')} ms  ({http['count']} requests)")
+    print(f"fake server: {report['server']}")
+
+async def run(args) -> dict:
+    loop = asyncio.get_running_loop()
+    day = datetime.strptime(args.date, '%Y-%m-%d') if args.date else datetime.now()
+    server = server_from_args(args, day=day)
+    http_client.BOATRACE_ORIGIN = await server.start()
+
+    store = MemoryStore(args.firestore_latency)
+    firestore_client.add_change_listener(store.on_change)
+    recorder = Recorder(store)
+    pubsub_client.publisher = LoopbackPublisher(loop, recorder.deliver, args.pubsub_latency)
+
+    first_deadline = server.timetable[0][0]
+    last_deadline = server.timetable[-1][0]
+    start = first_deadline - timedelta(seconds=max(STAGE_OFFSETS.values()) + 60)
+    end = last_deadline - timedelta(seconds=min(STAGE_OFFSETS.values()) - 60)
+    clock.accelerate(start, args.speed)
+    real_start = time.perf_counter()
+
+    try:
+        # Cloud Schedulerの定期呼び出しを再現する
+        while clock.now() < end:
+            await check_and_dispatch()
+            await clock.sleep(args.scheduler_interval)
+        while recorder.in_flight:
+            await asyncio.sleep(0.1)
+    finally:
+        await stop_dispatcher()
+        await http_client.close_session()
+        await server.stop()
+        firestore_client.remove_change_listener(store.on_change)
+        clock.reset()
+
+    real_seconds = time.perf_counter() - real_start
+    return {
+        'races': len(server.timetable),
+        'speed': args.speed,
+        'virtual_hours': (end - start).total_seconds() / 3600,
+        'real_seconds': real_seconds,
+        'dispatched': len(pubsub_client.publisher.published),
+        'processed': len(recorder.events),
+        'throughput': len(recorder.events) / real_seconds if real_seconds else 0,
+        'bets': store.bets,
+        'stages': summarize(recorder.events),
+        'executor': get_executor().stats(),
+        'http': http_client.get_latency_stats(),
+        'server': server.stats(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_server_arguments(parser)
+    parser.add_argument("--date", help="レース日 (YYYY-MM-DD、既定は今日)")
+    parser.add_argument("--speed", type=float, default=120, help="時間の早回し倍率")
+    parser.add_argument("--scheduler-interval", type=float, default=300, help="check_and_dispatchを呼ぶ間隔 (仮想秒)")
+    parser.add_argument("--pubsub-latency", type=float, default=0.01, help="Pub/Subの配送遅延 (実秒)")
+    parser.add_argument("--firestore-latency", type=float, default=0.0, help="Firestoreの書き込み1回あたりの待ち時間 (実秒)")
+    parser.add_argument("--verbose", action="store_true", help="パイプラインのログも表示する")
+    parser.add_argument("--output", help="結果をJSONで保存する")
+    args = parser.parse_args()
+
+    if firestore_client.get_db() is not None:
+        parser.error("PROJECT_IDを設定せずに実行してください (本番のFirestore・Pub/Subに書き込まないため)")
+
+    logs = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with logs:
+        report = asyncio.run(run(args))
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
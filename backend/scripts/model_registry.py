@@ -0,0 +1,59 @@
+"""
+モデルレジストリ (MODEL_REGISTRY_DIR) の管理
+
+使い方 (backendディレクトリで実行):
+    python -m scripts.model_registry list
+    python -m scripts.model_registry add AutogluonModels/ag-20250101_000000 2025-01-01
+    # 次回の起動から使う
+    python -m scripts.model_registry activate 2025-01-01
+    # 起動中のサービスを再起動せずに切り替える (POST /models/{version}/activate)
+    python -m scripts.model_registry activate 2025-01-01 --url http://localhost:8080
+"""
+import argparse
+import json
+import urllib.request
+from app.ml.registry import get_registry
+
+def list_versions(args):
+    registry = get_registry()
+    current = registry.current_version()
+    for version in registry.versions():
+        print(f"{'*' if version == current else ' '} {version}")
+
+def add(args):
+    path = get_registry().add(args.source, args.version)
+    print(f"Added {args.version} ({path})")
+
+def activate(args):
+    registry = get_registry()
+    registry.path(args.version)
+    if not args.url:
+        registry.set_current(args.version)
+        print(f"{args.version} will be used from the next start")
+        return
+    request = urllib.request.Request(f"{args.url.rstrip('/')}/models/{args.version}/activate", method='POST')
+    with urllib.request.urlopen(request, timeout=30) as response:
+        print(json.loads(response.read()))
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("list", help="登録済みのバージョン (*は使用中)")
+    p.set_defaults(func=list_versions)
+
+    p = sub.add_parser("add", help="モデルディレクトリを新しいバージョンとして登録する")
+    p.add_argument("source", help="AutoGluonのモデルディレクトリ")
+    p.add_argument("version")
+    p.set_defaults(func=add)
+
+    p = sub.add_parser("activate", help="使用するバージョンを切り替える")
+    p.add_argument("version")
+    p.add_argument("--url", help="起動中のサービスのURL (指定すると再起動せずに切り替える)")
+    p.set_defaults(func=activate)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
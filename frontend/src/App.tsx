@@ -2,7 +2,7 @@ import React, { useEffect, useState } from 'react';
 import { Container, Typography, Box, CssBaseline, AppBar, Toolbar } from '@mui/material';
 import { BalanceChart } from './components/BalanceChart';
 import { BetHistory } from './components/BetHistory';
-import { getBalanceHistory, getRecentBets } from './api';
+import { getBalanceHistory, getRecentBets, subscribeEvents } from './api';
 
 function App() {
     const [balanceData, setBalanceData] = useState([]);
@@ -20,6 +20,33 @@ function App() {
             }
         };
         fetchData();
+
+        // 以降は差分をライブで反映する
+        return subscribeEvents({
+            bets: (event) => {
+                const newBets = event.bets.map((bet: any) => ({
+                    ...bet,
+                    date: event.date,
+                    place_id: event.place_id,
+                    race_number: event.race_number,
+                    race_id: event.race_id,
+                    return_amount: 0,
+                }));
+                setBets((prev: any[]) => [
+                    ...newBets,
+                    ...prev.filter((b) => !newBets.some((n: any) => n.race_id === b.race_id && n.combination === b.combination)),
+                ].slice(0, 50) as any);
+            },
+            result: (event) => {
+                const { combination, payout } = event.result;
+                setBets((prev: any[]) => prev.map((bet) => bet.race_id !== event.race_id ? bet : {
+                    ...bet,
+                    status: bet.combination === combination ? 'won' : 'lost',
+                    return_amount: bet.combination === combination ? bet.amount * payout / 100 : 0,
+                }) as any);
+                getBalanceHistory().then(setBalanceData).catch(() => undefined);
+            },
+        });
     }, []);
 
     return (
@@ -11,3 +11,12 @@ export const getRecentBets = async () => {
     const response = await axios.get(`${API_URL}/bets`);
     return response.data.bets;
 };
+
+// ベット・結果の保存をServer-Sent Eventsで受け取る (戻り値で購読解除)
+export const subscribeEvents = (handlers: { [event: string]: (data: any) => void }) => {
+    const source = new EventSource(`${API_URL}/events`);
+    Object.entries(handlers).forEach(([event, handler]) => {
+        source.addEventListener(event, (e) => handler(JSON.parse((e as MessageEvent).data)));
+    });
+    return () => source.close();
+};
@@ -46,8 +46,16 @@ resource "google_cloud_run_v2_service" "worker" {
   ingress = "INGRESS_TRAFFIC_INTERNAL_ONLY" # Only triggered by Pub/Sub
 
   template {
+    # イベントはインスタンス内のスケジューラが発行するため、常時1台起動しCPUを割り当てておく
+    # 複数台にスケールしても発行するのはFirestoreのリース (leases/dispatcher) を持つ1台だけ
+    scaling {
+      min_instance_count = 1
+    }
     containers {
       image = "us-docker.pkg.dev/cloudrun/container/hello" # Placeholder
+      resources {
+        cpu_idle = false
+      }
       env {
         name  = "PROJECT_ID"
         value = var.project_id
@@ -68,6 +76,12 @@ resource "google_pubsub_subscription" "worker_subscription" {
       service_account_email = google_service_account.invoker.email
     }
   }
+
+  # 混雑したインスタンスは429を返すので、短い間隔で再送して他のインスタンスに回す
+  retry_policy {
+    minimum_backoff = "2s"
+    maximum_backoff = "30s"
+  }
 }
 
 # Service Account for Pub/Sub to invoke Cloud Run
@@ -84,7 +98,7 @@ resource "google_cloud_run_service_iam_binding" "invoker_binding" {
 }
 
 # Cloud Scheduler (Dispatcher)
-# Triggers every minute to check for upcoming races
+# Triggers every minute to refresh the timetable and keep the in-process dispatcher alive
 resource "google_cloud_scheduler_job" "dispatcher" {
   name             = "alchemy-dispatcher"
   description      = "Triggers the dispatcher every minute"
@@ -101,3 +115,44 @@ resource "google_cloud_scheduler_job" "dispatcher" {
   }
   depends_on = [google_project_service.services]
 }
+
+# Firestore composite indexes for the paginated /api/dashboard/bets filters
+# (equality on place_id/status, optional date range, newest first)
+locals {
+  bets_indexes = {
+    "place"             = [["place_id", "ASCENDING"], ["created_at", "DESCENDING"]]
+    "status"            = [["status", "ASCENDING"], ["created_at", "DESCENDING"]]
+    "place-status"      = [["place_id", "ASCENDING"], ["status", "ASCENDING"], ["created_at", "DESCENDING"]]
+    "date"              = [["date", "DESCENDING"], ["created_at", "DESCENDING"]]
+    "place-date"        = [["place_id", "ASCENDING"], ["date", "DESCENDING"], ["created_at", "DESCENDING"]]
+    "status-date"       = [["status", "ASCENDING"], ["date", "DESCENDING"], ["created_at", "DESCENDING"]]
+    "place-status-date" = [["place_id", "ASCENDING"], ["status", "ASCENDING"], ["date", "DESCENDING"], ["created_at", "DESCENDING"]]
+  }
+}
+
+resource "google_firestore_index" "bets" {
+  for_each   = local.bets_indexes
+  project    = var.project_id
+  database   = google_firestore_database.database.name
+  collection = "bets"
+
+  dynamic "fields" {
+    for_each = each.value
+    content {
+      field_path = fields.value[0]
+      order      = fields.value[1]
+    }
+  }
+}
+
+# Processed-event claims (app/firestore_client.claim_event) are only needed while
+# Pub/Sub may redeliver, so let Firestore delete them after expire_at
+resource "google_firestore_field" "event_claims_ttl" {
+  project    = var.project_id
+  database   = google_firestore_database.database.name
+  collection = "event_claims"
+  field      = "expire_at"
+
+  ttl_config {}
+  index_config {}
+}